@@ -9,6 +9,7 @@ sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
 from stacktach import datetime_to_decimal as dt
 from stacktach import image_type
 from stacktach import models
+from stacktach import utils
 
 
 if __name__ != '__main__':
@@ -255,7 +256,7 @@ if __name__ == '__main__':
 
                 if err_id:
                     err = models.RawData.objects.get(id=err_id)
-                    queue, body = json.loads(err.json)
+                    queue, body = utils.load_raw_json(err)
                     payload = body['payload']
 
                     # Add error information to failed request report
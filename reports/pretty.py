@@ -11,6 +11,7 @@ sys.path.append(os.environ.get('STACKTACH_INSTALL_DIR', '/stacktach'))
 from stacktach import datetime_to_decimal as dt
 from stacktach import image_type
 from stacktach import models
+from stacktach import utils
 
 
 def make_report(yesterday=None, start_hour=0, hours=24, percentile=97,
@@ -136,7 +137,7 @@ def make_report(yesterday=None, start_hour=0, hours=24, percentile=97,
 
             if failure_type:
                 if err:
-                    queue, body = json.loads(err.json)
+                    queue, body = utils.load_raw_json(err)
                     payload = body['payload']
                     exc = payload.get('exception')
                     if exc:
@@ -0,0 +1,131 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import time
+
+from stacktach import db as stackdb
+from stacktach import stacklog
+
+STACKDB = stackdb
+
+
+class PrefetchController(object):
+    """Picks how many unacked messages a consumer lets the broker send
+    it (its prefetch) from how long its database commits are taking.
+
+    Every interval seconds the smoothed commit latency is compared with
+    target: below it the prefetch grows by step, up to maximum, and
+    above it the prefetch halves, down to minimum. Above ceiling the
+    consumer should stop taking messages altogether (paused), probing
+    the database while it waits. It resumes once the probes have been
+    under target for resume_after intervals in a row, so it doesn't
+    flap around the ceiling."""
+
+    def __init__(self, name, minimum, maximum, target, ceiling, step=None,
+                 interval=1, smoothing=0.3, resume_after=3):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.ceiling = ceiling
+        self.step = step or minimum
+        self.interval = interval
+        self.smoothing = smoothing
+        self.resume_after = resume_after
+        self.prefetch = maximum
+        # Exponentially weighted average commit latency, in seconds.
+        self.latency = None
+        # The same for the probes, which are kept apart since a ping
+        # is so much quicker than a commit.
+        self.probe_latency = None
+        # How many intervals in a row the probes have been under target.
+        self.recovered = 0
+        self.paused = False
+        self.last_adjust = time.time()
+
+    def _smooth(self, average, seconds):
+        if average is None:
+            return seconds
+        return average + self.smoothing * (seconds - average)
+
+    def record(self, seconds):
+        self.latency = self._smooth(self.latency, seconds)
+
+    def probe(self):
+        """Times a round trip to the database, for while we're paused and
+        so not committing anything to time."""
+        start = time.time()
+        try:
+            STACKDB.ping()
+        except Exception, e:
+            stacklog.get_logger().warn("%s: database probe failed: %s" %
+                                       (self.name, e))
+            STACKDB.close_connection()
+            seconds = max(time.time() - start, self.ceiling * 2)
+        else:
+            seconds = time.time() - start
+        self.probe_latency = self._smooth(self.probe_latency, seconds)
+
+    def adjust(self):
+        """Returns the new prefetch if it should change, otherwise None.
+        Also works out whether we should be paused."""
+        now = time.time()
+        if self.latency is None or now - self.last_adjust < self.interval:
+            return None
+        self.last_adjust = now
+        log = stacklog.get_logger()
+
+        if self.paused:
+            if self.probe_latency is not None and \
+                    self.probe_latency <= self.target:
+                self.recovered += 1
+            else:
+                self.recovered = 0
+            if self.recovered >= self.resume_after:
+                self.paused = False
+                log.info("%s: database probes %.1fms have been under "
+                         "%.1fms for %d intervals, resuming" %
+                         (self.name, self.probe_latency * 1000,
+                          self.target * 1000, self.recovered))
+                # The commit latency is from before we paused, so start
+                # again from the commits we make now, taking it slowly.
+                self.latency = None
+                if self.prefetch == self.minimum:
+                    return None
+                self.prefetch = self.minimum
+                return self.prefetch
+        elif self.latency > self.ceiling:
+            self.paused = True
+            self.probe_latency = None
+            self.recovered = 0
+            log.warn("%s: commit latency %.1fms is over %.1fms, pausing" %
+                     (self.name, self.latency * 1000, self.ceiling * 1000))
+
+        if self.latency > self.target:
+            prefetch = max(self.minimum, self.prefetch / 2)
+        else:
+            prefetch = min(self.maximum, self.prefetch + self.step)
+        if prefetch == self.prefetch:
+            return None
+
+        log.info("%s: commit latency %.1fms, prefetch %d -> %d" %
+                 (self.name, self.latency * 1000, self.prefetch, prefetch))
+        self.prefetch = prefetch
+        return prefetch
@@ -0,0 +1,152 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Compression of RawData.json with a shared dictionary.
+
+Notifications are small and mostly the same keys and values, so on
+their own they don't compress well. Priming zlib with a dictionary of
+the common parts fixes that. Python 2's zlib has no preset dictionary
+support, so we do the equivalent: compress the dictionary once, keep
+a copy of the compressor (and decompressor) that has seen it, and
+start every message from a copy of that.
+
+Compressed payloads are stored as 'z<version>:<base64>' so the
+dictionary can be changed without breaking older rows. Anything else
+is plain json. Each version's dictionary lives in
+dictionaries/raw_json.<version> and must never change once rows have
+been written with it; add a new version (and bump LATEST_VERSION)
+instead.
+
+To train a new dictionary on some dumps (in the replay.py format):
+
+    python -m stacktach.compression dump.json.gz > \\
+        stacktach/dictionaries/raw_json.2
+"""
+
+import base64
+import collections
+import gzip
+import os
+import re
+import sys
+import zlib
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(__file__), 'dictionaries')
+LATEST_VERSION = 1
+# Deflate can only refer back 32k, and the message needs some of that.
+DICTIONARY_SIZE = 16384
+
+# "key": "value", "key": 123, "key": { and bare "strings" in lists.
+FRAGMENT_RE = re.compile(r'("[^"]*": )(?:"[^"]*"|[^"{\[,}\]]*|[{\[])'
+                         r'[,}\] ]*|"[^"]*"[,}\] ]*')
+
+_compressors = {}
+_decompressors = {}
+
+
+class CompressionException(Exception):
+    pass
+
+
+def load_dictionary(version):
+    path = os.path.join(DICTIONARY_DIR, 'raw_json.%d' % version)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        raise CompressionException("No RawData.json dictionary version %d"
+                                   % version)
+
+
+def _primed(version):
+    if version not in _compressors:
+        dictionary = load_dictionary(version)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -zlib.MAX_WBITS)
+        primed = compressor.compress(dictionary) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        decompressor.decompress(primed)
+        _compressors[version] = compressor
+        _decompressors[version] = decompressor
+    return _compressors[version], _decompressors[version]
+
+
+def compress(text, version=LATEST_VERSION):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    compressor = _primed(version)[0].copy()
+    data = compressor.compress(text) + compressor.flush()
+    return 'z%d:%s' % (version, base64.b64encode(data))
+
+
+def is_compressed(text):
+    return text[:1] == 'z'
+
+
+def decompress(text):
+    """Returns the json for a RawData.json value, compressed or not."""
+    if not is_compressed(text):
+        return text
+    version, _, data = text[1:].partition(':')
+    decompressor = _primed(int(version))[1].copy()
+    return decompressor.decompress(base64.b64decode(data)) + \
+        decompressor.flush()
+
+
+def _fragments(sample):
+    for match in FRAGMENT_RE.finditer(sample):
+        yield match.group(0)
+        if match.group(1):
+            yield match.group(1)
+
+
+def train(samples, size=DICTIONARY_SIZE, min_share=0.01):
+    """Builds a dictionary out of the fragments of json that turn up in
+    at least min_share of the samples, with the most common last, where
+    they're cheapest to refer to."""
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(_fragments(sample)))
+
+    min_count = max(2, int(len(samples) * min_share))
+    fragments = []
+    total = 0
+    for fragment, count in counts.most_common():
+        if count < min_count:
+            break
+        if total + len(fragment) > size:
+            continue
+        fragments.append(fragment)
+        total += len(fragment)
+    return ''.join(reversed(fragments))
+
+
+def main(args):
+    samples = []
+    for path in args:
+        opener = path.endswith('.gz') and gzip.open or open
+        with opener(path, 'rb') as f:
+            samples.extend(line.strip() for line in f if line.strip())
+    sys.stdout.write(train(samples))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
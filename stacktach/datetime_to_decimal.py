@@ -4,9 +4,31 @@ import decimal
 import time
 
 
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _seconds_to_decimal(seconds, microsecond):
+    # For seconds >= 0 this is exactly (same digits and exponent) the
+    # Decimal(str(seconds)) + Decimal(str(microsecond)) / Decimal("1000000.0")
+    # we've always stored, without the arithmetic.
+    if not microsecond:
+        return decimal.Decimal(seconds)
+    fraction = ('%06d' % microsecond).rstrip('0')
+    return decimal.Decimal('%d.%s' % (seconds, fraction))
+
+
 def dt_to_decimal(utc):
+    if utc.tzinfo is None:
+        seconds = (utc.toordinal() - EPOCH_ORDINAL) * 86400 + \
+            utc.hour * 3600 + utc.minute * 60 + utc.second
+    else:
+        seconds = calendar.timegm(utc.utctimetuple())
+
+    if seconds >= 0:
+        return _seconds_to_decimal(seconds, utc.microsecond)
+
     decimal.getcontext().prec = 30
-    return decimal.Decimal(str(calendar.timegm(utc.utctimetuple()))) + \
+    return decimal.Decimal(str(seconds)) + \
            (decimal.Decimal(str(utc.microsecond)) /
            decimal.Decimal("1000000.0"))
 
@@ -1,46 +1,134 @@
+import sqlite3
+
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+
+from stacktach import message_dedup
 from stacktach import stacklog
 from stacktach import models
 
 
-def _safe_get(Model, **kwargs):
-    object = None
-    query = Model.objects.filter(**kwargs)
-    count = query.count()
-    if count > 1:
+def _pick(Model, objects):
+    if len(objects) > 1:
         stacklog.warn('Multiple records found for %s get.' % Model.__name__)
-        object = query[0]
-    elif count < 1:
+    elif len(objects) < 1:
         stacklog.warn('No records found for %s get.' % Model.__name__)
-    else:
-        object = query[0]
-    return object
+        return None
+    return objects[0]
+
+
+def _safe_get(Model, **kwargs):
+    # Fetching two is enough to know if there's more than one, and by
+    # id so it's the same one every time there is.
+    query = Model.objects.filter(**kwargs).order_by('id')
+    return _pick(Model, list(query[:2]))
+
+
+def ping():
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1')
+    cursor.fetchone()
+
+
+def close_connection():
+    """The next query will open a new connection."""
+    connection.close()
 
 
 def get_or_create_deployment(name):
     return models.Deployment.objects.get_or_create(name=name)
 
 
-def create_rawdata(**kwargs):
-    imagemeta_fields = ['os_architecture', 'os_version',
-                        'os_distro', 'rax_options']
+IMAGEMETA_FIELDS = ['os_architecture', 'os_version',
+                    'os_distro', 'rax_options']
+
+
+def _split_rawdata_kwargs(kwargs):
     imagemeta_kwargs = \
-        dict((k, v) for k, v in kwargs.iteritems() if k in imagemeta_fields)
+        dict((k, v) for k, v in kwargs.iteritems() if k in IMAGEMETA_FIELDS)
     rawdata_kwargs = \
-        dict((k, v) for k, v in kwargs.iteritems() if k not in imagemeta_fields)
+        dict((k, v) for k, v in kwargs.iteritems() if k not in IMAGEMETA_FIELDS)
+    return rawdata_kwargs, imagemeta_kwargs
+
+
+def create_rawdata(**kwargs):
+    rawdata_kwargs, imagemeta_kwargs = _split_rawdata_kwargs(kwargs)
     rawdata = models.RawData(**rawdata_kwargs)
-    rawdata.save()
+    try:
+        rawdata.save()
+    except IntegrityError:
+        if not rawdata.message_id:
+            raise
+        # The unique index on message_id caught a redelivery.
+        transaction.rollback_unless_managed()
+        raise message_dedup.DuplicateMessage(rawdata.message_id)
 
     imagemeta_kwargs.update({'raw_id': rawdata.id})
     save(models.RawDataImageMeta(**imagemeta_kwargs))
 
     return rawdata
 
+
+def build_rawdata(**kwargs):
+    """An unsaved RawData for an event the ingest policy dropped, so it
+    can still be aggregated."""
+    rawdata_kwargs, imagemeta_kwargs = _split_rawdata_kwargs(kwargs)
+    return models.RawData(**rawdata_kwargs)
+
+
+def find_stored_message_ids(message_ids):
+    return set(models.RawData.objects.filter(message_id__in=message_ids)
+                                     .values_list('message_id', flat=True))
+
+
+def create_rawdata_batch(kwargs_list):
+    """Create a RawData/RawDataImageMeta pair for each kwargs dict.
+
+    The RawData rows are still inserted one at a time since Django
+    can't hand back the ids of a bulk insert and everything downstream
+    needs them, but the RawDataImageMeta rows all go in together.
+    Callers are expected to wrap this in a transaction."""
+    rawdatas = []
+    imagemetas = []
+    for kwargs in kwargs_list:
+        rawdata_kwargs, imagemeta_kwargs = _split_rawdata_kwargs(kwargs)
+        rawdata = models.RawData(**rawdata_kwargs)
+        rawdata.save()
+        imagemeta_kwargs.update({'raw_id': rawdata.id})
+        imagemetas.append(models.RawDataImageMeta(**imagemeta_kwargs))
+        rawdatas.append(rawdata)
+
+    if imagemetas:
+        models.RawDataImageMeta.objects.bulk_create(imagemetas)
+
+    return rawdatas
+
+
 def create_lifecycle(**kwargs):
     return models.Lifecycle(**kwargs)
 
 
 def find_lifecycles(**kwargs):
-    return models.Lifecycle.objects.select_related().filter(**kwargs)
+    # last_raw is needed for its when, but not its json.
+    return models.Lifecycle.objects.select_related('last_raw')\
+                                   .defer('last_raw__json').filter(**kwargs)
+
+
+def update_lifecycles(lifecycles):
+    for lifecycle in lifecycles:
+        models.Lifecycle.objects.filter(id=lifecycle.id).update(
+            last_raw=lifecycle.last_raw_id,
+            last_state=lifecycle.last_state,
+            last_task_state=lifecycle.last_task_state)
+
+
+def find_recent_lifecycles(since, limit):
+    return models.Lifecycle.objects.select_related('last_raw')\
+                                   .defer('last_raw__json')\
+                                   .filter(last_raw__when__gte=since)\
+                                   .order_by('-last_raw__when')[:limit]
 
 
 def create_timing(**kwargs):
@@ -51,6 +139,12 @@ def find_timings(**kwargs):
     return models.Timing.objects.select_related().filter(**kwargs)
 
 
+def find_open_timings(lifecycle_ids):
+    return models.Timing.objects.filter(lifecycle__in=lifecycle_ids,
+                                        start_raw__isnull=False,
+                                        end_raw__isnull=True).order_by('id')
+
+
 def create_request_tracker(**kwargs):
     return models.RequestTracker(**kwargs)
 
@@ -71,6 +165,85 @@ def get_or_create_instance_delete(**kwargs):
     return models.InstanceDeletes.objects.get_or_create(**kwargs)
 
 
+def _upsert_clause(vendor, table, key_columns, columns, keep_existing):
+    """The ON DUPLICATE KEY/ON CONFLICT part of an upsert, or None if
+    the database can't do one."""
+    if vendor == 'mysql':
+        new = 'VALUES(%s)'
+        clause = 'ON DUPLICATE KEY UPDATE'
+    elif (vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24)) or \
+            (vendor == 'postgresql' and
+             getattr(connection, 'pg_version', 0) >= 90500):
+        new = 'excluded.%s'
+        clause = 'ON CONFLICT (%s) DO UPDATE SET' % ', '.join(key_columns)
+    else:
+        return None
+
+    updates = []
+    for column in columns:
+        if column in keep_existing:
+            value = 'COALESCE(%s.%s, %s)' % (table, column, new % column)
+        else:
+            value = new % column
+        updates.append('%s = %s' % (column, value))
+    return '%s %s' % (clause, ', '.join(updates))
+
+
+def _upsert(model, key, values, keep_existing=()):
+    """Inserts a row with the key and values, or updates the values of
+    the row that already has that key, in a single statement so racing
+    workers can't both insert one. Relies on a unique index on the key
+    fields. Fields in keep_existing are only updated if they're NULL.
+
+    Falls back to get_or_create() and save() on databases without an
+    upsert, and for keys with a NULL in them, which unique indexes
+    don't cover."""
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in key.keys() + values.keys()]
+    clause = None
+    if None not in key.values():
+        clause = _upsert_clause(
+            connection.vendor, qn(opts.db_table),
+            [qn(opts.get_field(name).column) for name in key],
+            [qn(opts.get_field(name).column) for name in values],
+            [qn(opts.get_field(name).column) for name in keep_existing])
+
+    if clause is None:
+        obj, created = model.objects.get_or_create(**key)
+        for name, value in values.iteritems():
+            if name in keep_existing and getattr(obj, name) is not None:
+                continue
+            setattr(obj, name, value)
+        obj.save()
+        return
+
+    row = dict(key, **values)
+    params = []
+    for field in fields:
+        value = row[field.name]
+        if field.rel is not None and value is not None:
+            value = value.pk
+        params.append(field.get_db_prep_save(value, connection=connection))
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s) %s' % (
+        qn(opts.db_table), ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)), clause)
+    connection.cursor().execute(sql, params)
+    transaction.commit_unless_managed()
+
+
+def upsert_instance_usage(instance, request_id, values, keep_existing=()):
+    _upsert(models.InstanceUsage,
+            {'instance': instance, 'request_id': request_id},
+            values, keep_existing=keep_existing)
+
+
+def upsert_instance_delete(instance, deleted_at, values):
+    _upsert(models.InstanceDeletes,
+            {'instance': instance, 'deleted_at': deleted_at}, values)
+
+
 def get_instance_usage(**kwargs):
     return _safe_get(models.InstanceUsage, **kwargs)
 
@@ -83,9 +256,81 @@ def get_instance_delete(**kwargs):
     return _safe_get(models.InstanceDeletes, **kwargs)
 
 
+def _find_by_launch(Model, launches):
+    """Looks up the Model rows for many (instance, launched_at) pairs
+    with a single query. Returns {(instance, launched_at): row}, picking
+    the same row as _safe_get(Model, instance=instance,
+    launched_at__range=(launched_at, launched_at + 1)) would."""
+    if not launches:
+        return {}
+
+    launched = [launched_at for instance, launched_at in launches]
+    rows = Model.objects.filter(
+        instance__in=set(instance for instance, launched_at in launches),
+        launched_at__range=(min(launched), max(launched) + 1))
+    by_instance = {}
+    for row in rows.order_by('id'):
+        by_instance.setdefault(row.instance, []).append(row)
+
+    found = {}
+    for instance, launched_at in launches:
+        matches = [row for row in by_instance.get(instance, [])
+                   if launched_at <= row.launched_at <= launched_at + 1]
+        found[(instance, launched_at)] = _pick(Model, matches)
+    return found
+
+
+def find_instance_usages_by_launch(launches):
+    return _find_by_launch(models.InstanceUsage, launches)
+
+
+def find_instance_deletes_by_launch(launches):
+    return _find_by_launch(models.InstanceDeletes, launches)
+
+
 def create_instance_exists(**kwargs):
     return models.InstanceExists(**kwargs)
 
 
+def create_instance_exists_batch(exists):
+    models.InstanceExists.objects.bulk_create(exists)
+
+
+def increment_ingest_count(deployment, event, period_start, received, stored):
+    counts = models.IngestCount.objects.filter(deployment=deployment,
+                                               event=event,
+                                               period_start=period_start)
+    if counts.update(received=F('received') + received,
+                     stored=F('stored') + stored):
+        return
+
+    # Another worker for the deployment may create the row first.
+    sid = transaction.savepoint()
+    try:
+        models.IngestCount(deployment=deployment, event=event,
+                           period_start=period_start, received=received,
+                           stored=stored).save()
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        counts.update(received=F('received') + received,
+                      stored=F('stored') + stored)
+
+
+def create_dead_letter(**kwargs):
+    dead_letter = models.DeadLetter(**kwargs)
+    dead_letter.save()
+    return dead_letter
+
+
+def find_dead_letters(deployment, event=None, ids=None):
+    dead_letters = models.DeadLetter.objects.filter(deployment=deployment)
+    if event:
+        dead_letters = dead_letters.filter(event=event)
+    if ids:
+        dead_letters = dead_letters.filter(id__in=ids)
+    return dead_letters.order_by('id')
+
+
 def save(obj):
     obj.save()
\ No newline at end of file
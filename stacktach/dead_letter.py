@@ -0,0 +1,136 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import datetime
+import json
+import sys
+import time
+import traceback
+
+from django.db import connection
+from django.db import transaction
+from django.db import utils as db_utils
+
+from stacktach import datetime_to_decimal as dt
+from stacktach import db as stackdb
+from stacktach import pipeline
+from stacktach import stacklog
+
+STACKDB = stackdb
+
+
+def _describe(body):
+    """The message_id and event_type of a message body, if it can be
+    decoded."""
+    try:
+        values = json.loads(body)
+        return values.get('message_id'), values.get('event_type')
+    except (ValueError, TypeError, AttributeError):
+        return None, None
+
+
+def _database_module():
+    """The DB-API module behind the database backend, if it has one."""
+    backend = sys.modules[type(connection).__module__]
+    return getattr(backend, 'Database', None)
+
+
+def is_infrastructure_error(e):
+    """Whether e is down to the post processing pool or the database
+    rather than the message being handled.
+
+    Django 1.4 re-raises most database errors as its own DatabaseError
+    (MySQL's OperationalError, lock waits and deadlocks included, is
+    the exception), so those count too, apart from IntegrityError."""
+    if isinstance(e, pipeline.PipelineException):
+        return True
+    if isinstance(e, db_utils.DatabaseError):
+        return not isinstance(e, db_utils.IntegrityError)
+    database = _database_module()
+    return database is not None and \
+        isinstance(e, (database.OperationalError, database.InterfaceError))
+
+
+class DeadLetters(object):
+    """Parks the messages a worker can't handle as DeadLetter rows, so a
+    single bad notification can't stop the deployment being consumed.
+
+    A message is tried up to attempts times, retry_delay seconds apart,
+    before it's parked, since the database may be what's failing rather
+    than the message. If parking fails too the exception is raised as
+    before, and so is an is_infrastructure_error() one, so the message is
+    redelivered instead of being parked for something that wasn't its
+    fault."""
+
+    def __init__(self, deployment, attempts=3, retry_delay=1):
+        self.deployment = deployment
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.parked = 0
+
+    def attempt(self, process, message, routing_key):
+        """Calls process(message), parking the message if it's still
+        failing after self.attempts tries. Returns True if it was
+        parked, in which case it's up to the caller to ack it."""
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                process(message)
+                return False
+            except Exception, e:
+                if getattr(message, 'acknowledged', False):
+                    # It failed after being stored and acked (and
+                    # couldn't be parked either), so retrying it would
+                    # only find it's a duplicate.
+                    raise
+                if is_infrastructure_error(e):
+                    transaction.rollback_unless_managed()
+                    raise
+                error = traceback.format_exc()
+                transaction.rollback_unless_managed()
+            if attempts >= self.attempts:
+                break
+            stacklog.warn("Attempt %d of %d at a %s message failed: %s" %
+                          (attempts, self.attempts, routing_key, e))
+            time.sleep(self.retry_delay)
+
+        self.park(routing_key, message.body, error, attempts)
+        return True
+
+    def park(self, routing_key, body, error, attempts, raw=None):
+        """Stores a message as a DeadLetter. raw is the RawData if the
+        message was stored before it failed."""
+        body = str(body)
+        if raw is not None and raw.id is None:
+            # Dropped by the ingest policy, so redriving it stores it.
+            raw = None
+        message_id, event = _describe(body)
+        parked = dt.dt_to_decimal(datetime.datetime.utcnow())
+        with transaction.commit_on_success():
+            dead_letter = STACKDB.create_dead_letter(
+                deployment=self.deployment, routing_key=routing_key,
+                message_id=message_id, event=event, json=body, raw=raw,
+                error=error, attempts=attempts, parked=parked)
+        self.parked += 1
+        stacklog.error("Parked %s message %s as dead letter %s after %d "
+                       "attempts:\n%s" % (event, message_id, dead_letter.id,
+                                          attempts, error))
+        return dead_letter
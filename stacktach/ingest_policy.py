@@ -0,0 +1,133 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import time
+
+from django.db import transaction
+
+from stacktach import db as stackdb
+from stacktach import stacklog
+
+STACKDB = stackdb
+
+STORE_ALL = 'all'
+STORE_TRANSITIONS = 'transitions'
+STORE_SAMPLE = 'sample'
+COUNT_ONLY = 'count'
+
+SECS_PER_PERIOD = 3600
+
+
+class IngestPolicyException(Exception):
+    pass
+
+
+def parse_policy(policy):
+    """Returns (kind, n) for one of 'all', 'transitions', 'count' or
+    'sample:<n>' (store 1 in n)."""
+    if policy in (STORE_ALL, STORE_TRANSITIONS, COUNT_ONLY):
+        return policy, None
+    kind, _, n = policy.partition(':')
+    if kind == STORE_SAMPLE:
+        try:
+            n = int(n)
+        except ValueError:
+            n = 0
+        if n > 0:
+            return kind, n
+    raise IngestPolicyException("Unknown ingest policy '%s'" % policy)
+
+
+def _needs_raw(event):
+    # Timings, InstanceDeletes and InstanceExists all point at the
+    # RawData row, so these have to be stored.
+    from stacktach import views
+    return event.endswith('.start') or event.endswith('.end') or \
+        event in views.USAGE_PROCESS_MAPPING
+
+
+def _is_transition(values):
+    return values.get('state') != values.get('old_state') or \
+        values.get('task') != values.get('old_task')
+
+
+class IngestPolicy(object):
+    """Decides which events get stored in RawData.
+
+    Events without a policy are always stored. For the others we keep
+    count of how many were received and stored per hour and add them
+    to IngestCount every interval seconds."""
+
+    def __init__(self, deployment, policies, interval=60):
+        self.deployment = deployment
+        self.interval = interval
+        self.policies = {}
+        for event, policy in policies.items():
+            kind, n = parse_policy(policy)
+            if kind != STORE_ALL and _needs_raw(event):
+                stacklog.warn("Ignoring '%s' ingest policy for %s, it "
+                              "always has to be stored." % (policy, event))
+                continue
+            self.policies[event] = (kind, n)
+        # event -> number seen, for sampling
+        self.seen = {}
+        # (event, period_start) -> [received, stored]
+        self.counts = {}
+        self.last_flush = time.time()
+
+    def should_store(self, values):
+        event = values.get('event')
+        policy = self.policies.get(event)
+        if policy is None:
+            return True
+
+        kind, n = policy
+        if kind == STORE_SAMPLE:
+            seen = self.seen.get(event, 0)
+            self.seen[event] = seen + 1
+            store = seen % n == 0
+        elif kind == STORE_TRANSITIONS:
+            store = _is_transition(values)
+        else:
+            store = kind == STORE_ALL
+
+        when = values['when']
+        period_start = when - when % SECS_PER_PERIOD
+        counts = self.counts.setdefault((event, period_start), [0, 0])
+        counts[0] += 1
+        if store:
+            counts[1] += 1
+        return store
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.counts:
+            return
+        with transaction.commit_on_success():
+            for (event, period_start), (received, stored) in \
+                    sorted(self.counts.items()):
+                STACKDB.increment_ingest_count(self.deployment, event,
+                                               period_start, received,
+                                               stored)
+        self.counts.clear()
@@ -0,0 +1,159 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+
+from stacktach import db as stackdb
+from stacktach import stacklog
+
+STACKDB = stackdb
+
+
+def _detach(row, field):
+    """Drops row's reference to what its foreign key field points at,
+    keeping just the id, so the cache doesn't hold on to RawData rows
+    and their json."""
+    attname = '%s_id' % field
+    key = getattr(row, attname)
+    setattr(row, field, None)
+    setattr(row, attname, key)
+
+
+class LifecycleCache(object):
+    """A bounded LRU of the Lifecycle and open Timings for each instance.
+
+    aggregate_lifecycle() looks these up for every event, which costs
+    a query or two each time. The cache is only kept up to date by this
+    process's own writes, so it should only be used by a worker that
+    sees all of the events for the instances it handles.
+
+    Lifecycles should only be added once they're saved, and discarded if
+    that's rolled back. The cache only keeps the ids of their raws, and
+    the last raw's when, rather than the RawData rows themselves."""
+
+    def __init__(self, size):
+        self.size = size
+        # instance -> [lifecycle, {timing name: [open timings]}, last when]
+        # The open timings are None until we know them.
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _entry(self, instance):
+        entry = self.entries.pop(instance, None)
+        if entry is not None:
+            self.entries[instance] = entry
+        return entry
+
+    def get(self, instance):
+        entry = self._entry(instance)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def add(self, lifecycle, open_timings=None, last_when=None):
+        """Caches a saved lifecycle. If it's already cached and
+        open_timings is None, the open timings we had are kept."""
+        entry = self.entries.pop(lifecycle.instance, None)
+        if open_timings is None and entry is not None and \
+                entry[0] is lifecycle:
+            open_timings = entry[1]
+        _detach(lifecycle, 'last_raw')
+        self.entries[lifecycle.instance] = [lifecycle, open_timings,
+                                            last_when]
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, instance):
+        """Forgets an instance, for when what's cached for it might not
+        be what's in the database."""
+        self.entries.pop(instance, None)
+
+    def discard_all(self, instances):
+        for instance in instances:
+            self.discard(instance)
+
+    def get_last_when(self, lifecycle):
+        """When the lifecycle's last raw happened, if it's cached."""
+        entry = self.entries.get(lifecycle.instance)
+        if entry is None or entry[0] is not lifecycle:
+            return None
+        return entry[2]
+
+    def get_open_timings(self, lifecycle):
+        entry = self._entry(lifecycle.instance)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def set_open_timings(self, lifecycle, timings):
+        entry = self._entry(lifecycle.instance)
+        if entry is None:
+            return
+        open_timings = {}
+        for timing in timings:
+            _detach(timing, 'start_raw')
+            open_timings.setdefault(timing.name, []).append(timing)
+        entry[1] = open_timings
+
+    def add_open_timing(self, timing):
+        open_timings = self.get_open_timings(timing.lifecycle)
+        if open_timings is not None:
+            _detach(timing, 'start_raw')
+            open_timings.setdefault(timing.name, []).append(timing)
+
+    def remove_open_timing(self, timing):
+        open_timings = self.get_open_timings(timing.lifecycle)
+        if open_timings is not None and timing in \
+                open_timings.get(timing.name, []):
+            open_timings[timing.name].remove(timing)
+
+    def warm(self, since, include=None):
+        """Load the lifecycles of instances seen since the given
+        decimal timestamp, along with their open timings. include is
+        an optional filter on the instance uuid."""
+        by_instance = {}
+        for lifecycle in STACKDB.find_recent_lifecycles(since, self.size):
+            if include is not None and not include(lifecycle.instance):
+                continue
+            # Same choice as find_lifecycles()[0] if there are duplicates.
+            current = by_instance.get(lifecycle.instance)
+            if current is None or lifecycle.id < current.id:
+                by_instance[lifecycle.instance] = lifecycle
+
+        # Most recent last, so they're the last to be evicted.
+        for lifecycle in sorted(by_instance.values(),
+                                key=lambda l: l.last_raw_id):
+            self.add(lifecycle, {}, lifecycle.last_raw.when)
+
+        lifecycles = dict((l.id, l) for l in by_instance.values())
+        ids = lifecycles.keys()
+        for i in range(0, len(ids), 500):
+            for timing in STACKDB.find_open_timings(ids[i:i + 500]):
+                timing.lifecycle = lifecycles[timing.lifecycle_id]
+                self.add_open_timing(timing)
+
+        stacklog.get_logger().info("Warmed lifecycle cache with %d "
+                                   "instances" % len(self.entries))
@@ -0,0 +1,59 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+
+
+class DuplicateMessage(Exception):
+    def __init__(self, message_id):
+        super(DuplicateMessage, self).__init__(
+            "Message %s has already been stored" % message_id)
+        self.message_id = message_id
+
+
+class MessageDedup(object):
+    """Remembers the message_ids of the last size notifications, so that
+    ones redelivered after a reconnect can be dropped without going near
+    the database. Anything older is caught by the unique index on
+    RawData.message_id."""
+
+    def __init__(self, size):
+        self.size = size
+        self.message_ids = collections.OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def is_duplicate(self, message_id):
+        if message_id and message_id in self.message_ids:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, message_id):
+        """Called once the message has been stored (or found to have
+        been stored already)."""
+        if not message_id:
+            return
+        self.message_ids.pop(message_id, None)
+        self.message_ids[message_id] = True
+        while len(self.message_ids) > self.size:
+            self.message_ids.popitem(last=False)
@@ -0,0 +1,198 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import bisect
+import contextlib
+import time
+
+from django.db import connection
+from django.db import reset_queries
+
+from stacktach import stacklog
+
+# Upper bounds of the histogram buckets, in milliseconds. Anything
+# slower lands in an extra overflow bucket.
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class StageHistogram(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds, queries):
+        self.count += 1
+        self.seconds += seconds
+        self.queries += queries
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def percentile(self, percent):
+        """The upper bound, in ms, of the bucket holding the given
+        percentile. None if it's in the overflow bucket."""
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+    def summary(self):
+        def ms(bound):
+            return bound is None and '>%d' % BUCKETS_MS[-1] or str(bound)
+
+        return ("n=%d mean=%.1fms p50<=%sms p90<=%sms p99<=%sms "
+                "max=%.1fms queries/msg=%.1f" %
+                (self.count, self.seconds * 1000 / self.count,
+                 ms(self.percentile(50)), ms(self.percentile(90)),
+                 ms(self.percentile(99)), self.max_seconds * 1000,
+                 float(self.queries) / self.count))
+
+
+class MessageStats(object):
+    """Times each stage of handling a message, and how many queries it
+    made, in a histogram per event type and stage. The histograms are
+    logged and reset every interval seconds, and any message taking
+    longer than slow_seconds overall is logged as it happens.
+
+    Counting queries needs Django's debug cursor, which is turned on
+    for the default connection of whichever thread takes a snapshot,
+    since each thread has a connection of its own (the spool drainer's,
+    for one)."""
+
+    enabled = True
+
+    def __init__(self, name, interval, slow_seconds):
+        self.name = name
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        # event_type -> stage -> StageHistogram
+        self.histograms = {}
+        self.last_dump = time.time()
+
+    def snapshot(self):
+        connection.use_debug_cursor = True
+        # process_raw_data() resets the queries itself, so count from
+        # zero rather than from wherever the list was.
+        reset_queries()
+        return time.time()
+
+    def since(self, snapshot):
+        return time.time() - snapshot, len(connection.queries)
+
+    @contextlib.contextmanager
+    def stage(self, name, stages):
+        snapshot = self.snapshot()
+        try:
+            yield
+        finally:
+            seconds, queries = self.since(snapshot)
+            stages.append((name, seconds, queries))
+
+    def record(self, event_type, instance, stages):
+        by_stage = self.histograms.setdefault(event_type, {})
+        total = 0.0
+        for name, seconds, queries in stages:
+            histogram = by_stage.get(name)
+            if histogram is None:
+                histogram = by_stage[name] = StageHistogram()
+            histogram.add(seconds, queries)
+            total += seconds
+
+        if total >= self.slow_seconds:
+            detail = ", ".join("%s=%.1fms/%dq" % (name, seconds * 1000,
+                                                  queries)
+                               for name, seconds, queries in stages)
+            stacklog.get_logger().warn(
+                "%s: slow message %.1fms event_type=%s instance=%s (%s)" %
+                (self.name, total * 1000, event_type, instance, detail))
+
+    def maybe_dump(self):
+        if time.time() - self.last_dump >= self.interval:
+            self.dump()
+
+    def dump(self):
+        self.last_dump = time.time()
+        log = stacklog.get_logger()
+        for event_type in sorted(self.histograms):
+            by_stage = self.histograms[event_type]
+            for name in sorted(by_stage):
+                log.info("%s: %s %s %s" % (self.name, event_type, name,
+                                           by_stage[name].summary()))
+        self.histograms = {}
+
+
+class IngestLag(object):
+    """How long notifications are taking to get from nova into the
+    database, from their timestamp to being stored, for the priority
+    events and for everything else."""
+
+    def __init__(self, priority_events):
+        self.priority_events = set(priority_events)
+        # 'priority'/'other' -> [count, total seconds, max seconds]
+        self.lags = {}
+
+    def record(self, event_type, when):
+        lag = max(time.time() - float(when), 0.0)
+        if event_type in self.priority_events:
+            lags = self.lags.setdefault('priority', [0, 0.0, 0.0])
+        else:
+            lags = self.lags.setdefault('other', [0, 0.0, 0.0])
+        lags[0] += 1
+        lags[1] += lag
+        lags[2] = max(lags[2], lag)
+
+    def summary(self):
+        """The lags since the last summary."""
+        lags = self.lags
+        self.lags = {}
+        return ", ".join("%s n=%d mean=%.1fs max=%.1fs" %
+                         (name, lags[name][0], lags[name][1] / lags[name][0],
+                          lags[name][2])
+                         for name in sorted(lags))
+
+
+class NullMessageStats(object):
+    """Stands in for MessageStats when it's turned off."""
+
+    enabled = False
+
+    def snapshot(self):
+        return None
+
+    def since(self, snapshot):
+        return 0, 0
+
+    @contextlib.contextmanager
+    def stage(self, name, stages):
+        yield
+
+    def record(self, event_type, instance, stages):
+        pass
+
+    def maybe_dump(self):
+        pass
+
+    def dump(self):
+        pass
@@ -54,6 +54,9 @@ class RawData(models.Model):
                                 blank=True, db_index=True)
     request_id = models.CharField(max_length=50, null=True,
                                 blank=True, db_index=True)
+    # Unique so a redelivered notification can't be stored twice.
+    message_id = models.CharField(max_length=50, null=True,
+                                  blank=True, unique=True)
 
     def __repr__(self):
         return "%s %s %s" % (self.event, self.instance, self.state)
@@ -108,6 +111,9 @@ class InstanceUsage(models.Model):
         raw = raws[0]
         return raw.deployment
 
+    class Meta:
+        unique_together = ('instance', 'request_id')
+
 class InstanceDeletes(models.Model):
     instance = models.CharField(max_length=50, null=True,
                                 blank=True, db_index=True)
@@ -117,6 +123,9 @@ class InstanceDeletes(models.Model):
                                      decimal_places=6, db_index=True)
     raw = models.ForeignKey(RawData, null=True)
 
+    class Meta:
+        unique_together = ('instance', 'deleted_at')
+
 
 class InstanceReconcile(models.Model):
     row_created = models.DateTimeField(auto_now_add=True)
@@ -225,5 +234,39 @@ class JsonReport(models.Model):
     json = models.TextField()
 
 
+class IngestCount(models.Model):
+    """How many of an event the worker received and how many it stored
+    in RawData, per deployment and hour. Only kept for events with an
+    ingest policy, so reports can scale up the sampled events."""
+    deployment = models.ForeignKey(Deployment)
+    event = models.CharField(max_length=50, db_index=True)
+    period_start = models.DecimalField(max_digits=20, decimal_places=6,
+                                       db_index=True)
+    received = models.IntegerField(default=0)
+    stored = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('deployment', 'event', 'period_start')
+
+
+class DeadLetter(models.Model):
+    """A notification the worker gave up on, parked so the rest of the
+    queue isn't held up behind it. json is the message body as it came
+    off the queue. raw is set if it was stored but couldn't be
+    aggregated. worker/redrive.py feeds them back through."""
+    deployment = models.ForeignKey(Deployment)
+    routing_key = models.CharField(max_length=50, null=True, blank=True)
+    message_id = models.CharField(max_length=50, null=True, blank=True,
+                                  db_index=True)
+    event = models.CharField(max_length=50, null=True, blank=True,
+                             db_index=True)
+    json = models.TextField()
+    raw = models.ForeignKey(RawData, related_name='+', null=True)
+    error = models.TextField()
+    attempts = models.IntegerField(default=0)
+    parked = models.DecimalField(max_digits=20, decimal_places=6,
+                                 db_index=True)
+
+
 def get_model_fields(model):
     return model._meta.fields
@@ -2,84 +2,134 @@ from stacktach import utils
 from stacktach import image_type
 
 
-class Notification(object):
-    def __init__(self, body):
-        self.body = body
-        self.request_id = body['_context_request_id']
-        self.payload = body.get('payload', {})
-        self.state = self.payload.get('state', "")
-        self.old_state = self.payload.get('old_state', "")
-        self.old_task = self.payload.get('old_task_state', "")
-        self.task = self.payload.get('new_task_state', "")
-        self.image_type = image_type.get_numeric_code(self.payload)
-        self.publisher = self.body['publisher_id']
-        self.event = self.body['event_type']
-        image_meta = self.payload.get('image_meta', {})
-        self.os_architecture = image_meta.get('org.openstack__1__architecture',
-                                              '')
-        self.os_distro = image_meta.get('org.openstack__1__os_distro', '')
-        self.os_version = image_meta.get('org.openstack__1__os_version', '')
-        self.rax_options = image_meta.get('com.rackspace__1__options', '')
+class NotificationFields(object):
+    """Everything stored in RawData for a notification, worked out once
+    by extract_fields()."""
 
-    @property
-    def when(self):
-        when = self.body.get('timestamp', None)
-        if not when:
-            when = self.body['_context_timestamp']  # Old way of doing it
-        when = utils.str_time_to_unix(when)
-        return when
+    __slots__ = ['message_id', 'event', 'publisher', 'service', 'host',
+                 'request_id', 'instance', 'tenant', 'when', 'state',
+                 'old_state', 'old_task', 'task', 'image_type',
+                 'os_architecture', 'os_distro', 'os_version',
+                 'rax_options']
 
     def rawdata_kwargs(self, deployment, routing_key, json):
         return {
             'deployment': deployment,
             'routing_key': routing_key,
+            'json': json,
+            'message_id': self.message_id,
             'event': self.event,
             'publisher': self.publisher,
-            'json': json,
+            'service': self.service,
+            'host': self.host,
+            'request_id': self.request_id,
+            'instance': self.instance,
+            'tenant': self.tenant,
+            'when': self.when,
             'state': self.state,
             'old_state': self.old_state,
             'task': self.task,
             'old_task': self.old_task,
             'image_type': self.image_type,
-            'when': self.when,
-            'publisher': self.publisher,
-            'service': self.service,
-            'host': self.host,
-            'instance': self.instance,
-            'request_id': self.request_id,
-            'tenant': self.tenant,
             'os_architecture': self.os_architecture,
             'os_distro': self.os_distro,
             'os_version': self.os_version,
             'rax_options': self.rax_options
         }
 
-    @property
-    def instance(self):
-        # instance UUID's seem to hide in a lot of odd places.
-        instance = self.payload.get('instance_id', None)
-        instance = self.payload.get('instance_uuid', instance)
-        if not instance:
-            instance = self.payload.get('exception', {}).get('kwargs', {}).get('uuid')
-        if not instance:
-            instance = self.payload.get('instance', {}).get('uuid')
-        return instance
+
+def find_instance(payload):
+    # instance UUID's seem to hide in a lot of odd places.
+    instance = payload.get('instance_uuid', payload.get('instance_id'))
+    if not instance:
+        instance = payload.get('exception', {}).get('kwargs', {}).get('uuid')
+    if not instance:
+        instance = payload.get('instance', {}).get('uuid')
+    return instance
+
+
+def shard_key(body):
+    """What a notification is sharded by: its instance, or its
+    message_id if it hasn't got one."""
+    return find_instance(body.get('payload', {})) or body.get('message_id')
+
+
+def find_when(body):
+    when = body.get('timestamp')
+    if not when:
+        when = body['_context_timestamp']  # Old way of doing it
+    return utils.str_time_to_unix(when)
+
+
+def extract_fields(body):
+    """The fields of one of nova's notifications."""
+    fields = NotificationFields()
+    payload = body.get('payload', {})
+    fields.message_id = body.get('message_id')
+    fields.request_id = body['_context_request_id']
+    fields.event = body['event_type']
+
+    publisher = body['publisher_id']
+    fields.publisher = publisher
+    service, dot, host = publisher.partition('.')
+    fields.service = service
+    fields.host = None
+    if dot:
+        fields.host = host
+
+    fields.instance = find_instance(payload)
+    fields.tenant = payload.get('tenant_id',
+                                body.get('_context_project_id'))
+    fields.when = find_when(body)
+
+    fields.state = payload.get('state', "")
+    fields.old_state = payload.get('old_state', "")
+    fields.old_task = payload.get('old_task_state', "")
+    fields.task = payload.get('new_task_state', "")
+
+    fields.image_type = image_type.get_numeric_code(payload)
+    image_meta = payload.get('image_meta', {})
+    fields.os_architecture = image_meta.get('org.openstack__1__architecture',
+                                            '')
+    fields.os_distro = image_meta.get('org.openstack__1__os_distro', '')
+    fields.os_version = image_meta.get('org.openstack__1__os_version', '')
+    fields.rax_options = image_meta.get('com.rackspace__1__options', '')
+    return fields
+
+
+class Notification(object):
+    """A notification's fields are only worked out when first needed,
+    and then only once. The shard router, for one, only ever needs the
+    instance."""
+
+    def __init__(self, body):
+        self.body = body
+        self.payload = body.get('payload', {})
+        self._fields = None
 
     @property
-    def host(self):
-        host = None
-        parts = self.publisher.split('.')
-        if len(parts) > 1:
-            host = ".".join(parts[1:])
-        return host
+    def fields(self):
+        if self._fields is None:
+            self._fields = extract_fields(self.body)
+        return self._fields
+
+    def __getattr__(self, name):
+        # Only called for attributes not found the normal way.
+        if name in NotificationFields.__slots__:
+            return getattr(self.fields, name)
+        raise AttributeError(name)
 
     @property
-    def service(self):
-        parts = self.publisher.split('.')
-        return parts[0]
+    def instance(self):
+        if self._fields is None:
+            return find_instance(self.payload)
+        return self._fields.instance
 
     @property
-    def tenant(self):
-        tenant = self.body.get('_context_project_id', None)
-        tenant = self.payload.get('tenant_id', tenant)
-        return tenant
+    def when(self):
+        if self._fields is None:
+            return find_when(self.body)
+        return self._fields.when
+
+    def rawdata_kwargs(self, deployment, routing_key, json):
+        return self.fields.rawdata_kwargs(deployment, routing_key, json)
@@ -0,0 +1,133 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import multiprocessing
+import os
+import Queue
+import signal
+import time
+
+from django.db import connection
+
+from stacktach import stacklog
+from stacktach import utils
+from stacktach import views
+
+
+class PipelineException(Exception):
+    pass
+
+
+def _post_process_loop(queue, lag, parent_pid):
+    # Leave the signals to the consumer, it tells us to stop with a None.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    while True:
+        try:
+            item = queue.get(timeout=1)
+        except Queue.Empty:
+            if os.getppid() != parent_pid:
+                break
+            if views.LIFECYCLE_WRITER is not None:
+                views.LIFECYCLE_WRITER.maybe_flush()
+            continue
+
+        if item is None:
+            break
+
+        raw, body, queued = item
+        try:
+            views.post_process(raw, body)
+        except Exception, e:
+            stacklog.get_logger().exception(
+                "Problem post processing raw %s: %s" % (raw.id, e))
+        lag.value = time.time() - queued
+        if views.LIFECYCLE_WRITER is not None:
+            views.LIFECYCLE_WRITER.maybe_flush()
+
+    if views.LIFECYCLE_WRITER is not None:
+        views.LIFECYCLE_WRITER.flush()
+
+
+class PostProcessPipeline(object):
+    """Runs views.post_process() in a pool of processes so the consumer
+    only has to save the RawData and ack.
+
+    Each process has its own bounded queue and the raws are spread
+    across them by instance, so an instance's events are still
+    processed in order. put() blocks while the queue for the instance
+    is full, which holds the consumer back."""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queues = []
+        self.lags = []
+        self.processes = []
+
+    def start(self):
+        # Don't let the children inherit our db connection, everyone
+        # opens their own the next time they need it.
+        connection.close()
+        parent_pid = os.getpid()
+        for i in range(self.workers):
+            queue = multiprocessing.Queue(self.queue_size)
+            lag = multiprocessing.Value('d', 0.0)
+            process = multiprocessing.Process(
+                target=_post_process_loop, args=(queue, lag, parent_pid),
+                name='%s-post-process-%d' % (self.name, i))
+            process.daemon = True
+            process.start()
+            self.queues.append(queue)
+            self.lags.append(lag)
+            self.processes.append(process)
+
+    def put(self, raw, body):
+        shard = utils.shard_for(raw.instance, self.workers)
+        item = (raw, body, time.time())
+        while True:
+            try:
+                self.queues[shard].put(item, timeout=1)
+                return
+            except Queue.Full:
+                if not self.processes[shard].is_alive():
+                    raise PipelineException("Post processing worker %d "
+                                            "died" % shard)
+
+    def depths(self):
+        return [queue.qsize() for queue in self.queues]
+
+    def lag(self):
+        """Seconds between the most recently processed raw being queued
+        and its processing finishing, for each process."""
+        return [lag.value for lag in self.lags]
+
+    def stop(self):
+        """Waits for everything already queued to be processed."""
+        for queue, process in zip(self.queues, self.processes):
+            if process.is_alive():
+                queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.queues = []
+        self.lags = []
+        self.processes = []
@@ -0,0 +1,91 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Has the process that starts the workers or the verifier load what
+they need before forking them, so they share those pages copy-on-write
+rather than each loading its own."""
+
+import gc
+import importlib
+import signal
+import time
+
+from django.db.models import loading
+
+from stacktach import db
+
+# Imported when the first connection to RabbitMQ is made.
+TRANSPORT_MODULES = ['kombu.transport.librabbitmq']
+
+SMAPS = '/proc/%d/smaps'
+
+
+def preload(modules=TRANSPORT_MODULES):
+    """Imports modules and every installed app's models, then drops the
+    database connection so each child opens its own. Returns how long
+    it took."""
+    started = time.time()
+    for module in modules:
+        importlib.import_module(module)
+    loading.get_models()
+    db.close_connection()
+    # Otherwise each child frees it, copying the pages it's on.
+    gc.collect()
+    return time.time() - started
+
+
+def shared_memory(pid):
+    """How many bytes of pid's resident memory are shared with other
+    processes, or None if there's no /proc/<pid>/smaps to say."""
+    shared = 0
+    try:
+        with open(SMAPS % pid) as smaps:
+            for line in smaps:
+                if line.startswith('Shared_'):
+                    shared += int(line.split()[1]) * 1024
+    except IOError:
+        return None
+    return shared
+
+
+def report(processes, load_time):
+    """Prints what each of the forked processes got from their parent:
+    the load_time seconds it didn't spend loading, and the memory it
+    still shares."""
+    for process in processes:
+        if not process.is_alive():
+            continue
+        shared = shared_memory(process.pid)
+        if shared is None:
+            print "%s (pid %d) started %.2fs sooner" % \
+                (process.name, process.pid, load_time)
+        else:
+            print "%s (pid %d) started %.2fs sooner and shares %.1fMB" % \
+                (process.name, process.pid, load_time,
+                 shared / (1024.0 * 1024))
+
+
+def report_later(processes, load_time, delay=60):
+    """report()s on processes(), delay seconds from now, once they've
+    had time to write to their own pages."""
+    def on_alarm(signum, frame):
+        report(processes(), load_time)
+    signal.signal(signal.SIGALRM, on_alarm)
+    signal.alarm(delay)
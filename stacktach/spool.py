@@ -0,0 +1,266 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+import threading
+import time
+
+from stacktach import stacklog
+
+SEGMENT_PREFIX = 'segment-'
+CHECKPOINT = 'drained'
+
+
+class SpoolException(Exception):
+    pass
+
+
+class SpooledMessage(object):
+    """Enough of a kombu message for NovaConsumer to process."""
+
+    def __init__(self, routing_key, body):
+        self.delivery_info = {'routing_key': routing_key}
+        self.body = body
+        self.acknowledged = False
+
+    def ack(self):
+        # It was acked on the queue when it was spooled.
+        self.acknowledged = True
+
+
+class Spool(object):
+    """A local write ahead log of messages, so the worker can ack them
+    before they're in the database.
+
+    Messages are appended to numbered segment files, each record being
+    a '<length> <routing key>' line followed by the body and a newline.
+    sync() fsyncs what's been appended, so a group of messages only
+    costs one fsync, and then they can be acked. The drainer reads back
+    whatever has been synced and records how far it has got in the
+    checkpoint file once it's stored them; segments it has finished
+    with are deleted.
+
+    A record is only ever appended by one thread and read by another."""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        segments = self._segments()
+        self.write_segment = segments[-1] + 1 if segments else 0
+        self.writer = open(self._path(self.write_segment), 'ab')
+        self.read_position = self._read_checkpoint() or \
+            (segments[0] if segments else self.write_segment, 0)
+
+        # Everything up to here has been fsynced and can be read.
+        self.synced = (self.write_segment, 0)
+        self.lock = threading.Lock()
+        self.synced_event = threading.Event()
+        self.appended = 0
+        self.drained = 0
+        self.last_rate = (time.time(), 0)
+
+    def _path(self, segment):
+        return os.path.join(self.directory,
+                            '%s%010d' % (SEGMENT_PREFIX, segment))
+
+    def _segments(self):
+        return sorted(int(name[len(SEGMENT_PREFIX):])
+                      for name in os.listdir(self.directory)
+                      if name.startswith(SEGMENT_PREFIX))
+
+    def _checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT)
+
+    def _read_checkpoint(self):
+        path = self._checkpoint_path()
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            segment, offset = f.read().split()
+        return int(segment), int(offset)
+
+    def append(self, routing_key, body):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.writer.write('%d %s\n%s\n' % (len(body), routing_key, body))
+        self.appended += 1
+
+    def sync(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        synced = (self.write_segment, self.writer.tell())
+        if synced[1] >= self.segment_size:
+            self.writer.close()
+            self.write_segment += 1
+            self.writer = open(self._path(self.write_segment), 'ab')
+            synced = (self.write_segment, 0)
+        with self.lock:
+            self.synced = synced
+        self.synced_event.set()
+
+    def close(self):
+        self.sync()
+        self.writer.close()
+
+    def read(self, max_records):
+        """Returns up to max_records synced (routing_key, body) pairs
+        from where the drainer got to, and the position after them to
+        pass to commit() once they're stored."""
+        with self.lock:
+            synced = self.synced
+        segment, offset = self.read_position
+        records = []
+        while len(records) < max_records and (segment, offset) < synced:
+            path = self._path(segment)
+            if segment == synced[0]:
+                end = synced[1]
+            elif os.path.exists(path):
+                end = os.path.getsize(path)
+            else:
+                end = 0
+            if offset < end:
+                offset = self._read_records(path, offset, end, records,
+                                            max_records)
+                if len(records) >= max_records:
+                    break
+            if segment >= synced[0]:
+                break
+            if offset < end:
+                # What's left is a record that was being written when
+                # the worker died. It was never acked, so skip it.
+                stacklog.warn("Skipping partial record at %s:%d" %
+                              (path, offset))
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def _read_records(self, path, offset, end, records, max_records):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while len(records) < max_records and offset < end:
+                header = f.readline()
+                try:
+                    length, routing_key = header.rstrip('\n').split(' ', 1)
+                    length = int(length)
+                except ValueError:
+                    break
+                size = len(header) + length + 1
+                if not header.endswith('\n') or offset + size > end:
+                    break
+                records.append((routing_key, f.read(length)))
+                f.read(1)
+                offset += size
+        return offset
+
+    def commit(self, position, count):
+        """Records that everything before position is in the database."""
+        path = self._checkpoint_path()
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % position)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        self.read_position = position
+        self.drained += count
+
+        for segment in self._segments():
+            if segment >= position[0]:
+                break
+            os.remove(self._path(segment))
+
+    def drain_rate(self):
+        """Messages drained per second since the last call."""
+        now = time.time()
+        then, drained = self.last_rate
+        self.last_rate = (now, self.drained)
+        if now <= then:
+            return 0.0
+        return (self.drained - drained) / (now - then)
+
+    def depth(self):
+        """Bytes spooled but not yet drained."""
+        segment, offset = self.read_position
+        total = -offset
+        for s in self._segments():
+            if s >= segment:
+                total += os.path.getsize(self._path(s))
+        return max(total, 0)
+
+
+class SpoolDrainer(threading.Thread):
+    """Stores what's in the spool in batches of batch_size with
+    store(messages), where messages are SpooledMessages, and calls
+    idle() when there's nothing to do. If store() fails the same
+    batch is tried again a little later."""
+
+    def __init__(self, name, spool, store, idle, batch_size,
+                 retry_delay=5):
+        super(SpoolDrainer, self).__init__(name='%s-spool-drainer' % name)
+        self.daemon = True
+        self.spool = spool
+        self.store = store
+        self.idle = idle
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.stopping = False
+
+    def drain_once(self):
+        """Stores one batch, returning how many were stored."""
+        records, position = self.spool.read(self.batch_size)
+        if not records:
+            return 0
+        self.store([SpooledMessage(routing_key, body)
+                    for routing_key, body in records])
+        self.spool.commit(position, len(records))
+        return len(records)
+
+    def run(self):
+        while True:
+            try:
+                drained = self.drain_once()
+            except Exception, e:
+                stacklog.get_logger().exception(
+                    "%s: problem draining the spool, retrying in %ds: %s"
+                    % (self.name, self.retry_delay, e))
+                if self.stopping:
+                    break
+                time.sleep(self.retry_delay)
+                continue
+
+            if drained:
+                if self.stopping:
+                    # The rest is drained when the worker next starts.
+                    break
+                continue
+            self.idle()
+            if self.stopping:
+                break
+            self.spool.synced_event.wait(1)
+            self.spool.synced_event.clear()
+
+    def stop(self):
+        """Waits for the batch being stored, if there is one. Anything
+        else stays in the spool."""
+        self.stopping = True
+        self.spool.synced_event.set()
+        self.join()
@@ -3,6 +3,7 @@ import datetime
 import json
 
 from django.db.models import Q
+from django.db.models import Sum
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 
@@ -32,6 +33,14 @@ def routing_key_type(key):
     return ' '
 
 
+def get_ingest_counts(period_from, period_to):
+    counts = models.IngestCount.objects.filter(period_start__gte=period_from,
+                                               period_start__lt=period_to)
+    return counts.values('deployment__name', 'event')\
+                 .annotate(received=Sum('received'), stored=Sum('stored'))\
+                 .order_by('deployment__name', 'event')
+
+
 def get_deployments():
     return models.Deployment.objects.all().order_by('name')
 
@@ -96,6 +105,21 @@ def do_events(request):
     return rsp(json.dumps(results))
 
 
+def do_ingest_counts(request):
+    """How many of each event with an ingest policy were received and
+    how many stored, so sampled events can be scaled up."""
+    now = datetime.datetime.utcnow()
+    yesterday = now - datetime.timedelta(days=1)
+    period_from = request.GET.get('period_from', dt.dt_to_decimal(yesterday))
+    period_to = request.GET.get('period_to', dt.dt_to_decimal(now))
+    results = [["Deployment", "Event", "Received", "Stored", "Dropped"]]
+    for count in get_ingest_counts(period_from, period_to):
+        results.append([count['deployment__name'], count['event'],
+                        count['received'], count['stored'],
+                        count['received'] - count['stored']])
+    return rsp(json.dumps(results))
+
+
 def do_hosts(request):
     hosts = get_host_names()
     results = [["Host Name"]]
@@ -226,7 +250,7 @@ def do_show(request, event_id):
     results.append(["Req ID", event.request_id])
 
     final = [results, ]
-    j = json.loads(event.json)
+    j = utils.load_raw_json(event)
     final.append(json.dumps(j, indent=2))
     final.append(event.instance)
 
@@ -19,12 +19,30 @@
 # IN THE SOFTWARE.
 
 from datetime import datetime
+from datetime import timedelta
+import json
+import os
 import unittest
+
+from django.db import connection
+from django.db import reset_queries
+from django.test import TestCase
+
 import db
+from stacktach import compression
+from stacktach import message_dedup
+from stacktach import utils
+from stacktach import views
 from stacktach.datetime_to_decimal import dt_to_decimal
+from stacktach.models import DeadLetter
+from stacktach.models import IngestCount
+from stacktach.models import InstanceExists
+from stacktach.models import InstanceDeletes
+from stacktach.models import InstanceUsage
 from stacktach.models import RawDataImageMeta
 from stacktach.models import RawData
 from stacktach.models import get_model_fields
+import worker.redrive as redrive
 
 
 class RawDataImageMetaDbTestCase(unittest.TestCase):
@@ -39,7 +57,8 @@ class RawDataImageMetaDbTestCase(unittest.TestCase):
             'publisher': '', 'event': 'compute.instance.exists',
             'service': '', 'host': '', 'instance': '1234-5678-9012-3456',
             'request_id': '1234', 'os_architecture': 'x86', 'os_version': '1',
-            'os_distro': 'windows', 'rax_options': '2'}
+            'os_distro': 'windows', 'rax_options': '2',
+            'message_id': 'message-1'}
 
         rawdata = db.create_rawdata(**kwargs)
 
@@ -55,3 +74,393 @@ class RawDataImageMetaDbTestCase(unittest.TestCase):
         self.assertEquals(raw_image_meta.os_version, kwargs['os_version'])
         self.assertEquals(raw_image_meta.os_distro, kwargs['os_distro'])
         self.assertEquals(raw_image_meta.rax_options, kwargs['rax_options'])
+
+    def test_create_rawdata_batch_should_populate_rawdata_and_imagemeta(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        kwargs_list = []
+        for instance in ['1234-5678-9012-3456', '6543-2109-8765-4321']:
+            kwargs_list.append({
+                'deployment': deployment,
+                'when': dt_to_decimal(datetime.utcnow()),
+                'tenant': '1', 'json': '{}', 'routing_key': 'monitor.info',
+                'state': 'active', 'old_state': '', 'old_task': '',
+                'task': '', 'image_type': 1, 'publisher': '',
+                'event': 'compute.instance.update', 'service': '',
+                'host': '', 'instance': instance, 'request_id': '1234',
+                'os_architecture': 'x86', 'os_version': '1',
+                'os_distro': 'windows', 'rax_options': '2'})
+
+        rawdatas = db.create_rawdata_batch(kwargs_list)
+
+        self.assertEquals(len(rawdatas), 2)
+        for rawdata, kwargs in zip(rawdatas, kwargs_list):
+            self.assertEquals(rawdata.instance, kwargs['instance'])
+            raw_image_meta = RawDataImageMeta.objects.get(raw=rawdata)
+            self.assertEquals(raw_image_meta.os_architecture,
+                              kwargs['os_architecture'])
+            self.assertEquals(raw_image_meta.os_distro, kwargs['os_distro'])
+
+
+class LifecycleDbTestCase(TestCase):
+    def _create_raw(self, deployment, instance, when):
+        return db.create_rawdata(
+            deployment=deployment, when=when, tenant='1', json='{}',
+            routing_key='monitor.info', state='active', old_state='',
+            old_task='', task='', image_type=1, publisher='',
+            event='compute.instance.create.start', service='', host='',
+            instance=instance, request_id='1234', os_architecture='',
+            os_version='', os_distro='', rax_options='')
+
+    def test_find_recent_lifecycles_and_open_timings(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        old = dt_to_decimal(datetime(2013, 1, 1))
+        new = dt_to_decimal(datetime.utcnow())
+        old_raw = self._create_raw(deployment, 'old-instance', old)
+        new_raw = self._create_raw(deployment, 'new-instance', new)
+        old_lifecycle = db.create_lifecycle(instance='old-instance',
+                                            last_raw=old_raw)
+        db.save(old_lifecycle)
+        new_lifecycle = db.create_lifecycle(instance='new-instance',
+                                            last_raw=new_raw)
+        db.save(new_lifecycle)
+        open_timing = db.create_timing(name='compute.instance.create',
+                                       lifecycle=new_lifecycle,
+                                       start_raw=new_raw, start_when=new)
+        db.save(open_timing)
+        closed_timing = db.create_timing(name='compute.instance.resize',
+                                         lifecycle=new_lifecycle,
+                                         start_raw=new_raw, end_raw=new_raw)
+        db.save(closed_timing)
+
+        recent = list(db.find_recent_lifecycles(new - 60, 10))
+        self.assertEquals(recent, [new_lifecycle])
+        timings = list(db.find_open_timings([old_lifecycle.id,
+                                             new_lifecycle.id]))
+        self.assertEquals(timings, [open_timing])
+
+    def test_update_lifecycles(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        when = dt_to_decimal(datetime.utcnow())
+        raw1 = self._create_raw(deployment, 'instance1', when)
+        raw2 = self._create_raw(deployment, 'instance1', when + 1)
+        lifecycle = db.create_lifecycle(instance='instance1', last_raw=raw1,
+                                        last_state='building')
+        db.save(lifecycle)
+
+        lifecycle.last_raw = raw2
+        lifecycle.last_state = 'active'
+        lifecycle.last_task_state = 'spawning'
+        db.update_lifecycles([lifecycle])
+
+        with self.assertNumQueries(1):
+            lifecycle = db.find_lifecycles(instance='instance1')[0]
+            self.assertAlmostEquals(lifecycle.last_raw.when, raw2.when, 3)
+        self.assertEquals(lifecycle.last_raw_id, raw2.id)
+        self.assertEquals(lifecycle.last_state, 'active')
+        self.assertEquals(lifecycle.last_task_state, 'spawning')
+
+    def test_increment_ingest_count(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        period_start = dt_to_decimal(datetime(2013, 2, 4, 17))
+        event = 'compute.instance.update'
+        db.increment_ingest_count(deployment, event, period_start, 10, 1)
+        db.increment_ingest_count(deployment, event, period_start, 5, 2)
+
+        counts = IngestCount.objects.filter(deployment=deployment)
+        self.assertEquals(len(counts), 1)
+        self.assertEquals(counts[0].received, 15)
+        self.assertEquals(counts[0].stored, 3)
+
+    def test_compressed_json(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        when = dt_to_decimal(datetime.utcnow())
+        raw = self._create_raw(deployment, 'instance1', when)
+        body = {'event_type': 'compute.instance.update',
+                'payload': {'instance_id': 'instance1'}}
+        raw.json = compression.compress(json.dumps(['monitor.info', body]))
+        raw.save()
+
+        raw = RawData.objects.select_related().defer('json').get(id=raw.id)
+        self.assertEquals(raw.instance, 'instance1')
+        self.assertEquals(utils.load_raw_json(raw), ['monitor.info', body])
+
+    def test_create_rawdata_duplicate_message_id(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        when = dt_to_decimal(datetime.utcnow())
+        kwargs = dict(deployment=deployment, when=when, json='{}',
+                      event='compute.instance.update', instance='instance1',
+                      message_id='message-1')
+        db.create_rawdata(**kwargs)
+        self.assertRaises(message_dedup.DuplicateMessage, db.create_rawdata,
+                          **kwargs)
+
+        # Messages without an id can't be told apart.
+        kwargs['message_id'] = None
+        db.create_rawdata(**kwargs)
+        db.create_rawdata(**kwargs)
+
+        self.assertEquals(db.find_stored_message_ids(['message-1',
+                                                      'message-2']),
+                          set(['message-1']))
+        self.assertEquals(RawData.objects.count(), 3)
+
+    def test_redrive_dead_letter(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        body = {'event_type': 'compute.instance.update',
+                'publisher_id': 'compute.c-10-1-2-3',
+                'timestamp': '2013-06-01 00:00:00.000000',
+                'message_id': 'message-1',
+                '_context_request_id': 'req-1',
+                'payload': {'instance_id': 'instance1',
+                            'tenant_id': '1',
+                            'state': 'active',
+                            'old_state': 'building',
+                            'image_meta': {}}}
+        db.create_dead_letter(deployment=deployment,
+                              routing_key='monitor.info',
+                              message_id='message-1',
+                              event='compute.instance.update',
+                              json=json.dumps(body), error='ValueError: bad',
+                              attempts=3, parked=dt_to_decimal(
+                                  datetime.utcnow()))
+
+        parked = list(db.find_dead_letters(deployment,
+                                           event=body['event_type']))
+        self.assertEquals(len(parked), 1)
+        self.assertEquals(parked[0].message_id, 'message-1')
+        self.assertEquals(parked[0].attempts, 3)
+
+        self.assertEquals(redrive.redrive(deployment), (1, 0))
+        self.assertEquals(DeadLetter.objects.count(), 0)
+        raw = RawData.objects.get(message_id='message-1')
+        self.assertEquals(utils.load_raw_json(raw), ['monitor.info', body])
+
+
+class UsageDbTestCase(TestCase):
+    def test_upsert_instance_usage(self):
+        launched_at = dt_to_decimal(datetime(2013, 1, 1))
+        db.upsert_instance_usage('instance1', 'req-1',
+                                 {'tenant': '1', 'instance_type_id': '1'})
+        db.upsert_instance_usage('instance1', 'req-1',
+                                 {'tenant': '1', 'launched_at': launched_at},
+                                 keep_existing=['launched_at'])
+        db.upsert_instance_usage('instance1', 'req-1',
+                                 {'tenant': '2',
+                                  'launched_at': launched_at + 1},
+                                 keep_existing=['launched_at'])
+        db.upsert_instance_usage('instance1', 'req-2', {'tenant': '1'})
+
+        usage = InstanceUsage.objects.get(instance='instance1',
+                                          request_id='req-1')
+        self.assertEquals(usage.tenant, '2')
+        self.assertEquals(usage.instance_type_id, '1')
+        self.assertEquals(usage.launched_at, launched_at)
+        self.assertEquals(InstanceUsage.objects.count(), 2)
+
+    def test_upsert_instance_usage_without_request_id(self):
+        db.upsert_instance_usage('instance1', None, {'tenant': '1'})
+        db.upsert_instance_usage('instance1', None, {'tenant': '2'})
+
+        usage = InstanceUsage.objects.get(instance='instance1')
+        self.assertEquals(usage.tenant, '2')
+
+    def test_upsert_instance_delete(self):
+        deployment = db.get_or_create_deployment('deployment1')[0]
+        deleted_at = dt_to_decimal(datetime(2013, 1, 2))
+        launched_at = dt_to_decimal(datetime(2013, 1, 1))
+        raw = db.create_rawdata(deployment=deployment, when=deleted_at,
+                                json='{}', instance='instance1',
+                                event='compute.instance.delete.end')
+        db.upsert_instance_delete('instance1', deleted_at, {'raw': raw})
+        db.upsert_instance_delete('instance1', deleted_at,
+                                  {'raw': raw, 'launched_at': launched_at})
+
+        delete = InstanceDeletes.objects.get(instance='instance1')
+        self.assertEquals(delete.raw_id, raw.id)
+        self.assertEquals(delete.deleted_at, deleted_at)
+        self.assertEquals(delete.launched_at, launched_at)
+
+    def test_find_instance_usages_by_launch(self):
+        launched_at = dt_to_decimal(datetime(2013, 1, 1))
+        db.upsert_instance_usage('instance1', 'req-1',
+                                 {'launched_at': launched_at})
+        db.upsert_instance_usage('instance1', 'req-2',
+                                 {'launched_at': launched_at + 100})
+        db.upsert_instance_usage('instance2', 'req-3',
+                                 {'launched_at': launched_at})
+        launch1 = ('instance1', launched_at)
+        launch2 = ('instance2', launched_at)
+        launch3 = ('instance1', launched_at + 100)
+
+        found = db.find_instance_usages_by_launch([launch1, launch2,
+                                                   launch3])
+        self.assertEquals(found[launch1].request_id, 'req-1')
+        self.assertEquals(found[launch2].request_id, 'req-3')
+        self.assertEquals(found[launch3].request_id, 'req-2')
+
+    def test_create_instance_exists_batch(self):
+        launched_at = dt_to_decimal(datetime(2013, 1, 1))
+        db.create_instance_exists_batch([
+            db.create_instance_exists(instance='instance%d' % i,
+                                      launched_at=launched_at,
+                                      message_id='message-%d' % i)
+            for i in range(100)])
+        self.assertEquals(InstanceExists.objects.count(), 100)
+
+
+QUERY_BUDGETS = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                             'integration', 'query_budgets.json')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class QueryBudgetTestCase(TestCase):
+    """Puts an instance through every event views.post_process() handles
+    and checks none of them makes more queries than its budget in
+    tests/integration/query_budgets.json. Lower the budget there when a
+    change saves queries; raising it should be a deliberate choice."""
+
+    def setUp(self):
+        self.deployment = db.get_or_create_deployment('deployment1')[0]
+        self.when = datetime(2013, 6, 1)
+        self.launched_at = ''
+        self.deleted_at = ''
+        self.messages = 0
+        self.debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        with open(QUERY_BUDGETS) as f:
+            self.budgets = json.load(f)
+
+    def tearDown(self):
+        connection.use_debug_cursor = self.debug_cursor
+
+    def _tick(self):
+        self.when += timedelta(seconds=5)
+        return self.when.strftime(TIME_FORMAT)
+
+    def _launch(self):
+        self.launched_at = self._tick()
+
+    def _notification(self, event, request_id, service='compute',
+                      routing_key='monitor.info', **payload):
+        when = self._tick()
+        self.messages += 1
+        body = {
+            'event_type': event,
+            'publisher_id': '%s.host1' % service,
+            'timestamp': when,
+            'message_id': 'message-%d' % self.messages,
+            'priority': routing_key == 'monitor.error' and 'ERROR' or 'INFO',
+            '_context_request_id': request_id,
+            '_context_timestamp': when,
+            'payload': {
+                'instance_id': 'instance1',
+                'tenant_id': 'tenant1',
+                'instance_type_id': '1',
+                'state': 'active',
+                'old_state': 'active',
+                'old_task_state': '',
+                'new_task_state': '',
+                'launched_at': self.launched_at,
+                'deleted_at': self.deleted_at,
+                'image_meta': {
+                    'org.openstack__1__architecture': 'x64',
+                    'org.openstack__1__os_distro': 'org.ubuntu',
+                    'org.openstack__1__os_version': '12.04',
+                    'com.rackspace__1__options': '0',
+                },
+            },
+        }
+        body['payload'].update(payload)
+        return routing_key, body
+
+    def _exists(self):
+        return self._notification('compute.instance.exists', 'req-0',
+                                  audit_period_beginning='2013-06-01 '
+                                                         '00:00:00.000000',
+                                  audit_period_ending=self._tick())
+
+    def _history(self):
+        """The notifications for an instance that's created, rebuilt,
+        resized, reverted and deleted. Each launch gets its own
+        launched_at so the exists always find exactly one usage."""
+        n = self._notification
+        yield n('compute.instance.update', 'req-1', service='api',
+                state='building', old_state=None,
+                new_task_state='scheduling')
+        yield n('compute.instance.update', 'req-1', state='building',
+                old_state='building', old_task_state='scheduling',
+                new_task_state='spawning')
+        yield n('compute.instance.create.start', 'req-1', state='building',
+                old_state='building', old_task_state='spawning')
+        self._launch()
+        yield n('compute.instance.create.end', 'req-1', message='Success')
+        yield self._exists()
+        yield n('compute.instance.rebuild.start', 'req-2')
+        self._launch()
+        yield n('compute.instance.rebuild.end', 'req-2')
+        yield n('compute.instance.resize.prep.start', 'req-3')
+        yield n('compute.instance.resize.prep.end', 'req-3',
+                new_instance_type_id='2')
+        self._launch()
+        yield n('compute.instance.finish_resize.end', 'req-3',
+                instance_type_id='2')
+        yield n('compute.instance.resize.revert.start', 'req-4',
+                instance_type_id='2')
+        self._launch()
+        yield n('compute.instance.resize.revert.end', 'req-4')
+        yield self._exists()
+        yield n('compute.instance.delete.start', 'req-5',
+                new_task_state='deleting')
+        yield n('compute.instance.delete.error', 'req-5',
+                routing_key='monitor.error', old_task_state='deleting')
+        yield n('compute.instance.delete.start', 'req-6',
+                new_task_state='deleting')
+        self.deleted_at = self._tick()
+        yield n('compute.instance.delete.end', 'req-6', state='deleted',
+                old_task_state='deleting')
+        yield self._exists()
+
+    def _queries(self):
+        sql = [query['sql'] for query in connection.queries]
+        reset_queries()
+        return sql
+
+    def _run(self):
+        """Returns {event: {stage: [sql, ...]}} with the most queries
+        any one of each event made in each stage."""
+        queries = {}
+        for routing_key, body in self._history():
+            args = (routing_key, body)
+            raw = views.process_raw_data(self.deployment, args,
+                                         json.dumps(args))
+            stages = [('process_raw_data', self._queries())]
+            views.post_process(raw, body)
+            stages.append(('post_process', self._queries()))
+
+            event = queries.setdefault(body['event_type'], {})
+            for stage, sql in stages:
+                if stage not in event or len(sql) > len(event[stage]):
+                    event[stage] = sql
+        return queries
+
+    def test_every_event_has_a_budget(self):
+        events = set(self._run().keys())
+        self.assertTrue(set(views.INSTANCE_EVENT.values()) <= events)
+        self.assertEquals(events, set(self.budgets.keys()))
+
+    def test_history_has_task_states(self):
+        self._run()
+        deletes = RawData.objects.filter(event='compute.instance.delete.start')
+        self.assertEquals([raw.task for raw in deletes],
+                          ['deleting', 'deleting'])
+
+    def test_queries_within_budget(self):
+        over = []
+        for event, stages in sorted(self._run().items()):
+            for stage, sql in sorted(stages.items()):
+                budget = self.budgets[event][stage]
+                if len(sql) > budget:
+                    over.append("%s %s made %d queries, budget %d:\n    %s"
+                                % (event, stage, len(sql), budget,
+                                   '\n    '.join(sql)))
+        self.assertFalse(over, '\n'.join(over))
@@ -7,6 +7,7 @@ urlpatterns = patterns('',
     url(r'stacky/deployments/$', 'stacktach.stacky_server.do_deployments'),
     url(r'stacky/events/$', 'stacktach.stacky_server.do_events'),
     url(r'stacky/hosts/$', 'stacktach.stacky_server.do_hosts'),
+    url(r'stacky/ingest/$', 'stacktach.stacky_server.do_ingest_counts'),
     url(r'stacky/uuid/$', 'stacktach.stacky_server.do_uuid'),
     url(r'stacky/timings/$', 'stacktach.stacky_server.do_timings'),
     url(r'stacky/timings/uuid/$', 'stacktach.stacky_server.do_timings_uuid'),
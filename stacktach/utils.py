@@ -1,10 +1,52 @@
 import datetime
+import json
+import re
 import uuid
+import zlib
 
+from stacktach import compression
 from stacktach import datetime_to_decimal as dt
 
 
+# The timestamps nova sends, with either a T or a space in the middle
+# and optional fractional seconds.
+TIMESTAMP_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+                          r'(?:\.(\d{1,6}))?\Z')
+
+# Most messages carry the same timestamp a couple of times, and the
+# audit period ones are shared by every exists in the period.
+TIMESTAMP_CACHE_SIZE = 4096
+_timestamp_cache = {}
+
+
 def str_time_to_unix(when):
+    unix = _timestamp_cache.get(when)
+    if unix is None:
+        unix = _str_time_to_unix(when)
+        if len(_timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+            _timestamp_cache.clear()
+        _timestamp_cache[when] = unix
+    return unix
+
+
+def _str_time_to_unix(when):
+    match = TIMESTAMP_RE.match(when)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        microsecond = fraction and int(fraction.ljust(6, '0')) or 0
+        try:
+            parsed = datetime.datetime(int(year), int(month), int(day),
+                                       int(hour), int(minute), int(second),
+                                       microsecond)
+        except ValueError:
+            pass
+        else:
+            return dt.dt_to_decimal(parsed)
+
+    return _strptime_to_unix(when)
+
+
+def _strptime_to_unix(when):
     if 'T' in when:
         try:
             # Old way of doing it
@@ -27,6 +69,27 @@ def str_time_to_unix(when):
     return dt.dt_to_decimal(when)
 
 
+def load_raw_json(raw):
+    """Returns [routing_key, body] for a RawData record.
+
+    Depending on how the worker was configured RawData.json holds
+    either the json encoded [routing_key, body] pair or the original
+    message body, with the routing key only in its own column, and
+    either of those may be compressed."""
+    loaded = json.loads(compression.decompress(raw.json))
+    if isinstance(loaded, dict):
+        return [raw.routing_key, loaded]
+    return loaded
+
+
+def shard_for(key, shards):
+    """Picks one of shards for key (normally an instance uuid), the
+    same one every time."""
+    if not key:
+        return 0
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
 def is_uuid_like(val):
     try:
         converted = str(uuid.UUID(val))
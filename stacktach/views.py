@@ -1,7 +1,6 @@
 # Copyright 2012 - Dark Secret Software Inc.
 
 import datetime
-import json
 import pprint
 
 from django import db
@@ -16,6 +15,16 @@ from stacktach.notification import Notification
 
 STACKDB = stackdb
 
+# Set by the worker to a lifecycle_cache.LifecycleCache to save
+# looking up lifecycles and timings for every event.
+LIFECYCLE_CACHE = None
+# ... and to a write_behind.LifecycleWriteBehind to coalesce the
+# Lifecycle updates.
+LIFECYCLE_WRITER = None
+# ... and to an ingest_policy.IngestPolicy to only store some of the
+# high volume events.
+INGEST_POLICY = None
+
 
 def log_warn(msg):
     global LOG
@@ -70,6 +79,79 @@ def update_kpi(timing, raw):
     STACKDB.save(tracker)
 
 
+def _find_lifecycle(instance):
+    if LIFECYCLE_CACHE is not None:
+        lifecycle = LIFECYCLE_CACHE.get(instance)
+        if lifecycle is not None:
+            return lifecycle
+
+    # While we hope only one lifecycle ever exists it's quite
+    # likely we get multiple due to the workers and threads.
+    lifecycle = None
+    lifecycles = STACKDB.find_lifecycles(instance=instance)
+    if len(lifecycles) > 0:
+        lifecycle = lifecycles[0]
+    if not lifecycle:
+        lifecycle = STACKDB.create_lifecycle(instance=instance)
+    return lifecycle
+
+
+def _is_open_timing(timing):
+    try:
+        return timing.end_raw == None and timing.start_raw != None
+    except models.RawData.DoesNotExist:
+        # Our raw data was removed.
+        return False
+
+
+def _find_open_timing(name, lifecycle):
+    if LIFECYCLE_CACHE is None:
+        for t in STACKDB.find_timings(name=name, lifecycle=lifecycle):
+            if _is_open_timing(t):
+                return t
+        return None
+
+    open_timings = LIFECYCLE_CACHE.get_open_timings(lifecycle)
+    if open_timings is None:
+        timings = STACKDB.find_timings(lifecycle=lifecycle,
+                                       end_raw__isnull=True)
+        LIFECYCLE_CACHE.set_open_timings(
+            lifecycle, [t for t in timings if _is_open_timing(t)])
+        open_timings = LIFECYCLE_CACHE.get_open_timings(lifecycle)
+    timings = open_timings.get(name)
+    if timings:
+        return timings[0]
+    return None
+
+
+def _last_when(lifecycle):
+    """When the last raw the lifecycle saw happened, if there is one."""
+    if LIFECYCLE_CACHE is not None:
+        when = LIFECYCLE_CACHE.get_last_when(lifecycle)
+        if when is not None:
+            return when
+    try:
+        last_raw = lifecycle.last_raw
+    except models.RawData.DoesNotExist:
+        # Our raw data was removed.
+        return None
+    if last_raw is None:
+        return None
+    return last_raw.when
+
+
+def _find_unstarted_timing(name, lifecycle, when):
+    """The earliest timing whose .end came in, ahead of its .start, for
+    a .start at when."""
+    timings = STACKDB.find_timings(name=name, lifecycle=lifecycle,
+                                   start_raw__isnull=True,
+                                   end_when__gte=when)
+    timings = sorted(timings, key=lambda t: t.end_when)
+    if timings:
+        return timings[0]
+    return None
+
+
 def aggregate_lifecycle(raw):
     """Roll up the raw event into a Lifecycle object
     and a bunch of Timing objects.
@@ -83,18 +165,40 @@ def aggregate_lifecycle(raw):
     if not raw.instance:
         return
 
-    # While we hope only one lifecycle ever exists it's quite
-    # likely we get multiple due to the workers and threads.
-    lifecycle = None
-    lifecycles = STACKDB.find_lifecycles(instance=raw.instance)
-    if len(lifecycles) > 0:
-        lifecycle = lifecycles[0]
-    if not lifecycle:
-        lifecycle = STACKDB.create_lifecycle(instance=raw.instance)
-    lifecycle.last_raw = raw
-    lifecycle.last_state = raw.state
-    lifecycle.last_task_state = raw.old_task
-    STACKDB.save(lifecycle)
+    try:
+        _aggregate_lifecycle(raw)
+    except Exception:
+        if LIFECYCLE_CACHE is not None:
+            # It may not have been saved, or only partly.
+            LIFECYCLE_CACHE.discard(raw.instance)
+        raise
+
+
+def _aggregate_lifecycle(raw):
+    lifecycle = _find_lifecycle(raw.instance)
+    new = lifecycle.id is None
+    # Don't let an event that was overtaken undo the state of a later one,
+    # as priority events (see the worker's priority_events) can overtake
+    # earlier events for the same instance.
+    last_when = _last_when(lifecycle)
+    stale = last_when is not None and raw.when < last_when
+    if not stale:
+        # Events dropped by the ingest policy don't have a row to point at.
+        # Only the id is set, so a cached lifecycle doesn't keep the raw.
+        if raw.id is not None:
+            lifecycle.last_raw_id = raw.id
+            last_when = raw.when
+        lifecycle.last_state = raw.state
+        lifecycle.last_task_state = raw.old_task
+        if LIFECYCLE_WRITER is not None:
+            LIFECYCLE_WRITER.save(lifecycle)
+        else:
+            STACKDB.save(lifecycle)
+
+    if LIFECYCLE_CACHE is not None:
+        # Not until it's saved. A brand new lifecycle can't have any
+        # timings yet.
+        LIFECYCLE_CACHE.add(lifecycle, {} if new else None, last_when)
 
     event = raw.event
     parts = event.split('.')
@@ -116,16 +220,19 @@ def aggregate_lifecycle(raw):
     # *shouldn't* happen).
     start = step == 'start'
     timing = None
-    timings = STACKDB.find_timings(name=name, lifecycle=lifecycle)
     if not start:
-        for t in timings:
-            try:
-                if t.end_raw == None and t.start_raw != None:
-                    timing = t
-                    break
-            except models.RawData.DoesNotExist:
-                # Our raw data was removed.
-                pass
+        timing = _find_open_timing(name, lifecycle)
+    elif stale:
+        # Its .end may have overtaken it, in which case it's already
+        # got a timing with no start, and a later when than our own.
+        timing = _find_unstarted_timing(name, lifecycle, raw.when)
+        if timing is not None:
+            timing.start_raw = raw
+            timing.start_when = raw.when
+            timing.diff = timing.end_when - timing.start_when
+            update_kpi(timing, raw)
+            STACKDB.save(timing)
+            return
 
     if timing is None:
         timing = STACKDB.create_timing(name=name, lifecycle=lifecycle)
@@ -154,6 +261,12 @@ def aggregate_lifecycle(raw):
             update_kpi(timing, raw)
     STACKDB.save(timing)
 
+    if LIFECYCLE_CACHE is not None:
+        if start:
+            LIFECYCLE_CACHE.add_open_timing(timing)
+        else:
+            LIFECYCLE_CACHE.remove_open_timing(timing)
+
 
 INSTANCE_EVENT = {
     'create_start': 'compute.instance.create.start',
@@ -170,36 +283,40 @@ INSTANCE_EVENT = {
 }
 
 
+def _usage_values(payload):
+    image_meta = payload.get('image_meta', {})
+    return {
+        'tenant': payload['tenant_id'],
+        'rax_options': image_meta.get('com.rackspace__1__options', ''),
+        'os_architecture': image_meta.get('org.openstack__1__architecture',
+                                          ''),
+        'os_version': image_meta.get('org.openstack__1__os_version', ''),
+        'os_distro': image_meta.get('org.openstack__1__os_distro', ''),
+    }
+
+
 def _process_usage_for_new_launch(raw, body):
     payload = body['payload']
-    values = {}
-    values['instance'] = payload['instance_id']
-    values['request_id'] = body['_context_request_id']
-
-    (usage, new) = STACKDB.get_or_create_instance_usage(**values)
+    values = _usage_values(payload)
+    keep_existing = []
 
     if raw.event in [INSTANCE_EVENT['create_start'],
                      INSTANCE_EVENT['rebuild_start']]:
-        usage.instance_type_id = payload['instance_type_id']
+        values['instance_type_id'] = payload['instance_type_id']
 
     if raw.event in [INSTANCE_EVENT['rebuild_start'],
                      INSTANCE_EVENT['resize_prep_start'],
-                     INSTANCE_EVENT['resize_revert_start']] and\
-            usage.launched_at is None:
+                     INSTANCE_EVENT['resize_revert_start']]:
         # Grab the launched_at so if this action spans the audit period,
         #     we will have a launch record corresponding to the exists.
         #     We don't want to override a launched_at if it is already set
         #     though, because we may have already received the end event
-        usage.launched_at = utils.str_time_to_unix(payload['launched_at'])
+        values['launched_at'] = utils.str_time_to_unix(payload['launched_at'])
+        keep_existing.append('launched_at')
 
-    usage.tenant = payload['tenant_id']
-    image_meta = payload.get('image_meta', {})
-    usage.rax_options = image_meta.get('com.rackspace__1__options', '')
-    usage.os_architecture = image_meta.get('org.openstack__1__architecture',
-                                           '')
-    usage.os_version = image_meta.get('org.openstack__1__os_version', '')
-    usage.os_distro = image_meta.get('org.openstack__1__os_distro', '')
-    STACKDB.save(usage)
+    STACKDB.upsert_instance_usage(payload['instance_id'],
+                                  body['_context_request_id'], values,
+                                  keep_existing=keep_existing)
 
 
 def _process_usage_for_updates(raw, body):
@@ -209,99 +326,126 @@ def _process_usage_for_updates(raw, body):
         if 'message' in payload and payload['message'] != 'Success':
             return
 
-    instance_id = payload['instance_id']
-    request_id = body['_context_request_id']
-    (usage, new) = STACKDB.get_or_create_instance_usage(instance=instance_id,
-                                                        request_id=request_id)
+    values = _usage_values(payload)
 
     if raw.event in [INSTANCE_EVENT['create_end'],
                      INSTANCE_EVENT['rebuild_end'],
                      INSTANCE_EVENT['resize_finish_end'],
                      INSTANCE_EVENT['resize_revert_end']]:
-        usage.launched_at = utils.str_time_to_unix(payload['launched_at'])
+        values['launched_at'] = utils.str_time_to_unix(payload['launched_at'])
 
     if raw.event == INSTANCE_EVENT['resize_revert_end']:
-        usage.instance_type_id = payload['instance_type_id']
+        values['instance_type_id'] = payload['instance_type_id']
     elif raw.event == INSTANCE_EVENT['resize_prep_end']:
-        usage.instance_type_id = payload['new_instance_type_id']
+        values['instance_type_id'] = payload['new_instance_type_id']
 
-    usage.tenant = payload['tenant_id']
-    image_meta = payload.get('image_meta', {})
-    usage.rax_options = image_meta.get('com.rackspace__1__options', '')
-    usage.os_architecture = image_meta.get('org.openstack__1__architecture',
-                                           '')
-    usage.os_version = image_meta.get('org.openstack__1__os_version', '')
-    usage.os_distro = image_meta.get('org.openstack__1__os_distro', '')
-
-    STACKDB.save(usage)
+    STACKDB.upsert_instance_usage(payload['instance_id'],
+                                  body['_context_request_id'], values)
 
 
 def _process_delete(raw, body):
     payload = body['payload']
     instance_id = payload['instance_id']
     deleted_at = utils.str_time_to_unix(payload['deleted_at'])
-    values = {
-        'instance': instance_id,
-        'deleted_at': deleted_at,
-    }
-    (delete, new) = STACKDB.get_or_create_instance_delete(**values)
-    delete.raw = raw
+    values = {'raw': raw}
 
     launched_at = payload.get('launched_at')
     if launched_at and launched_at != '':
         launched_at = utils.str_time_to_unix(launched_at)
-        delete.launched_at = launched_at
+        values['launched_at'] = launched_at
 
-    STACKDB.save(delete)
+    STACKDB.upsert_instance_delete(instance_id, deleted_at, values)
 
 
-def _process_exists(raw, body):
+def _exists_values(raw, body):
+    """The InstanceExists fields for an exists event, bar the usage and
+    delete, or None if it has no launched_at."""
     payload = body['payload']
-    instance_id = payload['instance_id']
     launched_at_str = payload.get('launched_at')
-    if launched_at_str is not None and launched_at_str != '':
-        launched_at = utils.str_time_to_unix(payload['launched_at'])
-        launched_range = (launched_at, launched_at+1)
-        usage = STACKDB.get_instance_usage(instance=instance_id,
-                                           launched_at__range=launched_range)
-        values = {}
-        values['message_id'] = body['message_id']
-        values['instance'] = instance_id
-        values['launched_at'] = launched_at
-        beginning = utils.str_time_to_unix(payload['audit_period_beginning'])
-        values['audit_period_beginning'] = beginning
-        ending = utils.str_time_to_unix(payload['audit_period_ending'])
-        values['audit_period_ending'] = ending
-        values['instance_type_id'] = payload['instance_type_id']
-        if usage:
-            values['usage'] = usage
-        values['raw'] = raw
-        values['tenant'] = payload['tenant_id']
-        image_meta = payload.get('image_meta', {})
-        values['rax_options'] = image_meta.get('com.rackspace__1__options', '')
-        os_arch = image_meta.get('org.openstack__1__architecture', '')
-        values['os_architecture'] = os_arch
-        os_version = image_meta.get('org.openstack__1__os_version', '')
-        values['os_version'] = os_version
-        values['os_distro'] = image_meta.get('org.openstack__1__os_distro', '')
-
-        deleted_at = payload.get('deleted_at')
-        if deleted_at and deleted_at != '':
-            # We only want to pre-populate the 'delete' if we know this is in
-            #     fact an exist event for a deleted instance. Otherwise, there
-            #     is a chance we may populate it for a previous period's exist.
-            filter = {'instance': instance_id,
-                      'launched_at__range': launched_range}
-            delete = STACKDB.get_instance_delete(**filter)
-            deleted_at = utils.str_time_to_unix(deleted_at)
-            values['deleted_at'] = deleted_at
-            if delete:
-                values['delete'] = delete
-
-        exists = STACKDB.create_instance_exists(**values)
-        STACKDB.save(exists)
-    else:
+    if launched_at_str is None or launched_at_str == '':
+        return None
+
+    values = {}
+    values['message_id'] = body['message_id']
+    values['instance'] = payload['instance_id']
+    values['launched_at'] = utils.str_time_to_unix(launched_at_str)
+    beginning = utils.str_time_to_unix(payload['audit_period_beginning'])
+    values['audit_period_beginning'] = beginning
+    ending = utils.str_time_to_unix(payload['audit_period_ending'])
+    values['audit_period_ending'] = ending
+    values['instance_type_id'] = payload['instance_type_id']
+    values['raw'] = raw
+    values['tenant'] = payload['tenant_id']
+    image_meta = payload.get('image_meta', {})
+    values['rax_options'] = image_meta.get('com.rackspace__1__options', '')
+    os_arch = image_meta.get('org.openstack__1__architecture', '')
+    values['os_architecture'] = os_arch
+    os_version = image_meta.get('org.openstack__1__os_version', '')
+    values['os_version'] = os_version
+    values['os_distro'] = image_meta.get('org.openstack__1__os_distro', '')
+
+    deleted_at = payload.get('deleted_at')
+    if deleted_at and deleted_at != '':
+        # We only want to pre-populate the 'delete' if we know this is in
+        #     fact an exist event for a deleted instance. Otherwise, there
+        #     is a chance we may populate it for a previous period's exist.
+        values['deleted_at'] = utils.str_time_to_unix(deleted_at)
+    return values
+
+
+def _process_exists(raw, body):
+    values = _exists_values(raw, body)
+    if values is None:
         stacklog.warn("Ignoring exists without launched_at. RawData(%s)" % raw.id)
+        return
+
+    instance_id = values['instance']
+    launched_range = (values['launched_at'], values['launched_at'] + 1)
+    usage = STACKDB.get_instance_usage(instance=instance_id,
+                                       launched_at__range=launched_range)
+    if usage:
+        values['usage'] = usage
+
+    if 'deleted_at' in values:
+        delete = STACKDB.get_instance_delete(instance=instance_id,
+                                             launched_at__range=launched_range)
+        if delete:
+            values['delete'] = delete
+
+    exists = STACKDB.create_instance_exists(**values)
+    STACKDB.save(exists)
+
+
+def aggregate_exists_batch(raws):
+    """_process_exists() for a list of (raw, body) exists events, as
+    used by the worker for a batch. The usages and deletes for all of
+    them are looked up with a query each and the InstanceExists are
+    inserted together."""
+    values_list = []
+    for raw, body in raws:
+        values = _exists_values(raw, body)
+        if values is None:
+            stacklog.warn("Ignoring exists without launched_at. "
+                          "RawData(%s)" % raw.id)
+            continue
+        values_list.append(values)
+
+    launches = [(values['instance'], values['launched_at'])
+                for values in values_list]
+    usages = STACKDB.find_instance_usages_by_launch(launches)
+    deletes = STACKDB.find_instance_deletes_by_launch(
+        [(values['instance'], values['launched_at'])
+         for values in values_list if 'deleted_at' in values])
+
+    exists = []
+    for launch, values in zip(launches, values_list):
+        if usages[launch]:
+            values['usage'] = usages[launch]
+        if deletes.get(launch):
+            values['delete'] = deletes[launch]
+        exists.append(STACKDB.create_instance_exists(**values))
+    if exists:
+        STACKDB.create_instance_exists_batch(exists)
 
 
 USAGE_PROCESS_MAPPING = {
@@ -338,10 +482,64 @@ def process_raw_data(deployment, args, json_args):
         values = notification.rawdata_kwargs(deployment, routing_key, json_args)
         if not values:
             return record
+        if not _should_store(values):
+            return STACKDB.build_rawdata(**values)
         record = STACKDB.create_rawdata(**values)
     return record
 
 
+def _should_store(values):
+    return INGEST_POLICY is None or INGEST_POLICY.should_store(values)
+
+
+def process_raw_data_batch(deployment, messages):
+    """Batched version of process_raw_data() used by the worker.
+
+    messages is a list of (args, json_args) tuples. Returns a list
+    of RawData records in the same order, with None for any message
+    that didn't produce one or was already stored. Records for events
+    the ingest policy dropped aren't saved."""
+    db.reset_queries()
+
+    values_list = []
+    for args, json_args in messages:
+        routing_key, body = args
+        values = None
+        notification = NOTIFICATIONS[routing_key](body)
+        if notification:
+            values = notification.rawdata_kwargs(deployment, routing_key,
+                                                 json_args)
+        values_list.append(values or None)
+
+    # Drop any that were stored before (redelivered after a reconnect)
+    # in one go rather than having the unique index fail the batch.
+    message_ids = [values['message_id'] for values in values_list
+                   if values and values.get('message_id')]
+    if message_ids:
+        seen = STACKDB.find_stored_message_ids(message_ids)
+        for i, values in enumerate(values_list):
+            message_id = values and values.get('message_id')
+            if message_id in seen:
+                values_list[i] = None
+            elif message_id:
+                seen.add(message_id)
+
+    stored = [bool(values) and _should_store(values)
+              for values in values_list]
+
+    created = iter(STACKDB.create_rawdata_batch(
+        [values for values, store in zip(values_list, stored) if store]))
+    records = []
+    for values, store in zip(values_list, stored):
+        if store:
+            records.append(created.next())
+        elif values:
+            records.append(STACKDB.build_rawdata(**values))
+        else:
+            records.append(None)
+    return records
+
+
 def post_process(raw, body):
     aggregate_lifecycle(raw)
     aggregate_usage(raw, body)
@@ -393,7 +591,8 @@ def details(request, deployment_id, column, row_id):
     c = _default_context(request, deployment_id)
     row = models.RawData.objects.get(pk=row_id)
     value = getattr(row, column)
-    rows = models.RawData.objects.select_related()
+    # The rows only show the summary columns, so leave the json behind.
+    rows = models.RawData.objects.select_related().defer('json')
     if deployment_id:
         rows = rows.filter(deployment=deployment_id)
     if column != 'when':
@@ -417,7 +616,7 @@ def details(request, deployment_id, column, row_id):
 def expand(request, deployment_id, row_id):
     c = _default_context(request, deployment_id)
     row = models.RawData.objects.get(pk=row_id)
-    payload = json.loads(row.json)
+    payload = utils.load_raw_json(row)
     pp = pprint.PrettyPrinter()
     c['payload'] = pp.pformat(payload)
     return render_to_response('expand.html', c)
@@ -429,7 +628,8 @@ def latest_raw(request, deployment_id):
     c = _default_context(request, deployment_id)
     then = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
     thend = dt.dt_to_decimal(then)
-    query = models.RawData.objects.select_related().filter(when__gt=thend)
+    query = models.RawData.objects.select_related().defer('json')\
+                                  .filter(when__gt=thend)
     if deployment_id > 0:
         query = query.filter(deployment=deployment_id)
     rows = query.order_by('-when')[:20]
@@ -450,7 +650,7 @@ def search(request, deployment_id):
         updates = False
     rows = None
     if column != None and value != None:
-        rows = models.RawData.objects.select_related()
+        rows = models.RawData.objects.select_related().defer('json')
         if deployment_id and int(deployment_id) != 0:
             rows = rows.filter(deployment=deployment_id)
         rows = rows.filter(**{column: value})
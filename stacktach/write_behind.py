@@ -0,0 +1,70 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+import time
+
+from django.db import transaction
+
+from stacktach import db as stackdb
+
+STACKDB = stackdb
+
+
+class LifecycleWriteBehind(object):
+    """Holds on to Lifecycle updates and writes them out every interval
+    seconds, so an instance getting a burst of events only has its
+    Lifecycle row updated once.
+
+    New lifecycles are still saved straight away since their Timings
+    and RequestTrackers need the id."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        # instance -> latest state of its lifecycle
+        self.pending = collections.OrderedDict()
+        self.last_flush = time.time()
+        self.saves = 0
+        self.writes = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def save(self, lifecycle):
+        self.saves += 1
+        if lifecycle.id is None:
+            STACKDB.save(lifecycle)
+            self.writes += 1
+            return
+        self.pending[lifecycle.instance] = lifecycle
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        lifecycles = self.pending.values()
+        with transaction.commit_on_success():
+            STACKDB.update_lifecycles(lifecycles)
+        self.pending.clear()
+        self.writes += len(lifecycles)
@@ -0,0 +1,79 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""How much smaller RawData.json gets with the shared dictionary, and
+what it costs, against plain zlib. The notifications use a different
+seed from the ones the dictionary was trained on.
+
+    python -m tests.benchmarks.compression --count 20000"""
+
+import argparse
+import base64
+import json
+import timeit
+import zlib
+
+from stacktach import compression
+from tests.benchmarks import notifications
+
+
+def check(texts):
+    for text in texts:
+        if compression.decompress(compression.compress(text)) != text:
+            raise AssertionError("Round trip failed for %s" % text)
+
+
+def best_of(func, values, repeat):
+    return min(timeit.repeat(lambda: map(func, values), number=1,
+                             repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach Compression Benchmark')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    texts = [json.dumps(n) for n in
+             notifications.generate(args.count, seed=args.seed)]
+    check(texts)
+    compressed = map(compression.compress, texts)
+    zlibbed = [base64.b64encode(zlib.compress(text)) for text in texts]
+
+    raw_size = sum(map(len, texts))
+    print "%d notifications, identical results" % len(texts)
+    for name, values in [('json', texts), ('zlib + base64', zlibbed),
+                         ('dictionary + base64', compressed)]:
+        size = float(sum(map(len, values)))
+        print "%-25s %8.1f bytes/row %6.2fx" % (name, size / len(values),
+                                                 raw_size / size)
+
+    results = [
+        ('compress', best_of(compression.compress, texts, args.repeat)),
+        ('decompress', best_of(compression.decompress, compressed,
+                               args.repeat)),
+    ]
+    for name, seconds in results:
+        print "%-25s %8.2f us/call" % (name, seconds * 10 ** 6 / len(texts))
+
+
+if __name__ == '__main__':
+    main()
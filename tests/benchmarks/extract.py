@@ -0,0 +1,164 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Microbenchmark for the notification extractors against the
+Notification class they replaced, checking they agree first.
+
+    python -m tests.benchmarks.extract --count 20000"""
+
+import argparse
+import timeit
+
+from stacktach import image_type
+from stacktach import notification
+from stacktach import utils
+from tests.benchmarks import notifications
+
+
+class OldNotification(object):
+    def __init__(self, body):
+        self.body = body
+        self.request_id = body['_context_request_id']
+        self.payload = body.get('payload', {})
+        self.state = self.payload.get('state', "")
+        self.old_state = self.payload.get('old_state', "")
+        self.old_task = self.payload.get('old_task_state', "")
+        self.task = self.payload.get('new_task_state', "")
+        self.image_type = image_type.get_numeric_code(self.payload)
+        self.publisher = self.body['publisher_id']
+        self.event = self.body['event_type']
+        image_meta = self.payload.get('image_meta', {})
+        self.os_architecture = image_meta.get('org.openstack__1__architecture',
+                                              '')
+        self.os_distro = image_meta.get('org.openstack__1__os_distro', '')
+        self.os_version = image_meta.get('org.openstack__1__os_version', '')
+        self.rax_options = image_meta.get('com.rackspace__1__options', '')
+
+    @property
+    def when(self):
+        when = self.body.get('timestamp', None)
+        if not when:
+            when = self.body['_context_timestamp']
+        when = utils.str_time_to_unix(when)
+        return when
+
+    def rawdata_kwargs(self, deployment, routing_key, json):
+        return {
+            'deployment': deployment,
+            'routing_key': routing_key,
+            'event': self.event,
+            'publisher': self.publisher,
+            'json': json,
+            'state': self.state,
+            'old_state': self.old_state,
+            'task': self.task,
+            'old_task': self.old_task,
+            'image_type': self.image_type,
+            'when': self.when,
+            'publisher': self.publisher,
+            'service': self.service,
+            'host': self.host,
+            'instance': self.instance,
+            'request_id': self.request_id,
+            'tenant': self.tenant,
+            'os_architecture': self.os_architecture,
+            'os_distro': self.os_distro,
+            'os_version': self.os_version,
+            'rax_options': self.rax_options
+        }
+
+    @property
+    def instance(self):
+        instance = self.payload.get('instance_id', None)
+        instance = self.payload.get('instance_uuid', instance)
+        if not instance:
+            instance = self.payload.get('exception', {}).get('kwargs', {})\
+                                   .get('uuid')
+        if not instance:
+            instance = self.payload.get('instance', {}).get('uuid')
+        return instance
+
+    @property
+    def host(self):
+        host = None
+        parts = self.publisher.split('.')
+        if len(parts) > 1:
+            host = ".".join(parts[1:])
+        return host
+
+    @property
+    def service(self):
+        parts = self.publisher.split('.')
+        return parts[0]
+
+    @property
+    def tenant(self):
+        tenant = self.body.get('_context_project_id', None)
+        tenant = self.payload.get('tenant_id', tenant)
+        return tenant
+
+
+def check(bodies):
+    for body in bodies:
+        new = notification.Notification(body).rawdata_kwargs(1, 'rk', 'j')
+        # Stored since the old class was replaced.
+        new.pop('message_id')
+        old = OldNotification(body).rawdata_kwargs(1, 'rk', 'j')
+        if new != old:
+            raise AssertionError("%s != %s" % (new, old))
+
+
+def best_of(func, values, repeat):
+    return min(timeit.repeat(lambda: map(func, values), number=1,
+                             repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach Notification Benchmark')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = [body for routing_key, body in
+              notifications.generate(args.count)]
+    check(bodies)
+
+    results = [
+        ('rawdata_kwargs (old)',
+         best_of(lambda body: OldNotification(body).rawdata_kwargs(1, 'rk',
+                                                                   'j'),
+                 bodies, args.repeat)),
+        ('rawdata_kwargs',
+         best_of(lambda body: notification.Notification(body)
+                 .rawdata_kwargs(1, 'rk', 'j'), bodies, args.repeat)),
+        ('instance only (old)',
+         best_of(lambda body: OldNotification(body).instance, bodies,
+                 args.repeat)),
+        ('instance only',
+         best_of(lambda body: notification.Notification(body).instance,
+                 bodies, args.repeat)),
+    ]
+    print "%d notifications, identical results" % len(bodies)
+    for name, seconds in results:
+        print "%-25s %8.2f us/call" % (name, seconds * 10 ** 6 / len(bodies))
+
+
+if __name__ == '__main__':
+    main()
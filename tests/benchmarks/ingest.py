@@ -0,0 +1,183 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""End to end ingest benchmark.
+
+Publishes synthetic notifications to kombu's in-memory transport and
+has a NovaConsumer consume them into a freshly created test database,
+then reports throughput, per message latency and queries per message
+for each event type. Use the same settings as the integration tests:
+
+    STACKTACH_DB_ENGINE=django.db.backends.sqlite3 ... \\
+    DJANGO_SETTINGS_MODULE=tests.integration.settings \\
+    python -m tests.benchmarks.ingest --messages 10000 \\
+        --config '{"batch_size": 100, "lifecycle_cache_size": 10000}'
+
+--config takes the same settings as a deployment in the worker config.
+With sqlite the database is in memory; with MySQL a test_ database is
+created and dropped on the server in the settings."""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import kombu
+
+from django.db import connection
+from south.management.commands import patch_for_test_db_setup
+
+from stacktach import stacklog
+
+stacklog.set_default_logger_location("%s.log")
+
+from stacktach import db
+from stacktach import message_stats
+from tests.benchmarks import notifications
+import worker.worker as worker
+
+
+def percentile(values, percent):
+    """values must be sorted."""
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class BenchmarkConsumer(worker.NovaConsumer):
+    """Times every message, from being received to being stored and
+    aggregated, and stops once it has seen them all."""
+
+    def __init__(self, expected, *args, **kwargs):
+        super(BenchmarkConsumer, self).__init__(*args, **kwargs)
+        self.expected = expected
+        self.seen = 0
+        self.received = {}
+        self.latencies = []
+
+    def on_nova(self, body, message):
+        self.received[message.delivery_tag] = time.time()
+        super(BenchmarkConsumer, self).on_nova(body, message)
+        self.seen += 1
+        if self.seen >= self.expected:
+            self.should_stop = True
+
+    def _process(self, message):
+        super(BenchmarkConsumer, self)._process(message)
+        self._done([message])
+
+    def _process_batch(self):
+        messages = self.batch
+        super(BenchmarkConsumer, self)._process_batch()
+        self._done(messages)
+
+    def _done(self, messages):
+        now = time.time()
+        for message in messages:
+            received = self.received.pop(message.delivery_tag)
+            self.latencies.append(now - received)
+
+
+def publish(conn, consumer, messages):
+    channel = conn.channel()
+    for queue in consumer._nova_queues():
+        queue(channel).declare()
+    producer = kombu.Producer(channel, exchange=consumer._nova_queues()[0]
+                              .exchange, serializer='json')
+    for routing_key, body in messages:
+        producer.publish(body, routing_key=routing_key)
+    channel.close()
+
+
+def run(messages, config):
+    deployment, new = db.get_or_create_deployment(config['name'])
+    worker._setup_lifecycle_cache(config)
+    worker._setup_lifecycle_writer(config)
+    # Slow messages are logged, not reported, so only the histograms.
+    stats = message_stats.MessageStats(config['name'], 10 ** 9, 10 ** 9)
+
+    with kombu.Connection('memory://') as conn:
+        consumer = BenchmarkConsumer(len(messages), config['name'], conn,
+                                     deployment, False, {}, stats=stats,
+                                     **worker._consumer_kwargs(config))
+        publish(conn, consumer, messages)
+        start = time.time()
+        consumer.run()
+        elapsed = time.time() - start
+
+    if worker.views.LIFECYCLE_WRITER is not None:
+        worker.views.LIFECYCLE_WRITER.flush()
+    return elapsed, consumer.latencies, stats.histograms
+
+
+def report(elapsed, latencies, histograms):
+    latencies = sorted(latencies)
+    print "%d messages in %.2fs, %.1f messages/s" % \
+        (len(latencies), elapsed, len(latencies) / elapsed)
+    print "latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % tuple(
+        percentile(latencies, percent) * 1000
+        for percent in (50, 90, 99, 100))
+    print
+    print "%-40s %7s %9s %s" % ("event type", "count", "queries", "by stage")
+    for event_type in sorted(histograms):
+        by_stage = histograms[event_type]
+        count = max(h.count for h in by_stage.values())
+        queries = sum(h.queries for h in by_stage.values())
+        stages = ", ".join("%s %.1f" % (name, float(h.queries) / h.count)
+                           for name, h in sorted(by_stage.items()))
+        print "%-40s %7d %9.1f %s" % (event_type, count,
+                                      float(queries) / count, stages)
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach Ingest Benchmark')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--instances', type=int, default=100,
+                        help="Number of instances in flight at once.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', type=json.loads, default={},
+                        help="json worker config settings to use.")
+    args = parser.parse_args()
+
+    config = {'name': 'benchmark'}
+    config.update(args.config)
+    messages = notifications.generate(args.messages,
+                                      instances=args.instances,
+                                      seed=args.seed)
+
+    patch_for_test_db_setup()
+    # The data migrations print as they go.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+    finally:
+        sys.stdout = stdout
+    try:
+        report(*run(messages, config))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
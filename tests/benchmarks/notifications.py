@@ -0,0 +1,182 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Synthetic, but realistic looking, nova notifications for the
+benchmarks. Each instance goes through a create, a few updates, maybe
+a resize, an exists per audit period and maybe a delete, with the
+events of different instances interleaved."""
+
+import datetime
+import random
+import uuid
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+IMAGE_META = {
+    'org.openstack__1__architecture': 'x64',
+    'org.openstack__1__os_distro': 'org.ubuntu',
+    'org.openstack__1__os_version': '12.04',
+    'com.rackspace__1__options': '0',
+}
+
+
+def _format(when):
+    return when.strftime(TIME_FORMAT)
+
+
+class Instance(object):
+    def __init__(self, rand, now):
+        self.rand = rand
+        self.uuid = str(uuid.UUID(int=rand.getrandbits(128)))
+        self.tenant = str(rand.randint(1000, 9999))
+        self.host = 'compute-%d.example.com' % rand.randint(1, 200)
+        self.instance_type_id = str(rand.randint(1, 8))
+        self.now = now
+        self.launched_at = None
+        self.deleted_at = None
+        self.request_id = None
+
+    def _tick(self):
+        self.now += datetime.timedelta(seconds=self.rand.uniform(0.1, 30))
+        return self.now
+
+    def notification(self, event_type, service='compute', state='active',
+                     old_state='active', old_task='', new_task='',
+                     **payload):
+        when = self._tick()
+        body = {
+            'event_type': event_type,
+            'publisher_id': '%s.%s' % (service, self.host),
+            'timestamp': _format(when),
+            'message_id': str(uuid.UUID(int=self.rand.getrandbits(128))),
+            'priority': 'INFO',
+            '_context_request_id': self.request_id,
+            '_context_timestamp': _format(when),
+            'payload': {
+                'instance_id': self.uuid,
+                'tenant_id': self.tenant,
+                'instance_type_id': self.instance_type_id,
+                'state': state,
+                'old_state': old_state,
+                'old_task_state': old_task,
+                'new_task_state': new_task,
+                'launched_at': self.launched_at and
+                    _format(self.launched_at) or '',
+                'deleted_at': self.deleted_at and
+                    _format(self.deleted_at) or '',
+                'image_meta': IMAGE_META,
+            },
+        }
+        body['payload'].update(payload)
+        return ['monitor.info', body]
+
+    def _new_request(self):
+        self.request_id = 'req-%s' % uuid.UUID(int=self.rand.getrandbits(128))
+
+    def create(self):
+        self._new_request()
+        yield self.notification('compute.instance.update', service='api',
+                                state='building', old_state=None,
+                                new_task='scheduling')
+        yield self.notification('compute.instance.update',
+                                state='building', old_state='building',
+                                old_task='scheduling', new_task='spawning')
+        yield self.notification('compute.instance.create.start',
+                                state='building', old_state='building',
+                                old_task='spawning')
+        self.launched_at = self.now
+        yield self.notification('compute.instance.create.end',
+                                message='Success')
+
+    def update(self):
+        self._new_request()
+        yield self.notification('compute.instance.update', service='api')
+
+    def resize(self):
+        self._new_request()
+        new_type = str(self.rand.randint(1, 8))
+        yield self.notification('compute.instance.resize.prep.start',
+                                new_task='resize_prep')
+        yield self.notification('compute.instance.resize.prep.end',
+                                new_instance_type_id=new_type)
+        yield self.notification('compute.instance.resize.start',
+                                new_task='resize_migrating')
+        yield self.notification('compute.instance.resize.end')
+        self.instance_type_id = new_type
+        self.launched_at = self.now
+        yield self.notification('compute.instance.finish_resize.end')
+
+    def exists(self):
+        ending = self.now.replace(minute=0, second=0, microsecond=0)
+        beginning = ending - datetime.timedelta(days=1)
+        yield self.notification(
+            'compute.instance.exists',
+            audit_period_beginning=_format(beginning),
+            audit_period_ending=_format(ending))
+
+    def delete(self):
+        self._new_request()
+        yield self.notification('compute.instance.delete.start',
+                                new_task='deleting')
+        self.deleted_at = self.now
+        yield self.notification('compute.instance.delete.end',
+                                state='deleted', old_task='deleting')
+        yield self.notification(
+            'compute.instance.exists',
+            audit_period_beginning=_format(self.launched_at),
+            audit_period_ending=_format(self.deleted_at))
+
+    def events(self, resize_chance=0.2, delete_chance=0.3):
+        for event in self.create():
+            yield event
+        for i in range(self.rand.randint(0, 4)):
+            for event in self.update():
+                yield event
+        if self.rand.random() < resize_chance:
+            for event in self.resize():
+                yield event
+        for event in self.exists():
+            yield event
+        if self.rand.random() < delete_chance:
+            for event in self.delete():
+                yield event
+
+
+def generate(count, instances=100, seed=0, resize_chance=0.2,
+             delete_chance=0.3):
+    """Returns count [routing_key, body] pairs from up to instances
+    instances in flight at once."""
+    rand = random.Random(seed)
+    now = datetime.datetime(2013, 6, 1)
+
+    def new_instance():
+        instance = Instance(rand, now)
+        return instance.events(resize_chance=resize_chance,
+                               delete_chance=delete_chance)
+
+    active = [new_instance() for i in range(instances)]
+    notifications = []
+    while len(notifications) < count:
+        i = rand.randrange(len(active))
+        try:
+            notifications.append(active[i].next())
+        except StopIteration:
+            active[i] = new_instance()
+    return notifications
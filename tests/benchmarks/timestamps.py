@@ -0,0 +1,124 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Microbenchmark for utils.str_time_to_unix() and
+datetime_to_decimal.dt_to_decimal() against the strptime and Decimal
+arithmetic versions they replaced, checking the results are identical
+first.
+
+    python -m tests.benchmarks.timestamps --count 20000"""
+
+import argparse
+import calendar
+import datetime
+import decimal
+import random
+import timeit
+
+from stacktach import datetime_to_decimal as dt
+from stacktach import utils
+
+
+def old_dt_to_decimal(utc):
+    decimal.getcontext().prec = 30
+    return decimal.Decimal(str(calendar.timegm(utc.utctimetuple()))) + \
+           (decimal.Decimal(str(utc.microsecond)) /
+           decimal.Decimal("1000000.0"))
+
+
+def old_str_time_to_unix(when):
+    if 'T' in when:
+        try:
+            when = datetime.datetime.strptime(when, "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            when = datetime.datetime.strptime(when, "%Y-%m-%dT%H:%M:%S")
+    else:
+        try:
+            when = datetime.datetime.strptime(when, "%Y-%m-%d %H:%M:%S.%f")
+        except ValueError:
+            when = datetime.datetime.strptime(when, "%Y-%m-%d %H:%M:%S")
+    return old_dt_to_decimal(when)
+
+
+def timestamps(count, seed=0):
+    """Nova style timestamps, in all the formats we accept."""
+    rand = random.Random(seed)
+    start = datetime.datetime(2012, 1, 1)
+    formats = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f',
+               '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+    result = []
+    for i in range(count):
+        when = start + datetime.timedelta(seconds=rand.uniform(0, 10 ** 8))
+        if rand.random() < 0.1:
+            when = when.replace(microsecond=0)
+        result.append(when.strftime(rand.choice(formats)))
+    return result
+
+
+def check(values):
+    for value in values:
+        new = utils._str_time_to_unix(value)
+        old = old_str_time_to_unix(value)
+        if new.as_tuple() != old.as_tuple():
+            raise AssertionError("%s: %r != %r" % (value, new, old))
+
+
+def best_of(func, values, repeat):
+    return min(timeit.repeat(lambda: map(func, values), number=1,
+                             repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser('StackTach Timestamp Benchmark')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    values = timestamps(args.count)
+    check(values)
+    datetimes = [datetime.datetime.utcfromtimestamp(float(old))
+                 for old in map(old_str_time_to_unix, values)]
+
+    def cached(value):
+        return utils.str_time_to_unix(value)
+
+    # Each message has a handful of timestamps, mostly repeated.
+    repeated = [value for value in values[:args.count / 4]
+                for i in range(4)]
+
+    results = [
+        ('dt_to_decimal (old)', best_of(old_dt_to_decimal, datetimes,
+                                        args.repeat)),
+        ('dt_to_decimal', best_of(dt.dt_to_decimal, datetimes,
+                                  args.repeat)),
+        ('str_time_to_unix (old)', best_of(old_str_time_to_unix, values,
+                                           args.repeat)),
+        ('str_time_to_unix, uncached', best_of(utils._str_time_to_unix,
+                                               values, args.repeat)),
+        ('str_time_to_unix, 4 per message', best_of(cached, repeated,
+                                                    args.repeat)),
+    ]
+    print "%d timestamps, identical results" % len(values)
+    for name, seconds in results:
+        print "%-35s %8.2f us/call" % (name, seconds * 10 ** 6 / len(values))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+
+import mox
+
+from stacktach import backpressure
+from stacktach import stacklog
+
+
+class PrefetchControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.stackdb = backpressure.STACKDB
+        backpressure.STACKDB = self.mox.CreateMockAnything()
+        self.log = self.mox.CreateMockAnything()
+        self.mox.stubs.Set(stacklog, 'get_logger', lambda: self.log)
+        self.controller = backpressure.PrefetchController('test', 10, 40,
+                                                          0.1, 1)
+        self.controller.last_adjust = 100
+        self.mox.StubOutWithMock(backpressure.time, 'time')
+
+    def tearDown(self):
+        backpressure.STACKDB = self.stackdb
+        self.mox.UnsetStubs()
+
+    def test_record_smooths_latency(self):
+        controller = self.controller
+        self.mox.ReplayAll()
+        controller.record(0.5)
+        self.assertEqual(controller.latency, 0.5)
+        controller.record(1.5)
+        self.assertAlmostEqual(controller.latency, 0.8)
+        self.mox.VerifyAll()
+
+    def test_adjust_waits_for_interval(self):
+        controller = self.controller
+        backpressure.time.time().AndReturn(101)
+        backpressure.time.time().AndReturn(100.5)
+        self.mox.ReplayAll()
+        self.assertEqual(controller.adjust(), None)
+        controller.record(0.5)
+        self.assertEqual(controller.adjust(), None)
+        self.assertEqual(controller.prefetch, 40)
+        self.mox.VerifyAll()
+
+    def test_adjust_halves_and_grows_prefetch(self):
+        controller = self.controller
+        backpressure.time.time().AndReturn(101)
+        self.log.info("test: commit latency 500.0ms, prefetch 40 -> 20")
+        backpressure.time.time().AndReturn(102)
+        self.log.info("test: commit latency 500.0ms, prefetch 20 -> 10")
+        backpressure.time.time().AndReturn(103)
+        backpressure.time.time().AndReturn(104)
+        self.log.info("test: commit latency 50.0ms, prefetch 10 -> 20")
+        self.mox.ReplayAll()
+        controller.record(0.5)
+        self.assertEqual(controller.adjust(), 20)
+        self.assertEqual(controller.adjust(), 10)
+        self.assertEqual(controller.adjust(), None)
+        self.assertFalse(controller.paused)
+        controller.latency = 0.05
+        self.assertEqual(controller.adjust(), 20)
+        self.mox.VerifyAll()
+
+    def test_adjust_pauses_over_ceiling(self):
+        controller = self.controller
+        backpressure.time.time().AndReturn(101)
+        self.log.warn("test: commit latency 2000.0ms is over 1000.0ms, "
+                      "pausing")
+        self.log.info("test: commit latency 2000.0ms, prefetch 40 -> 20")
+        self.mox.ReplayAll()
+        controller.record(2)
+        self.assertEqual(controller.adjust(), 20)
+        self.assertTrue(controller.paused)
+        self.mox.VerifyAll()
+
+    def test_adjust_resumes_after_probes_under_target(self):
+        controller = self.controller
+        controller.paused = True
+        controller.prefetch = 20
+        controller.latency = 2
+        for i in range(5):
+            backpressure.time.time().AndReturn(101 + i)
+            if i == 0:
+                self.log.info("test: commit latency 2000.0ms, "
+                              "prefetch 20 -> 10")
+        self.log.info("test: database probes 50.0ms have been under "
+                      "100.0ms for 3 intervals, resuming")
+        self.mox.ReplayAll()
+        # Under the ceiling but not the target isn't enough.
+        controller.probe_latency = 0.5
+        self.assertEqual(controller.adjust(), 10)
+        self.assertEqual(controller.recovered, 0)
+        controller.probe_latency = 0.05
+        self.assertEqual(controller.adjust(), None)
+        self.assertEqual(controller.adjust(), None)
+        self.assertTrue(controller.paused)
+        # Wherever the prefetch had got to, it starts again from minimum.
+        controller.prefetch = 40
+        self.assertEqual(controller.adjust(), 10)
+        self.assertFalse(controller.paused)
+        self.assertEqual(controller.latency, None)
+        # Nothing more until there are commits to go on.
+        self.assertEqual(controller.adjust(), None)
+        self.mox.VerifyAll()
+
+    def test_probe(self):
+        controller = self.controller
+        backpressure.time.time().AndReturn(200)
+        backpressure.STACKDB.ping()
+        backpressure.time.time().AndReturn(200.25)
+        self.mox.ReplayAll()
+        controller.probe()
+        self.assertEqual(controller.probe_latency, 0.25)
+        self.assertEqual(controller.latency, None)
+        self.mox.VerifyAll()
+
+    def test_probe_failure_counts_as_over_ceiling(self):
+        controller = self.controller
+        backpressure.time.time().AndReturn(200)
+        backpressure.STACKDB.ping().AndRaise(Exception("gone away"))
+        self.log.warn("test: database probe failed: gone away")
+        backpressure.STACKDB.close_connection()
+        backpressure.time.time().AndReturn(200.25)
+        self.mox.ReplayAll()
+        controller.probe()
+        self.assertEqual(controller.probe_latency, 2)
+        self.mox.VerifyAll()
@@ -0,0 +1,45 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+
+from stacktach import views
+from tests.benchmarks import notifications
+
+
+class GenerateTestCase(unittest.TestCase):
+    def test_generate(self):
+        messages = notifications.generate(500, instances=10, seed=1)
+        self.assertEqual(len(messages), 500)
+        self.assertEqual(messages, notifications.generate(500, instances=10,
+                                                          seed=1))
+
+        event_types = set()
+        for routing_key, body in messages:
+            notification = views.NOTIFICATIONS[routing_key](body)
+            self.assertTrue(notification.instance)
+            self.assertTrue(notification.when)
+            event_types.add(notification.event)
+        for event_type in ['compute.instance.create.end',
+                           'compute.instance.delete.end',
+                           'compute.instance.exists',
+                           'compute.instance.finish_resize.end',
+                           'compute.instance.update']:
+            self.assertTrue(event_type in event_types)
@@ -0,0 +1,76 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import unittest
+
+from stacktach import compression
+
+
+NOTIFICATION = json.dumps(['monitor.info', {
+    'event_type': 'compute.instance.update',
+    'publisher_id': 'compute.compute-1.example.com',
+    'payload': {'state': 'active', 'old_state': 'building',
+                'display_name': u'caf\xe9'}}])
+
+
+class CompressionTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        compressed = compression.compress(NOTIFICATION)
+        self.assertTrue(compressed.startswith('z1:'))
+        self.assertTrue(compression.is_compressed(compressed))
+        self.assertEqual(compression.decompress(compressed), NOTIFICATION)
+
+    def test_round_trip_unicode(self):
+        text = u'{"display_name": "caf\xe9"}'
+        compressed = compression.compress(text)
+        self.assertEqual(compression.decompress(compressed).decode('utf-8'),
+                         text)
+
+    def test_dictionary_makes_it_smaller(self):
+        import base64
+        import zlib
+        plain = base64.b64encode(zlib.compress(NOTIFICATION))
+        self.assertTrue(len(compression.compress(NOTIFICATION)) < len(plain))
+
+    def test_plain_json_untouched(self):
+        self.assertFalse(compression.is_compressed(NOTIFICATION))
+        self.assertEqual(compression.decompress(NOTIFICATION), NOTIFICATION)
+        self.assertEqual(compression.decompress('{"a": 1}'), '{"a": 1}')
+
+    def test_unknown_version(self):
+        self.assertRaises(compression.CompressionException,
+                          compression.compress, NOTIFICATION, version=999)
+        self.assertRaises(compression.CompressionException,
+                          compression.decompress, 'z999:AAAA')
+
+    def test_train(self):
+        samples = ['{"state": "active", "host": "%d"}' % i
+                   for i in range(10)]
+        dictionary = compression.train(samples)
+        self.assertTrue('"state": "active", ' in dictionary)
+        self.assertTrue('"host": ' in dictionary)
+        # Fragments seen in only one sample are left out.
+        self.assertFalse('"3"' in dictionary)
+
+    def test_train_size(self):
+        samples = ['{"a": "%s", "b": "x"}' % ('y' * 50)] * 3
+        dictionary = compression.train(samples, size=20)
+        self.assertTrue(len(dictionary) <= 20)
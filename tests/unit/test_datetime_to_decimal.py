@@ -18,6 +18,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import calendar
 import datetime
 import decimal
 import unittest
@@ -37,3 +38,26 @@ class DatetimeToDecimalTestCase(unittest.TestCase):
         expected_datetime = datetime.datetime.utcfromtimestamp(expected_decimal)
         actual_datetime = datetime_to_decimal.dt_from_decimal(expected_decimal)
         self.assertEqual(actual_datetime, expected_datetime)
+
+    def _old_dt_to_decimal(self, utc):
+        decimal.getcontext().prec = 30
+        return decimal.Decimal(str(calendar.timegm(utc.utctimetuple()))) + \
+            (decimal.Decimal(str(utc.microsecond)) /
+             decimal.Decimal("1000000.0"))
+
+    def test_datetime_to_decimal_identical_to_arithmetic(self):
+        class UTCPlusOne(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=1)
+
+        for utc in [datetime.datetime(2013, 6, 1, 10, 11, 12),
+                    datetime.datetime(2013, 6, 1, 10, 11, 12, 500000),
+                    datetime.datetime(2013, 6, 1, 10, 11, 12, 123456),
+                    datetime.datetime(2013, 6, 1, 10, 11, 12, 1),
+                    datetime.datetime(1970, 1, 1),
+                    datetime.datetime(1969, 12, 31, 23, 59, 59, 500000),
+                    datetime.datetime(2013, 6, 1, 10, 11, 12, 250000,
+                                      tzinfo=UTCPlusOne())]:
+            actual = datetime_to_decimal.dt_to_decimal(utc)
+            expected = self._old_dt_to_decimal(utc)
+            self.assertEqual(actual.as_tuple(), expected.as_tuple())
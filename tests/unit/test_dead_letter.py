@@ -0,0 +1,194 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import unittest
+
+import mox
+
+from stacktach import dead_letter
+from stacktach import spool
+from tests.unit.utils import MESSAGE_ID_1
+
+BODY = json.dumps({'message_id': MESSAGE_ID_1,
+                   'event_type': 'compute.instance.exists'})
+
+
+class DeadLettersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.stackdb = dead_letter.STACKDB
+        dead_letter.STACKDB = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(dead_letter.transaction,
+                                 'commit_on_success')
+        self.mox.StubOutWithMock(dead_letter.transaction,
+                                 'rollback_unless_managed')
+        self.mox.StubOutWithMock(dead_letter.time, 'sleep')
+        self.mox.StubOutWithMock(dead_letter.stacklog, 'warn')
+        self.mox.StubOutWithMock(dead_letter.stacklog, 'error')
+        self.deployment = self.mox.CreateMockAnything()
+        self.dead_letters = dead_letter.DeadLetters(self.deployment,
+                                                    attempts=3,
+                                                    retry_delay=2)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        dead_letter.STACKDB = self.stackdb
+
+    def _expect_park(self, attempts, raw=None, message_id=MESSAGE_ID_1,
+                     event='compute.instance.exists', body=BODY):
+        commit = self.mox.CreateMockAnything()
+        dead_letter.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        parked = self.mox.CreateMockAnything()
+        parked.id = 7
+        dead_letter.STACKDB.create_dead_letter(
+            deployment=self.deployment, routing_key='monitor.info',
+            message_id=message_id, event=event, json=body, raw=raw,
+            error=mox.StrContains('ValueError: bad'), attempts=attempts,
+            parked=mox.IgnoreArg()).AndReturn(parked)
+        commit.__exit__(None, None, None).AndReturn(None)
+        dead_letter.stacklog.error(mox.StrContains('dead letter 7'))
+        return parked
+
+    def _failing(self, failures):
+        calls = []
+
+        def process(message):
+            calls.append(message)
+            if len(calls) <= failures:
+                raise ValueError('bad')
+        return process, calls
+
+    def test_attempt_succeeds(self):
+        message = spool.SpooledMessage('monitor.info', BODY)
+        process, calls = self._failing(0)
+        self.mox.ReplayAll()
+        self.assertFalse(self.dead_letters.attempt(process, message,
+                                                   'monitor.info'))
+        self.assertEqual(calls, [message])
+        self.assertEqual(self.dead_letters.parked, 0)
+        self.mox.VerifyAll()
+
+    def test_attempt_retries(self):
+        message = spool.SpooledMessage('monitor.info', BODY)
+        process, calls = self._failing(2)
+        for i in range(2):
+            dead_letter.transaction.rollback_unless_managed()
+            dead_letter.stacklog.warn(mox.StrContains('Attempt %d of 3'
+                                                      % (i + 1)))
+            dead_letter.time.sleep(2)
+        self.mox.ReplayAll()
+        self.assertFalse(self.dead_letters.attempt(process, message,
+                                                   'monitor.info'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.dead_letters.parked, 0)
+        self.mox.VerifyAll()
+
+    def test_attempt_parks_message(self):
+        message = spool.SpooledMessage('monitor.info', BODY)
+        process, calls = self._failing(3)
+        for i in range(2):
+            dead_letter.transaction.rollback_unless_managed()
+            dead_letter.stacklog.warn(mox.IgnoreArg())
+            dead_letter.time.sleep(2)
+        dead_letter.transaction.rollback_unless_managed()
+        self._expect_park(3)
+        self.mox.ReplayAll()
+        self.assertTrue(self.dead_letters.attempt(process, message,
+                                                  'monitor.info'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.dead_letters.parked, 1)
+        self.mox.VerifyAll()
+
+    def test_attempt_raises_once_acked(self):
+        message = spool.SpooledMessage('monitor.info', BODY)
+
+        def process(message):
+            message.ack()
+            raise ValueError('bad')
+        self.mox.ReplayAll()
+        self.assertRaises(ValueError, self.dead_letters.attempt, process,
+                          message, 'monitor.info')
+        self.assertEqual(self.dead_letters.parked, 0)
+        self.mox.VerifyAll()
+
+    def test_attempt_raises_infrastructure_error(self):
+        message = spool.SpooledMessage('monitor.info', BODY)
+
+        def process(message):
+            raise dead_letter.db_utils.DatabaseError('database is locked')
+        dead_letter.transaction.rollback_unless_managed()
+        self.mox.ReplayAll()
+        self.assertRaises(dead_letter.db_utils.DatabaseError,
+                          self.dead_letters.attempt, process, message,
+                          'monitor.info')
+        self.assertEqual(self.dead_letters.parked, 0)
+        self.mox.VerifyAll()
+
+    def test_is_infrastructure_error(self):
+        class OperationalError(Exception):
+            pass
+
+        class InterfaceError(Exception):
+            pass
+
+        database = self.mox.CreateMockAnything()
+        database.OperationalError = OperationalError
+        database.InterfaceError = InterfaceError
+        self.mox.stubs.Set(dead_letter, '_database_module', lambda: database)
+        self.assertTrue(dead_letter.is_infrastructure_error(
+            dead_letter.pipeline.PipelineException('died')))
+        self.assertTrue(dead_letter.is_infrastructure_error(
+            OperationalError('Lock wait timeout exceeded')))
+        self.assertTrue(dead_letter.is_infrastructure_error(
+            InterfaceError('closed')))
+        self.assertTrue(dead_letter.is_infrastructure_error(
+            dead_letter.db_utils.DatabaseError('deadlock detected')))
+        self.assertFalse(dead_letter.is_infrastructure_error(
+            dead_letter.db_utils.IntegrityError('duplicate key')))
+        self.assertFalse(dead_letter.is_infrastructure_error(
+            ValueError('bad')))
+        self.assertFalse(dead_letter.is_infrastructure_error(
+            KeyError('state')))
+
+    def test_park_stored_raw(self):
+        raw = self.mox.CreateMockAnything()
+        raw.id = 1
+        self._expect_park(1, raw=raw)
+        self.mox.ReplayAll()
+        self.dead_letters.park('monitor.info', BODY, 'ValueError: bad', 1,
+                               raw=raw)
+        self.mox.VerifyAll()
+
+    def test_park_unsaved_raw(self):
+        raw = self.mox.CreateMockAnything()
+        raw.id = None
+        self._expect_park(1)
+        self.mox.ReplayAll()
+        self.dead_letters.park('monitor.info', BODY, 'ValueError: bad', 1,
+                               raw=raw)
+        self.mox.VerifyAll()
+
+    def test_park_undecodable_body(self):
+        self._expect_park(1, message_id=None, event=None, body='{"bad')
+        self.mox.ReplayAll()
+        self.dead_letters.park('monitor.info', '{"bad', 'ValueError: bad', 1)
+        self.mox.VerifyAll()
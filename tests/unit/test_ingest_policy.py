@@ -0,0 +1,132 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import decimal
+import unittest
+
+import mox
+
+from stacktach import ingest_policy
+
+UPDATE = 'compute.instance.update'
+WHEN = decimal.Decimal('1360000000.5')
+PERIOD_START = decimal.Decimal('1359997200')
+
+
+def _values(state='active', old_state='active', task=None, old_task=None,
+            event=UPDATE, when=WHEN):
+    return {'event': event, 'when': when, 'state': state,
+            'old_state': old_state, 'task': task, 'old_task': old_task}
+
+
+class IngestPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        ingest_policy.STACKDB = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(ingest_policy.transaction,
+                                 'commit_on_success')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_parse_policy(self):
+        self.assertEqual(ingest_policy.parse_policy('all'), ('all', None))
+        self.assertEqual(ingest_policy.parse_policy('count'),
+                         ('count', None))
+        self.assertEqual(ingest_policy.parse_policy('transitions'),
+                         ('transitions', None))
+        self.assertEqual(ingest_policy.parse_policy('sample:10'),
+                         ('sample', 10))
+
+    def test_parse_policy_bad(self):
+        for policy in ['sample', 'sample:0', 'sample:x', 'some']:
+            self.assertRaises(ingest_policy.IngestPolicyException,
+                              ingest_policy.parse_policy, policy)
+
+    def test_events_without_policy_are_stored(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'count'})
+        values = _values(event='compute.instance.exists')
+        self.assertTrue(policy.should_store(values))
+        self.assertEqual(policy.counts, {})
+
+    def test_events_needing_raws_are_refused(self):
+        self.mox.StubOutWithMock(ingest_policy.stacklog, 'warn')
+        ingest_policy.stacklog.warn(mox.IsA(str))
+        ingest_policy.stacklog.warn(mox.IsA(str))
+        self.mox.ReplayAll()
+        policy = ingest_policy.IngestPolicy('dep', {
+            'compute.instance.create.start': 'count',
+            'compute.instance.exists': 'sample:2',
+            'compute.instance.delete.end': 'all',
+            UPDATE: 'count'})
+        self.assertEqual(policy.policies,
+                         {'compute.instance.delete.end': ('all', None),
+                          UPDATE: ('count', None)})
+        self.mox.VerifyAll()
+
+    def test_sample(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'sample:3'})
+        stored = [policy.should_store(_values()) for i in range(7)]
+        self.assertEqual(stored, [True, False, False, True, False, False,
+                                  True])
+        self.assertEqual(policy.counts, {(UPDATE, PERIOD_START): [7, 3]})
+
+    def test_transitions(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'transitions'})
+        self.assertFalse(policy.should_store(_values()))
+        self.assertTrue(policy.should_store(_values(old_state='building')))
+        self.assertTrue(policy.should_store(_values(task='deleting')))
+        self.assertFalse(policy.should_store(_values(task='spawning',
+                                                     old_task='spawning')))
+        self.assertEqual(policy.counts, {(UPDATE, PERIOD_START): [4, 2]})
+
+    def test_count_only(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'count'})
+        self.assertFalse(policy.should_store(_values()))
+        self.assertFalse(policy.should_store(_values(when=WHEN + 3600)))
+        self.assertEqual(policy.counts,
+                         {(UPDATE, PERIOD_START): [1, 0],
+                          (UPDATE, PERIOD_START + 3600): [1, 0]})
+
+    def test_flush(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'count'})
+        commit = self.mox.CreateMockAnything()
+        ingest_policy.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        ingest_policy.STACKDB.increment_ingest_count('dep', UPDATE,
+                                                     PERIOD_START, 2, 0)
+        commit.__exit__(None, None, None).AndReturn(None)
+        self.mox.ReplayAll()
+        policy.should_store(_values())
+        policy.should_store(_values())
+        policy.flush()
+        self.assertEqual(policy.counts, {})
+        policy.flush()
+        self.mox.VerifyAll()
+
+    def test_maybe_flush_waits_for_interval(self):
+        policy = ingest_policy.IngestPolicy('dep', {UPDATE: 'count'}, 60)
+        self.mox.StubOutWithMock(ingest_policy.time, 'time')
+        ingest_policy.time.time().AndReturn(policy.last_flush + 1)
+        self.mox.ReplayAll()
+        policy.should_store(_values())
+        policy.maybe_flush()
+        self.assertEqual(len(policy.counts), 1)
+        self.mox.VerifyAll()
@@ -0,0 +1,273 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import datetime
+import unittest
+
+import mox
+
+import utils
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from stacktach import lifecycle_cache
+from stacktach import stacklog
+from stacktach import views
+
+
+class LifecycleCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        lifecycle_cache.STACKDB = self.mox.CreateMockAnything()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _create_lifecycle(self, instance, id=1):
+        last_raw = utils.create_raw(self.mox, 100 + id,
+                                    'compute.instance.update', id=id)
+        lifecycle = utils.create_lifecycle(self.mox, instance, 'active', '',
+                                           last_raw)
+        lifecycle.id = id
+        lifecycle.last_raw_id = id
+        return lifecycle
+
+    def test_get_and_add(self):
+        cache = lifecycle_cache.LifecycleCache(10)
+        lifecycle = self._create_lifecycle(INSTANCE_ID_1)
+        self.assertEqual(cache.get(INSTANCE_ID_1), None)
+        cache.add(lifecycle)
+        self.assertEqual(cache.get(INSTANCE_ID_1), lifecycle)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_add_evicts_least_recently_used(self):
+        cache = lifecycle_cache.LifecycleCache(2)
+        lifecycle1 = self._create_lifecycle('instance1')
+        lifecycle2 = self._create_lifecycle('instance2')
+        lifecycle3 = self._create_lifecycle('instance3')
+        cache.add(lifecycle1)
+        cache.add(lifecycle2)
+        cache.get('instance1')
+        cache.add(lifecycle3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('instance1'), lifecycle1)
+        self.assertEqual(cache.get('instance2'), None)
+        self.assertEqual(cache.get('instance3'), lifecycle3)
+
+    def test_open_timings(self):
+        cache = lifecycle_cache.LifecycleCache(10)
+        lifecycle = self._create_lifecycle(INSTANCE_ID_1)
+        cache.add(lifecycle)
+        self.assertEqual(cache.get_open_timings(lifecycle), None)
+
+        name = 'compute.instance.create'
+        timing1 = utils.create_timing(self.mox, name, lifecycle)
+        timing2 = utils.create_timing(self.mox, name, lifecycle)
+        cache.set_open_timings(lifecycle, [timing1])
+        cache.add_open_timing(timing2)
+        self.assertEqual(cache.get_open_timings(lifecycle),
+                         {name: [timing1, timing2]})
+        cache.remove_open_timing(timing1)
+        self.assertEqual(cache.get_open_timings(lifecycle), {name: [timing2]})
+
+    def test_add_open_timing_unknown_timings(self):
+        cache = lifecycle_cache.LifecycleCache(10)
+        lifecycle = self._create_lifecycle(INSTANCE_ID_1)
+        cache.add(lifecycle)
+        timing = utils.create_timing(self.mox, 'compute.instance.create',
+                                     lifecycle)
+        cache.add_open_timing(timing)
+        self.assertEqual(cache.get_open_timings(lifecycle), None)
+
+    def test_warm(self):
+        cache = lifecycle_cache.LifecycleCache(10)
+        lifecycle1 = self._create_lifecycle(INSTANCE_ID_1, id=1)
+        lifecycle2 = self._create_lifecycle(INSTANCE_ID_2, id=2)
+        duplicate = self._create_lifecycle(INSTANCE_ID_1, id=3)
+        lifecycle_cache.STACKDB.find_recent_lifecycles(100, 10)\
+                               .AndReturn([duplicate, lifecycle2, lifecycle1])
+        timing = utils.create_timing(self.mox, 'compute.instance.create',
+                                     None)
+        timing.lifecycle_id = 1
+        lifecycle_cache.STACKDB.find_open_timings(mox.SameElementsAs([1, 2]))\
+                               .AndReturn([timing])
+        log = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(stacklog, 'get_logger')
+        stacklog.get_logger().AndReturn(log)
+        log.info(mox.IgnoreArg())
+        self.mox.ReplayAll()
+        cache.warm(100)
+        self.assertEqual(cache.get(INSTANCE_ID_1), lifecycle1)
+        self.assertEqual(cache.get(INSTANCE_ID_2), lifecycle2)
+        self.assertEqual(timing.lifecycle, lifecycle1)
+        self.assertEqual(cache.get_open_timings(lifecycle1),
+                         {'compute.instance.create': [timing]})
+        self.assertEqual(cache.get_open_timings(lifecycle2), {})
+        # Only the raws' ids are kept, and the last one's when.
+        self.assertEqual(lifecycle1.last_raw, None)
+        self.assertEqual(lifecycle1.last_raw_id, 1)
+        self.assertEqual(timing.start_raw, None)
+        self.assertEqual(cache.get_last_when(lifecycle1), 101)
+        self.mox.VerifyAll()
+
+    def test_warm_include(self):
+        cache = lifecycle_cache.LifecycleCache(10)
+        lifecycle1 = self._create_lifecycle(INSTANCE_ID_1, id=1)
+        lifecycle2 = self._create_lifecycle(INSTANCE_ID_2, id=2)
+        lifecycle_cache.STACKDB.find_recent_lifecycles(100, 10)\
+                               .AndReturn([lifecycle1, lifecycle2])
+        lifecycle_cache.STACKDB.find_open_timings([2]).AndReturn([])
+        log = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(stacklog, 'get_logger')
+        stacklog.get_logger().AndReturn(log)
+        log.info(mox.IgnoreArg())
+        self.mox.ReplayAll()
+        cache.warm(100, include=lambda instance: instance == INSTANCE_ID_2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(INSTANCE_ID_2), lifecycle2)
+        self.mox.VerifyAll()
+
+
+class CachedAggregateLifecycleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        views.STACKDB = self.mox.CreateMockAnything()
+        views.LIFECYCLE_CACHE = lifecycle_cache.LifecycleCache(10)
+
+    def tearDown(self):
+        views.LIFECYCLE_CACHE = None
+        self.mox.UnsetStubs()
+
+    def test_new_lifecycle_start_and_end(self):
+        event_name = 'compute.instance.create'
+        start_when = utils.decimal_utc()
+        end_when = start_when + 10
+        start_raw = utils.create_raw(self.mox, start_when,
+                                     '%s.start' % event_name)
+        end_raw = utils.create_raw(self.mox, end_when, '%s.end' % event_name)
+
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([])
+        lifecycle = self.mox.CreateMockAnything()
+        lifecycle.instance = INSTANCE_ID_1
+        lifecycle.id = None
+        lifecycle.last_raw = None
+        views.STACKDB.create_lifecycle(instance=INSTANCE_ID_1)\
+                     .AndReturn(lifecycle)
+        views.STACKDB.save(lifecycle).WithSideEffects(
+            lambda lifecycle: setattr(lifecycle, 'id', 1))
+        timing = utils.create_timing(self.mox, event_name, lifecycle)
+        views.STACKDB.create_timing(lifecycle=lifecycle, name=event_name)\
+                     .AndReturn(timing)
+        views.STACKDB.save(timing)
+
+        # No lookups at all for the .end
+        views.STACKDB.save(lifecycle)
+        self.mox.StubOutWithMock(views, "update_kpi")
+        views.update_kpi(timing, end_raw)
+        views.STACKDB.save(timing)
+        self.mox.ReplayAll()
+
+        views.aggregate_lifecycle(start_raw)
+        views.aggregate_lifecycle(end_raw)
+        self.assertEqual(timing.end_raw, end_raw)
+        self.assertEqual(timing.diff, 10)
+        self.assertEqual(views.LIFECYCLE_CACHE.get_open_timings(lifecycle),
+                         {event_name: []})
+        self.mox.VerifyAll()
+
+    def test_failed_save_is_not_cached(self):
+        raw = utils.create_raw(self.mox, utils.decimal_utc(),
+                               'compute.instance.update')
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([])
+        lifecycle = self.mox.CreateMockAnything()
+        lifecycle.instance = INSTANCE_ID_1
+        lifecycle.id = None
+        lifecycle.last_raw = None
+        views.STACKDB.create_lifecycle(instance=INSTANCE_ID_1)\
+                     .AndReturn(lifecycle)
+        views.STACKDB.save(lifecycle).AndRaise(Exception('deadlock'))
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, views.aggregate_lifecycle, raw)
+        self.assertEqual(len(views.LIFECYCLE_CACHE), 0)
+        self.mox.VerifyAll()
+
+    def test_failure_discards_cached_lifecycle(self):
+        raw = utils.create_raw(self.mox, utils.decimal_utc(),
+                               'compute.instance.resize.start')
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1, 'active',
+                                           '', None)
+        lifecycle.last_raw_id = None
+        views.LIFECYCLE_CACHE.add(lifecycle, {})
+        views.STACKDB.save(lifecycle)
+        timing = utils.create_timing(self.mox, 'compute.instance.resize',
+                                     lifecycle)
+        views.STACKDB.create_timing(lifecycle=lifecycle,
+                                    name='compute.instance.resize')\
+                     .AndReturn(timing)
+        views.STACKDB.save(timing).AndRaise(Exception('deadlock'))
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, views.aggregate_lifecycle, raw)
+        self.assertEqual(views.LIFECYCLE_CACHE.get(INSTANCE_ID_1), None)
+        self.mox.VerifyAll()
+
+    def test_cached_lifecycle_keeps_only_raw_id(self):
+        when = utils.decimal_utc()
+        raw = utils.create_raw(self.mox, when, 'compute.instance.update',
+                               id=7)
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1, 'active',
+                                           '', None)
+        lifecycle.last_raw_id = None
+        views.LIFECYCLE_CACHE.add(lifecycle, {})
+        views.STACKDB.save(lifecycle)
+        self.mox.StubOutWithMock(views, "start_kpi_tracking")
+        views.start_kpi_tracking(lifecycle, raw)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(raw)
+        self.assertEqual(lifecycle.last_raw, None)
+        self.assertEqual(lifecycle.last_raw_id, 7)
+        self.assertEqual(views.LIFECYCLE_CACHE.get_last_when(lifecycle), when)
+        self.mox.VerifyAll()
+
+    def test_existing_lifecycle_loads_open_timings_once(self):
+        event_name = 'compute.instance.resize'
+        when = utils.decimal_utc()
+        end_raw = utils.create_raw(self.mox, when, '%s.end' % event_name)
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1, 'active',
+                                           '', None)
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1)\
+                     .AndReturn([lifecycle])
+        views.STACKDB.save(lifecycle)
+        views.STACKDB.find_timings(lifecycle=lifecycle, end_raw__isnull=True)\
+                     .AndReturn([])
+        timing = utils.create_timing(self.mox, event_name, lifecycle)
+        views.STACKDB.create_timing(lifecycle=lifecycle, name=event_name)\
+                     .AndReturn(timing)
+        views.STACKDB.save(timing)
+
+        views.STACKDB.save(lifecycle)
+        timing2 = utils.create_timing(self.mox, event_name, lifecycle)
+        views.STACKDB.create_timing(lifecycle=lifecycle, name=event_name)\
+                     .AndReturn(timing2)
+        views.STACKDB.save(timing2)
+        self.mox.ReplayAll()
+
+        views.aggregate_lifecycle(end_raw)
+        views.aggregate_lifecycle(end_raw)
+        self.mox.VerifyAll()
@@ -0,0 +1,55 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+
+from stacktach import message_dedup
+
+
+class MessageDedupTestCase(unittest.TestCase):
+    def test_is_duplicate(self):
+        dedup = message_dedup.MessageDedup(10)
+        self.assertFalse(dedup.is_duplicate('message-1'))
+        dedup.add('message-1')
+        self.assertTrue(dedup.is_duplicate('message-1'))
+        self.assertFalse(dedup.is_duplicate('message-2'))
+        self.assertEqual(dedup.duplicates, 1)
+
+    def test_no_message_id(self):
+        dedup = message_dedup.MessageDedup(10)
+        dedup.add(None)
+        self.assertFalse(dedup.is_duplicate(None))
+        self.assertEqual(len(dedup), 0)
+
+    def test_evicts_oldest(self):
+        dedup = message_dedup.MessageDedup(2)
+        dedup.add('message-1')
+        dedup.add('message-2')
+        dedup.add('message-1')
+        dedup.add('message-3')
+        self.assertEqual(len(dedup), 2)
+        self.assertTrue(dedup.is_duplicate('message-1'))
+        self.assertFalse(dedup.is_duplicate('message-2'))
+        self.assertTrue(dedup.is_duplicate('message-3'))
+
+    def test_size_zero_remembers_nothing(self):
+        dedup = message_dedup.MessageDedup(0)
+        dedup.add('message-1')
+        self.assertFalse(dedup.is_duplicate('message-1'))
@@ -0,0 +1,154 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import threading
+import unittest
+
+from django.db import connection
+import mox
+
+from utils import INSTANCE_ID_1
+from stacktach import message_stats
+from stacktach import stacklog
+
+
+class StageHistogramTestCase(unittest.TestCase):
+    def test_add_and_percentile(self):
+        histogram = message_stats.StageHistogram()
+        for ms in [0.5, 3, 3, 4, 40, 40, 40, 40, 40, 7000]:
+            histogram.add(ms / 1000.0, 2)
+        self.assertEqual(histogram.count, 10)
+        self.assertEqual(histogram.queries, 20)
+        self.assertEqual(histogram.max_seconds, 7)
+        self.assertEqual(histogram.percentile(10), 1)
+        self.assertEqual(histogram.percentile(40), 5)
+        self.assertEqual(histogram.percentile(90), 50)
+        self.assertEqual(histogram.percentile(99), None)
+
+    def test_summary(self):
+        histogram = message_stats.StageHistogram()
+        histogram.add(0.004, 3)
+        self.assertEqual(histogram.summary(),
+                         "n=1 mean=4.0ms p50<=5ms p90<=5ms p99<=5ms "
+                         "max=4.0ms queries/msg=3.0")
+
+
+class MessageStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(message_stats, 'connection')
+        self.stats = message_stats.MessageStats('test', 60, 0.1)
+        self.mox.StubOutWithMock(message_stats.time, 'time')
+        self.mox.StubOutWithMock(message_stats, 'reset_queries')
+        self.mox.StubOutWithMock(stacklog, 'get_logger')
+        message_stats.connection.queries = []
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_stage(self):
+        stages = []
+        message_stats.reset_queries()
+        message_stats.time.time().AndReturn(100)
+        message_stats.time.time().AndReturn(100.25)
+        self.mox.ReplayAll()
+        with self.stats.stage('parse', stages):
+            message_stats.connection.queries.extend(['q1', 'q2'])
+        self.assertEqual(stages, [('parse', 0.25, 2)])
+        self.mox.VerifyAll()
+
+    def test_snapshot_turns_on_debug_cursor_for_its_thread(self):
+        # Each thread has its own connection, so use the real ones.
+        self.mox.UnsetStubs()
+        debug_cursors = []
+
+        def drain():
+            self.stats.snapshot()
+            debug_cursors.append(connection.use_debug_cursor)
+        thread = threading.Thread(target=drain)
+        thread.start()
+        thread.join()
+        self.assertEqual(debug_cursors, [True])
+
+    def test_record(self):
+        self.mox.ReplayAll()
+        self.stats.record('compute.instance.update', INSTANCE_ID_1,
+                          [('parse', 0.001, 0),
+                           ('process_raw_data', 0.01, 2)])
+        histograms = self.stats.histograms['compute.instance.update']
+        self.assertEqual(histograms['parse'].count, 1)
+        self.assertEqual(histograms['process_raw_data'].queries, 2)
+        self.mox.VerifyAll()
+
+    def test_record_logs_slow_message(self):
+        log = self.mox.CreateMockAnything()
+        stacklog.get_logger().AndReturn(log)
+        log.warn("test: slow message 150.0ms "
+                 "event_type=compute.instance.update instance=%s "
+                 "(parse=50.0ms/0q, process_raw_data=100.0ms/3q)" %
+                 INSTANCE_ID_1)
+        self.mox.ReplayAll()
+        self.stats.record('compute.instance.update', INSTANCE_ID_1,
+                          [('parse', 0.05, 0),
+                           ('process_raw_data', 0.1, 3)])
+        self.mox.VerifyAll()
+
+    def test_maybe_dump(self):
+        self.stats.last_dump = 100
+        histogram = message_stats.StageHistogram()
+        histogram.add(0.004, 3)
+        self.stats.histograms = {'compute.instance.update':
+                                 {'parse': histogram}}
+        message_stats.time.time().AndReturn(130)
+        message_stats.time.time().AndReturn(160)
+        message_stats.time.time().AndReturn(160)
+        log = self.mox.CreateMockAnything()
+        stacklog.get_logger().AndReturn(log)
+        log.info("test: compute.instance.update parse %s" %
+                 histogram.summary())
+        self.mox.ReplayAll()
+        self.stats.maybe_dump()
+        self.stats.maybe_dump()
+        self.assertEqual(self.stats.histograms, {})
+        self.mox.VerifyAll()
+
+
+class IngestLagTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(message_stats.time, 'time')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_record_and_summary(self):
+        lag = message_stats.IngestLag(['compute.instance.exists'])
+        message_stats.time.time().AndReturn(110)
+        message_stats.time.time().AndReturn(130)
+        message_stats.time.time().AndReturn(150)
+        self.mox.ReplayAll()
+        lag.record('compute.instance.exists', 108)
+        lag.record('compute.instance.update', 100)
+        lag.record('compute.instance.update', 140)
+        self.assertEqual(lag.summary(),
+                         "other n=2 mean=20.0s max=30.0s, "
+                         "priority n=1 mean=2.0s max=2.0s")
+        self.assertEqual(lag.lags, {})
+        self.mox.VerifyAll()
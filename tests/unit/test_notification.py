@@ -21,6 +21,7 @@
 from decimal import Decimal
 import unittest
 from stacktach.notification import Notification
+from tests.unit.utils import MESSAGE_ID_1
 from tests.unit.utils import REQUEST_ID_1, TENANT_ID_1, INSTANCE_ID_1
 
 
@@ -64,6 +65,7 @@ class NotificationTestCase(unittest.TestCase):
         self.assertEquals(kwargs['publisher'], 'compute.cpu1-n01.example.com')
         self.assertEquals(kwargs['event'], 'compute.instance.create.start')
         self.assertEquals(kwargs['request_id'], REQUEST_ID_1)
+        self.assertEquals(kwargs['message_id'], None)
 
     def test_rawdata_kwargs_missing_image_meta(self):
         message = {
@@ -178,3 +180,44 @@ class NotificationTestCase(unittest.TestCase):
         self.assertEquals(kwargs['publisher'], 'compute.cpu1-n01.example.com')
         self.assertEquals(kwargs['event'], 'compute.instance.create.start')
         self.assertEquals(kwargs['request_id'], REQUEST_ID_1)
+
+    def test_instance_without_other_fields(self):
+        message = {'payload': {'instance': {'uuid': INSTANCE_ID_1}}}
+        self.assertEquals(Notification(message).instance, INSTANCE_ID_1)
+
+    def test_instance_uuid_before_instance_id(self):
+        message = {'payload': {'instance_id': 'other',
+                               'instance_uuid': INSTANCE_ID_1}}
+        self.assertEquals(Notification(message).instance, INSTANCE_ID_1)
+
+    def test_fields_extracted_once(self):
+        message = {
+            'event_type': 'compute.instance.update',
+            'publisher_id': 'compute.',
+            '_context_request_id': REQUEST_ID_1,
+            'timestamp': '2013-06-12 06:30:52.790476',
+            'payload': {'instance_id': INSTANCE_ID_1,
+                        'tenant_id': TENANT_ID_1}
+        }
+        n = Notification(message)
+        fields = n.fields
+        self.assertTrue(n.fields is fields)
+        self.assertEquals(n.service, 'compute')
+        self.assertEquals(n.host, '')
+        self.assertEquals(n.tenant, TENANT_ID_1)
+        self.assertEquals(n.instance, INSTANCE_ID_1)
+        self.assertEquals(n.when, Decimal('1371018652.790476'))
+        self.assertRaises(AttributeError, getattr, n, 'bogus')
+
+    def test_message_id(self):
+        message = {
+            'event_type': 'compute.instance.update',
+            'publisher_id': 'compute.cpu1-n01.example.com',
+            'message_id': MESSAGE_ID_1,
+            '_context_request_id': REQUEST_ID_1,
+            'timestamp': '2013-06-12 06:30:52.790476',
+            'payload': {'instance_id': INSTANCE_ID_1}
+        }
+        kwargs = Notification(message).rawdata_kwargs('1', 'monitor.info',
+                                                      'json')
+        self.assertEquals(kwargs['message_id'], MESSAGE_ID_1)
@@ -0,0 +1,103 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import Queue
+import unittest
+
+import mox
+
+import utils
+from utils import INSTANCE_ID_1
+from stacktach import pipeline
+from stacktach import utils as stacktach_utils
+
+
+class PostProcessPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.pipeline = pipeline.PostProcessPipeline('test', 2, 10)
+        for i in range(2):
+            self.pipeline.queues.append(self.mox.CreateMockAnything())
+            self.pipeline.processes.append(self.mox.CreateMockAnything())
+            self.pipeline.lags.append(self.mox.CreateMockAnything())
+        self.mox.StubOutWithMock(pipeline.time, 'time')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_put_picks_queue_by_instance(self):
+        raw = utils.create_raw(self.mox, utils.decimal_utc(),
+                               'compute.instance.update')
+        body = {'event_type': 'compute.instance.update'}
+        shard = stacktach_utils.shard_for(INSTANCE_ID_1, 2)
+        pipeline.time.time().AndReturn(100)
+        self.pipeline.queues[shard].put((raw, body, 100), timeout=1)
+        self.mox.ReplayAll()
+        self.pipeline.put(raw, body)
+        self.mox.VerifyAll()
+
+    def test_put_waits_while_queue_full(self):
+        raw = utils.create_raw(self.mox, utils.decimal_utc(),
+                               'compute.instance.update')
+        shard = stacktach_utils.shard_for(INSTANCE_ID_1, 2)
+        queue = self.pipeline.queues[shard]
+        pipeline.time.time().AndReturn(100)
+        queue.put((raw, {}, 100), timeout=1).AndRaise(Queue.Full())
+        self.pipeline.processes[shard].is_alive().AndReturn(True)
+        queue.put((raw, {}, 100), timeout=1)
+        self.mox.ReplayAll()
+        self.pipeline.put(raw, {})
+        self.mox.VerifyAll()
+
+    def test_put_raises_if_worker_died(self):
+        raw = utils.create_raw(self.mox, utils.decimal_utc(),
+                               'compute.instance.update')
+        shard = stacktach_utils.shard_for(INSTANCE_ID_1, 2)
+        pipeline.time.time().AndReturn(100)
+        self.pipeline.queues[shard].put((raw, {}, 100), timeout=1)\
+                                   .AndRaise(Queue.Full())
+        self.pipeline.processes[shard].is_alive().AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertRaises(pipeline.PipelineException, self.pipeline.put,
+                          raw, {})
+        self.mox.VerifyAll()
+
+    def test_depths_and_lag(self):
+        self.pipeline.queues[0].qsize().AndReturn(3)
+        self.pipeline.queues[1].qsize().AndReturn(0)
+        self.pipeline.lags[0].value = 1.5
+        self.pipeline.lags[1].value = 0.0
+        self.mox.ReplayAll()
+        self.assertEqual(self.pipeline.depths(), [3, 0])
+        self.assertEqual(self.pipeline.lag(), [1.5, 0.0])
+        self.mox.VerifyAll()
+
+    def test_stop(self):
+        queues = self.pipeline.queues
+        processes = self.pipeline.processes
+        processes[0].is_alive().AndReturn(True)
+        queues[0].put(None)
+        processes[1].is_alive().AndReturn(False)
+        processes[0].join()
+        processes[1].join()
+        self.mox.ReplayAll()
+        self.pipeline.stop()
+        self.assertEqual(self.pipeline.processes, [])
+        self.mox.VerifyAll()
@@ -0,0 +1,104 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mox
+
+from stacktach import prefork
+
+
+class PreforkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.tmpdir = tempfile.mkdtemp()
+        self.smaps = prefork.SMAPS
+        prefork.SMAPS = os.path.join(self.tmpdir, '%d.smaps')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        prefork.SMAPS = self.smaps
+        shutil.rmtree(self.tmpdir)
+
+    def test_preload(self):
+        self.mox.StubOutWithMock(prefork.importlib, 'import_module')
+        self.mox.StubOutWithMock(prefork.loading, 'get_models')
+        self.mox.StubOutWithMock(prefork.db, 'close_connection')
+        self.mox.StubOutWithMock(prefork.gc, 'collect')
+        self.mox.StubOutWithMock(prefork.time, 'time')
+        prefork.time.time().AndReturn(100)
+        prefork.importlib.import_module('kombu.transport.librabbitmq')
+        prefork.loading.get_models().AndReturn([])
+        prefork.db.close_connection()
+        prefork.gc.collect().AndReturn(0)
+        prefork.time.time().AndReturn(102.5)
+        self.mox.ReplayAll()
+        self.assertEqual(prefork.preload(), 2.5)
+        self.mox.VerifyAll()
+
+    def test_shared_memory(self):
+        with open(prefork.SMAPS % 42, 'w') as smaps:
+            smaps.write("00400000-0063c000 r-xp 00000000 08:01 1 python\n"
+                        "Rss:                2288 kB\n"
+                        "Shared_Clean:       2048 kB\n"
+                        "Shared_Dirty:        128 kB\n"
+                        "Private_Clean:        64 kB\n"
+                        "Private_Dirty:        48 kB\n"
+                        "01b6a000-01f9c000 rw-p 00000000 00:00 0 [heap]\n"
+                        "Shared_Clean:          0 kB\n"
+                        "Shared_Dirty:       1024 kB\n")
+        self.assertEqual(prefork.shared_memory(42), 3200 * 1024)
+
+    def test_shared_memory_without_smaps(self):
+        self.assertEqual(prefork.shared_memory(42), None)
+
+    def test_report(self):
+        with open(prefork.SMAPS % 101, 'w') as smaps:
+            smaps.write("Shared_Dirty:       2048 kB\n")
+        process1 = self.mox.CreateMockAnything()
+        process1.name, process1.pid = 'worker-1', 101
+        process1.is_alive().AndReturn(True)
+        process2 = self.mox.CreateMockAnything()
+        process2.is_alive().AndReturn(False)
+        process3 = self.mox.CreateMockAnything()
+        process3.name, process3.pid = 'worker-3', 103
+        process3.is_alive().AndReturn(True)
+        self.mox.ReplayAll()
+        printed = []
+        self.mox.stubs.Set(sys, 'stdout', Output(printed))
+        prefork.report([process1, process2, process3], 1.5)
+        self.mox.stubs.UnsetAll()
+        self.assertEqual(''.join(printed),
+                         "worker-1 (pid 101) started 1.50s sooner and "
+                         "shares 2.0MB\n"
+                         "worker-3 (pid 103) started 1.50s sooner\n")
+        self.mox.VerifyAll()
+
+
+class Output(object):
+    def __init__(self, written):
+        self.written = written
+
+    def write(self, text):
+        self.written.append(text)
@@ -0,0 +1,115 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import unittest
+
+import mox
+
+from stacktach import db
+from stacktach import views
+from tests.unit.utils import INSTANCE_ID_1
+import worker.redrive as redrive
+
+BODY = {'event_type': 'compute.instance.update',
+        'payload': {'instance_id': INSTANCE_ID_1}}
+
+
+class RedriveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(redrive.transaction, 'commit_on_success')
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        self.mox.StubOutWithMock(views, 'post_process')
+        self.mox.StubOutWithMock(db, 'find_dead_letters')
+        self.mox.StubOutWithMock(db, 'save')
+        self.deployment = self.mox.CreateMockAnything()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _dead_letter(self, raw=None):
+        dead_letter = self.mox.CreateMockAnything()
+        dead_letter.deployment = self.deployment
+        dead_letter.routing_key = 'monitor.info'
+        dead_letter.json = json.dumps(BODY)
+        dead_letter.raw_id = raw and 1 or None
+        dead_letter.raw = raw
+        dead_letter.attempts = 3
+        dead_letter.error = 'ValueError: bad'
+        return dead_letter
+
+    def _expect_commit(self, error=None):
+        commit = self.mox.CreateMockAnything()
+        redrive.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        if error is None:
+            commit.__exit__(None, None, None).AndReturn(None)
+        else:
+            commit.__exit__(error, mox.IgnoreArg(), mox.IgnoreArg())\
+                  .AndReturn(False)
+
+    def test_redrive_dead_letter(self):
+        dead_letter = self._dead_letter()
+        raw = self.mox.CreateMockAnything()
+        self._expect_commit()
+        views.process_raw_data(self.deployment, ('monitor.info', BODY),
+                               dead_letter.json).AndReturn(raw)
+        views.post_process(raw, BODY)
+        dead_letter.delete()
+        self.mox.ReplayAll()
+        redrive.redrive_dead_letter(dead_letter)
+        self.mox.VerifyAll()
+
+    def test_redrive_dead_letter_already_stored(self):
+        raw = self.mox.CreateMockAnything()
+        dead_letter = self._dead_letter(raw=raw)
+        self._expect_commit()
+        views.post_process(raw, BODY)
+        dead_letter.delete()
+        self.mox.ReplayAll()
+        redrive.redrive_dead_letter(dead_letter)
+        self.mox.VerifyAll()
+
+    def test_redrive_counts_failures(self):
+        dead_letter1 = self._dead_letter()
+        dead_letter2 = self._dead_letter()
+        db.find_dead_letters(self.deployment, event='compute.instance.update',
+                             ids=None).AndReturn([dead_letter1, dead_letter2])
+        raw = self.mox.CreateMockAnything()
+        self._expect_commit()
+        views.process_raw_data(self.deployment, mox.IgnoreArg(),
+                               mox.IgnoreArg()).AndReturn(raw)
+        views.post_process(raw, BODY)
+        dead_letter1.delete()
+        self._expect_commit(error=ValueError)
+        views.process_raw_data(self.deployment, mox.IgnoreArg(),
+                               mox.IgnoreArg())\
+             .AndRaise(ValueError('still bad'))
+        self._expect_commit()
+        db.save(dead_letter2)
+        self.mox.ReplayAll()
+        redriven, failed = redrive.redrive(self.deployment,
+                                           event='compute.instance.update')
+        self.assertEqual((redriven, failed), (1, 1))
+        self.assertEqual(dead_letter2.attempts, 4)
+        self.assertTrue('ValueError: still bad' in dead_letter2.error)
+        self.mox.VerifyAll()
@@ -0,0 +1,219 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import gzip
+import json
+import os
+import Queue
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from utils import REQUEST_ID_1
+from stacktach import utils as stacktach_utils
+from stacktach import views
+import worker.replay as replay
+
+
+class ReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.tmpdir = tempfile.mkdtemp()
+        self.mox.StubOutWithMock(replay.transaction, 'commit_on_success')
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        self.mox.StubOutWithMock(views, 'post_process')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        shutil.rmtree(self.tmpdir)
+
+    def _write_dump(self, name, messages, compress=False):
+        path = os.path.join(self.tmpdir, name)
+        opener = compress and gzip.open or open
+        lines = []
+        with opener(path, 'wb') as f:
+            for message in messages:
+                line = json.dumps(message)
+                lines.append(line)
+                f.write('%s\n' % line)
+        return path, lines
+
+    def _message(self, instance, event_type='compute.instance.update'):
+        return ['monitor.info', {'event_type': event_type,
+                                 '_context_request_id': REQUEST_ID_1,
+                                 'publisher_id': 'compute.c.example.com',
+                                 'payload': {'instance_id': instance}}]
+
+    def _expect_batch(self, deployment, messages, lines, raws):
+        commit = self.mox.CreateMockAnything()
+        replay.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        batch = [(tuple(message), line)
+                 for message, line in zip(messages, lines)]
+        views.process_raw_data_batch(deployment, batch).AndReturn(raws)
+        for raw, message in zip(raws, messages):
+            if raw:
+                views.post_process(raw, message[1])
+        commit.__exit__(None, None, None).AndReturn(None)
+
+    def test_replay_dump(self):
+        deployment = self.mox.CreateMockAnything()
+        messages = [self._message(INSTANCE_ID_1) for i in range(3)]
+        dump, lines = self._write_dump('dump.json.gz', messages,
+                                       compress=True)
+        raw1 = self.mox.CreateMockAnything()
+        raw3 = self.mox.CreateMockAnything()
+        self._expect_batch(deployment, messages[:2], lines[:2], [raw1, None])
+        self._expect_batch(deployment, messages[2:], lines[2:], [raw3])
+        self.mox.ReplayAll()
+        replayed = replay.replay_dump(deployment, dump, batch_size=2,
+                                      checkpoint_dir=self.tmpdir)
+        self.assertEqual(replayed, 3)
+        checkpoint = replay.checkpoint_path(self.tmpdir, dump, 0)
+        self.assertEqual(replay.read_checkpoint(checkpoint), 3)
+        self.mox.VerifyAll()
+
+    def test_replay_batch_failure_discards_cached_lifecycles(self):
+        deployment = self.mox.CreateMockAnything()
+        messages = [self._message(INSTANCE_ID_1),
+                    self._message(INSTANCE_ID_2)]
+        batch = [(tuple(message), json.dumps(message))
+                 for message in messages]
+        cache = self.mox.CreateMockAnything()
+        self.mox.stubs.Set(views, 'LIFECYCLE_CACHE', cache)
+        commit = self.mox.CreateMockAnything()
+        replay.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        views.process_raw_data_batch(deployment, batch)\
+             .AndRaise(Exception('deadlock'))
+        commit.__exit__(Exception, mox.IgnoreArg(), mox.IgnoreArg())\
+              .AndReturn(None)
+        cache.discard_all([INSTANCE_ID_1, INSTANCE_ID_2])
+        self.mox.ReplayAll()
+        self.assertRaises(Exception, replay.replay_batch, deployment, batch)
+        self.mox.VerifyAll()
+
+    def test_replay_dump_resumes_from_checkpoint(self):
+        deployment = self.mox.CreateMockAnything()
+        messages = [self._message(INSTANCE_ID_1) for i in range(3)]
+        dump, lines = self._write_dump('dump.json', messages)
+        checkpoint = replay.checkpoint_path(self.tmpdir, dump, 0)
+        replay.write_checkpoint(checkpoint, 2)
+        raw = self.mox.CreateMockAnything()
+        self._expect_batch(deployment, messages[2:], lines[2:], [raw])
+        self.mox.ReplayAll()
+        replayed = replay.replay_dump(deployment, dump, batch_size=2,
+                                      checkpoint_dir=self.tmpdir)
+        self.assertEqual(replayed, 1)
+        self.assertEqual(replay.read_checkpoint(checkpoint), 3)
+        self.mox.VerifyAll()
+
+    def test_split_dump(self):
+        messages = [self._message(INSTANCE_ID_1),
+                    self._message(INSTANCE_ID_2),
+                    self._message(INSTANCE_ID_1)]
+        dump, lines = self._write_dump('dump.json', messages)
+        shard1 = stacktach_utils.shard_for(INSTANCE_ID_1, 3)
+        shard2 = stacktach_utils.shard_for(INSTANCE_ID_2, 3)
+        self.assertNotEqual(shard1, shard2)
+        queues = [Queue.Queue() for shard in range(3)]
+        self.mox.ReplayAll()
+        replay.split_dump(dump, queues, batch_size=2)
+
+        self.assertEqual(queues[shard1].get_nowait(),
+                         (dump, [lines[0], lines[2]], 3))
+        self.assertEqual(queues[shard1].get_nowait(), (dump, [], 3))
+        self.assertEqual(queues[shard2].get_nowait(), (dump, [lines[1]], 3))
+        other = 3 - shard1 - shard2
+        self.assertEqual(queues[other].get_nowait(), (dump, [], 3))
+        for queue in queues:
+            self.assertTrue(queue.empty())
+        self.mox.VerifyAll()
+
+    def test_split_dump_resumes_each_shard_from_its_checkpoint(self):
+        messages = [self._message(INSTANCE_ID_1),
+                    self._message(INSTANCE_ID_2),
+                    self._message(INSTANCE_ID_1),
+                    self._message(INSTANCE_ID_2)]
+        dump, lines = self._write_dump('dump.json', messages)
+        shard1 = stacktach_utils.shard_for(INSTANCE_ID_1, 3)
+        shard2 = stacktach_utils.shard_for(INSTANCE_ID_2, 3)
+        replay.write_checkpoint(
+            replay.checkpoint_path(self.tmpdir, dump, shard1), 3)
+        replay.write_checkpoint(
+            replay.checkpoint_path(self.tmpdir, dump, shard2), 1)
+        queues = [Queue.Queue() for shard in range(3)]
+        self.mox.ReplayAll()
+        replay.split_dump(dump, queues, checkpoint_dir=self.tmpdir)
+        self.assertEqual(queues[shard1].get_nowait(), (dump, [], 4))
+        self.assertEqual(queues[shard2].get_nowait(),
+                         (dump, [lines[1], lines[3]], 4))
+        self.mox.VerifyAll()
+
+    def test_split_dump_gives_up_when_a_shard_dies(self):
+        messages = [self._message(INSTANCE_ID_1)]
+        dump, lines = self._write_dump('dump.json', messages)
+        shard = stacktach_utils.shard_for(INSTANCE_ID_1, 2)
+        queues = [self.mox.CreateMockAnything(),
+                  self.mox.CreateMockAnything()]
+        processes = [self.mox.CreateMockAnything(),
+                     self.mox.CreateMockAnything()]
+        processes[shard].name = 'Process-1'
+        processes[shard].exitcode = 1
+        queues[shard].put((dump, lines, 1), timeout=1)\
+                     .AndRaise(Queue.Full())
+        processes[shard].is_alive().AndReturn(True)
+        queues[shard].put((dump, lines, 1), timeout=1)\
+                     .AndRaise(Queue.Full())
+        processes[shard].is_alive().AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertRaises(replay.ShardDied, replay.split_dump, dump, queues,
+                          batch_size=1, processes=processes)
+        self.mox.VerifyAll()
+
+    def test_replay_shard(self):
+        deployment = self.mox.CreateMockAnything()
+        messages = [self._message(INSTANCE_ID_1) for i in range(3)]
+        dump, lines = self._write_dump('dump.json', messages)
+        raw = self.mox.CreateMockAnything()
+        self._expect_batch(deployment, messages[:2], lines[:2], [raw, raw])
+        self._expect_batch(deployment, messages[2:], lines[2:], [raw])
+        queue = Queue.Queue()
+        queue.put((dump, lines[:2], 4))
+        queue.put((dump, lines[2:], 7))
+        queue.put((dump, [], 9))
+        queue.put(None)
+        self.mox.ReplayAll()
+        replayed = replay.replay_shard(deployment, queue, 1,
+                                       checkpoint_dir=self.tmpdir)
+        self.assertEqual(replayed, {dump: 3})
+        checkpoint = replay.checkpoint_path(self.tmpdir, dump, 1)
+        self.assertEqual(replay.read_checkpoint(checkpoint), 9)
+        self.mox.VerifyAll()
+
+    def test_read_checkpoint_missing(self):
+        self.assertEqual(replay.read_checkpoint(None), 0)
+        path = os.path.join(self.tmpdir, 'missing')
+        self.assertEqual(replay.read_checkpoint(path), 0)
@@ -0,0 +1,181 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+from stacktach import spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        shutil.rmtree(self.tmpdir)
+
+    def test_only_synced_records_are_read(self):
+        s = spool.Spool(self.directory)
+        s.append('monitor.info', '{"a": 1}')
+        self.assertEqual(s.read(10), ([], (0, 0)))
+        s.sync()
+        s.append('monitor.error', u'{"b": "\\n"}')
+        records, position = s.read(10)
+        self.assertEqual(records, [('monitor.info', '{"a": 1}')])
+        s.sync()
+        s.commit(position, 1)
+        records, position = s.read(10)
+        self.assertEqual(records, [('monitor.error', '{"b": "\\n"}')])
+        self.assertEqual(s.appended, 2)
+        self.assertEqual(s.drained, 1)
+
+    def test_read_in_batches(self):
+        s = spool.Spool(self.directory)
+        for i in range(5):
+            s.append('monitor.info', '{"i": %d}' % i)
+        s.sync()
+        records, position = s.read(3)
+        self.assertEqual(len(records), 3)
+        s.commit(position, 3)
+        records, position = s.read(3)
+        self.assertEqual([body for key, body in records],
+                         ['{"i": 3}', '{"i": 4}'])
+
+    def test_segments_are_rotated_and_deleted(self):
+        s = spool.Spool(self.directory, segment_size=10)
+        s.append('monitor.info', '{"i": 0}')
+        s.sync()
+        s.append('monitor.info', '{"i": 1}')
+        s.sync()
+        self.assertEqual(s.write_segment, 2)
+        self.assertTrue(s.depth() > 0)
+        records, position = s.read(10)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(position, (2, 0))
+        s.commit(position, 2)
+        self.assertEqual(s._segments(), [2])
+        self.assertEqual(s.depth(), 0)
+
+    def test_reopen_resumes_from_checkpoint(self):
+        s = spool.Spool(self.directory)
+        for i in range(3):
+            s.append('monitor.info', '{"i": %d}' % i)
+        s.sync()
+        records, position = s.read(1)
+        s.commit(position, 1)
+        s.close()
+
+        s = spool.Spool(self.directory)
+        self.assertEqual(s.write_segment, 1)
+        records, position = s.read(10)
+        self.assertEqual([body for key, body in records],
+                         ['{"i": 1}', '{"i": 2}'])
+        self.assertEqual(position, (1, 0))
+
+    def test_partial_record_skipped(self):
+        s = spool.Spool(self.directory)
+        s.append('monitor.info', '{"i": 0}')
+        s.sync()
+        s.writer.write('20 monitor.info\n{"i": ')
+        s.close()
+
+        self.mox.StubOutWithMock(spool.stacklog, 'warn')
+        spool.stacklog.warn(mox.IsA(str))
+        self.mox.ReplayAll()
+        s = spool.Spool(self.directory)
+        records, position = s.read(10)
+        self.assertEqual(records, [('monitor.info', '{"i": 0}')])
+        self.assertEqual(position, (1, 0))
+        self.mox.VerifyAll()
+
+
+class SpoolDrainerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = spool.Spool(os.path.join(self.tmpdir, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_drain_once(self):
+        stored = []
+        drainer = spool.SpoolDrainer('test', self.spool, stored.extend,
+                                     lambda: None, 2)
+        for i in range(3):
+            self.spool.append('monitor.info', '{"i": %d}' % i)
+        self.spool.sync()
+        self.assertEqual(drainer.drain_once(), 2)
+        self.assertEqual(drainer.drain_once(), 1)
+        self.assertEqual(drainer.drain_once(), 0)
+        self.assertEqual([m.body for m in stored],
+                         ['{"i": 0}', '{"i": 1}', '{"i": 2}'])
+        self.assertEqual(stored[0].delivery_info,
+                         {'routing_key': 'monitor.info'})
+        self.assertEqual(self.spool.drained, 3)
+
+    def test_failed_batch_is_retried(self):
+        calls = []
+
+        def store(messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise Exception("database went away")
+
+        drainer = spool.SpoolDrainer('test', self.spool, store,
+                                     lambda: None, 10)
+        self.spool.append('monitor.info', '{}')
+        self.spool.sync()
+        self.assertRaises(Exception, drainer.drain_once)
+        self.assertEqual(drainer.drain_once(), 1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_stop(self):
+        idles = []
+        drainer = spool.SpoolDrainer('test', self.spool, lambda messages: None,
+                                     lambda: idles.append(1), 10)
+        drainer.start()
+        drainer.stop()
+        self.assertFalse(drainer.is_alive())
+        self.assertTrue(idles)
+
+    def test_stop_leaves_the_rest_spooled(self):
+        stored = []
+
+        def store(messages):
+            stored.extend(messages)
+            # As if we were asked to stop part way through the batch.
+            drainer.stopping = True
+
+        drainer = spool.SpoolDrainer('test', self.spool, store,
+                                     lambda: None, 10)
+        for i in range(25):
+            self.spool.append('monitor.info', '{"i": %d}' % i)
+        self.spool.sync()
+        drainer.run()
+        self.assertEqual(len(stored), 10)
+        records, position = self.spool.read(100)
+        self.assertEqual(len(records), 15)
@@ -26,6 +26,7 @@ import mox
 
 import utils
 from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
 from utils import OS_VERSION_1
 from utils import OS_ARCH_1
 from utils import OS_DISTRO_1
@@ -108,6 +109,127 @@ class StacktachRawParsingTestCase(unittest.TestCase):
 
         views.NOTIFICATIONS['monitor.info'] = old_info_handler
 
+    def test_process_raw_data_batch(self):
+        deployment = self.mox.CreateMockAnything()
+        args1 = ('monitor.info', {'event_type': 'compute.instance.update'})
+        args2 = ('monitor.error', {'event_type': 'compute.instance.error'})
+        messages = [(args1, json.dumps(args1)), (args2, json.dumps(args2))]
+        raw_values1 = {'routing_key': 'monitor.info', 'json': messages[0][1]}
+        raw_values2 = {'routing_key': 'monitor.error', 'json': messages[1][1]}
+
+        old_info_handler = views.NOTIFICATIONS['monitor.info']
+        old_error_handler = views.NOTIFICATIONS['monitor.error']
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                         messages[0][1])\
+                         .AndReturn(raw_values1)
+        mock_notification.rawdata_kwargs(deployment, 'monitor.error',
+                                         messages[1][1])\
+                         .AndReturn(raw_values2)
+        views.NOTIFICATIONS['monitor.info'] = \
+            lambda message_body: mock_notification
+        views.NOTIFICATIONS['monitor.error'] = \
+            lambda message_body: mock_notification
+
+        raw1 = self.mox.CreateMockAnything()
+        raw2 = self.mox.CreateMockAnything()
+        views.STACKDB.create_rawdata_batch([raw_values1, raw_values2])\
+                     .AndReturn([raw1, raw2])
+        self.mox.ReplayAll()
+        raws = views.process_raw_data_batch(deployment, messages)
+        self.assertEqual(raws, [raw1, raw2])
+        self.mox.VerifyAll()
+
+        views.NOTIFICATIONS['monitor.info'] = old_info_handler
+        views.NOTIFICATIONS['monitor.error'] = old_error_handler
+
+    def test_process_raw_data_batch_skips_empty_values(self):
+        deployment = self.mox.CreateMockAnything()
+        args = ('monitor.info', {'event_type': 'compute.instance.update'})
+        messages = [(args, json.dumps(args)), (args, json.dumps(args))]
+        raw_values = {'routing_key': 'monitor.info', 'json': messages[0][1]}
+
+        old_info_handler = views.NOTIFICATIONS['monitor.info']
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                         messages[0][1]).AndReturn({})
+        mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                         messages[1][1])\
+                         .AndReturn(raw_values)
+        views.NOTIFICATIONS['monitor.info'] = \
+            lambda message_body: mock_notification
+
+        raw = self.mox.CreateMockAnything()
+        views.STACKDB.create_rawdata_batch([raw_values]).AndReturn([raw])
+        self.mox.ReplayAll()
+        raws = views.process_raw_data_batch(deployment, messages)
+        self.assertEqual(raws, [None, raw])
+        self.mox.VerifyAll()
+
+        views.NOTIFICATIONS['monitor.info'] = old_info_handler
+
+    def test_process_raw_data_batch_builds_dropped_raws(self):
+        deployment = self.mox.CreateMockAnything()
+        args = ('monitor.info', {'event_type': 'compute.instance.update'})
+        messages = [(args, json.dumps(args)), (args, json.dumps(args))]
+        raw_values1 = {'routing_key': 'monitor.info', 'state': 'active'}
+        raw_values2 = {'routing_key': 'monitor.info', 'state': 'building'}
+
+        old_info_handler = views.NOTIFICATIONS['monitor.info']
+        mock_notification = self.mox.CreateMockAnything()
+        mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                         messages[0][1])\
+                         .AndReturn(raw_values1)
+        mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                         messages[1][1])\
+                         .AndReturn(raw_values2)
+        views.NOTIFICATIONS['monitor.info'] = \
+            lambda message_body: mock_notification
+        views.INGEST_POLICY = self.mox.CreateMockAnything()
+        views.INGEST_POLICY.should_store(raw_values1).AndReturn(False)
+        views.INGEST_POLICY.should_store(raw_values2).AndReturn(True)
+
+        dropped = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        views.STACKDB.create_rawdata_batch([raw_values2]).AndReturn([raw])
+        views.STACKDB.build_rawdata(**raw_values1).AndReturn(dropped)
+        self.mox.ReplayAll()
+        try:
+            raws = views.process_raw_data_batch(deployment, messages)
+        finally:
+            views.INGEST_POLICY = None
+            views.NOTIFICATIONS['monitor.info'] = old_info_handler
+        self.assertEqual(raws, [dropped, raw])
+        self.mox.VerifyAll()
+
+    def test_process_raw_data_batch_skips_stored_messages(self):
+        deployment = self.mox.CreateMockAnything()
+        args = ('monitor.info', {'event_type': 'compute.instance.update'})
+        messages = [(args, json.dumps(args))] * 3
+        raw_values1 = {'routing_key': 'monitor.info', 'message_id': 'm1'}
+        raw_values2 = {'routing_key': 'monitor.info', 'message_id': 'm2'}
+
+        old_info_handler = views.NOTIFICATIONS['monitor.info']
+        mock_notification = self.mox.CreateMockAnything()
+        for values in [raw_values1, raw_values2, dict(raw_values2)]:
+            mock_notification.rawdata_kwargs(deployment, 'monitor.info',
+                                             messages[0][1])\
+                             .AndReturn(values)
+        views.NOTIFICATIONS['monitor.info'] = \
+            lambda message_body: mock_notification
+
+        raw = self.mox.CreateMockAnything()
+        views.STACKDB.find_stored_message_ids(['m1', 'm2', 'm2'])\
+                     .AndReturn(set(['m1']))
+        views.STACKDB.create_rawdata_batch([raw_values2]).AndReturn([raw])
+        self.mox.ReplayAll()
+        try:
+            raws = views.process_raw_data_batch(deployment, messages)
+        finally:
+            views.NOTIFICATIONS['monitor.info'] = old_info_handler
+        self.assertEqual(raws, [None, raw, None])
+        self.mox.VerifyAll()
+
 class StacktachLifecycleTestCase(unittest.TestCase):
     def setUp(self):
         self.mox = mox.Mox()
@@ -197,6 +319,24 @@ class StacktachLifecycleTestCase(unittest.TestCase):
         views.aggregate_lifecycle(raw)
         self.mox.VerifyAll()
 
+    def test_aggregate_lifecycle_dropped_raw(self):
+        event_name = 'compute.instance.update'
+        when = datetime.datetime.utcnow()
+        raw = utils.create_raw(self.mox, when, event_name, state='active')
+        raw.id = None
+        old_raw = self.mox.CreateMockAnything()
+        old_raw.when = when - datetime.timedelta(seconds=1)
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1,
+                                           'building', '', old_raw)
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1)\
+                     .AndReturn([lifecycle])
+        views.STACKDB.save(lifecycle)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(raw)
+        self.assertEqual(lifecycle.last_raw, old_raw)
+        self.assertEqual(lifecycle.last_state, 'active')
+        self.mox.VerifyAll()
+
     def test_aggregate_lifecycle_start(self):
         event_name = 'compute.instance.create'
         event = '%s.start' % event_name
@@ -206,12 +346,12 @@ class StacktachLifecycleTestCase(unittest.TestCase):
         views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([])
         lifecycle = self.mox.CreateMockAnything()
         lifecycle.instance = INSTANCE_ID_1
+        lifecycle.id = None
+        lifecycle.last_raw = None
         views.STACKDB.create_lifecycle(instance=INSTANCE_ID_1)\
                      .AndReturn(lifecycle)
         views.STACKDB.save(lifecycle)
 
-        views.STACKDB.find_timings(name=event_name, lifecycle=lifecycle)\
-                     .AndReturn([])
         timing = utils.create_timing(self.mox, event_name, lifecycle)
         views.STACKDB.create_timing(lifecycle=lifecycle, name=event_name)\
                      .AndReturn(timing)
@@ -219,7 +359,7 @@ class StacktachLifecycleTestCase(unittest.TestCase):
 
         self.mox.ReplayAll()
         views.aggregate_lifecycle(raw)
-        self.assertEqual(lifecycle.last_raw, raw)
+        self.assertEqual(lifecycle.last_raw_id, raw.id)
         self.assertEqual(lifecycle.last_state, 'building')
         self.assertEqual(lifecycle.last_task_state, '')
         self.assertEqual(timing.name, event_name)
@@ -258,7 +398,7 @@ class StacktachLifecycleTestCase(unittest.TestCase):
 
         self.mox.ReplayAll()
         views.aggregate_lifecycle(end_raw)
-        self.assertEqual(lifecycle.last_raw, end_raw)
+        self.assertEqual(lifecycle.last_raw_id, end_raw.id)
         self.assertEqual(lifecycle.last_state, 'active')
         self.assertEqual(lifecycle.last_task_state, 'build')
         self.assertEqual(timing.name, event_name)
@@ -271,6 +411,58 @@ class StacktachLifecycleTestCase(unittest.TestCase):
 
         self.mox.VerifyAll()
 
+    def test_aggregate_lifecycle_stale_update(self):
+        when = utils.decimal_utc()
+        raw = utils.create_raw(self.mox, when, 'compute.instance.update',
+                               state='active', old_task='deleting')
+        last_raw = utils.create_raw(self.mox, when + 5,
+                                    'compute.instance.delete.end',
+                                    state='deleted')
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1,
+                                           'deleted', '', last_raw)
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1)\
+                     .AndReturn([lifecycle])
+        self.mox.StubOutWithMock(views, "start_kpi_tracking")
+        views.start_kpi_tracking(lifecycle, raw)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(raw)
+        self.assertEqual(lifecycle.last_raw, last_raw)
+        self.assertEqual(lifecycle.last_state, 'deleted')
+        self.assertEqual(lifecycle.last_task_state, '')
+        self.mox.VerifyAll()
+
+    def test_aggregate_lifecycle_start_after_end(self):
+        event_name = 'compute.instance.delete'
+        start_when = utils.decimal_utc()
+        end_when = start_when + 5
+        start_raw = utils.create_raw(self.mox, start_when,
+                                     '%s.start' % event_name, id=2)
+        end_raw = utils.create_raw(self.mox, end_when, '%s.end' % event_name,
+                                   state='deleted')
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1,
+                                           'deleted', '', end_raw)
+        lifecycle.last_raw_id = end_raw.id
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1)\
+                     .AndReturn([lifecycle])
+        timing = utils.create_timing(self.mox, event_name, lifecycle,
+                                     end_raw=end_raw, end_when=end_when)
+        views.STACKDB.find_timings(name=event_name, lifecycle=lifecycle,
+                                   start_raw__isnull=True,
+                                   end_when__gte=start_when)\
+                     .AndReturn([timing])
+        self.mox.StubOutWithMock(views, "update_kpi")
+        views.update_kpi(timing, start_raw)
+        views.STACKDB.save(timing)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(start_raw)
+        self.assertEqual(lifecycle.last_raw_id, end_raw.id)
+        self.assertEqual(lifecycle.last_state, 'deleted')
+        self.assertEqual(timing.start_raw, start_raw)
+        self.assertEqual(timing.start_when, start_when)
+        self.assertEqual(timing.end_raw, end_raw)
+        self.assertEqual(timing.diff, 5)
+        self.mox.VerifyAll()
+
     def test_aggregate_lifecycle_update(self):
         event = 'compute.instance.update'
         when = datetime.datetime.utcnow()
@@ -279,6 +471,8 @@ class StacktachLifecycleTestCase(unittest.TestCase):
         views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1).AndReturn([])
         lifecycle = self.mox.CreateMockAnything()
         lifecycle.instance = INSTANCE_ID_1
+        lifecycle.id = None
+        lifecycle.last_raw = None
         views.STACKDB.create_lifecycle(instance=INSTANCE_ID_1).AndReturn(lifecycle)
         views.STACKDB.save(lifecycle)
 
@@ -287,7 +481,7 @@ class StacktachLifecycleTestCase(unittest.TestCase):
 
         self.mox.ReplayAll()
         views.aggregate_lifecycle(raw)
-        self.assertEqual(lifecycle.last_raw, raw)
+        self.assertEqual(lifecycle.last_raw_id, raw.id)
         self.assertEqual(lifecycle.last_state, 'active')
         self.assertEqual(lifecycle.last_task_state, 'reboot')
 
@@ -539,10 +733,22 @@ class StacktachUsageParsingTestCase(unittest.TestCase):
         raw = utils.create_raw(self.mox, when_decimal, event=event,
                                json_str=json_str)
         usage = self.mox.CreateMockAnything()
-        views.STACKDB.get_or_create_instance_usage(instance=INSTANCE_ID_1,
-                                                   request_id=REQUEST_ID_1) \
-            .AndReturn((usage, True))
-        views.STACKDB.save(usage)
+
+        def upsert(instance, request_id, values, keep_existing=()):
+            # The same as the database would do.
+            for name, value in values.items():
+                if name not in keep_existing or \
+                        getattr(usage, name, None) is None:
+                    setattr(usage, name, value)
+
+        if event.endswith('.start'):
+            views.STACKDB.upsert_instance_usage(
+                INSTANCE_ID_1, REQUEST_ID_1, mox.IsA(dict),
+                keep_existing=mox.IgnoreArg()).WithSideEffects(upsert)
+        else:
+            views.STACKDB.upsert_instance_usage(
+                INSTANCE_ID_1, REQUEST_ID_1, mox.IsA(dict))\
+                .WithSideEffects(upsert)
         self.mox.ReplayAll()
         return raw, usage
 
@@ -558,20 +764,12 @@ class StacktachUsageParsingTestCase(unittest.TestCase):
         event = 'compute.instance.delete.end'
         raw = utils.create_raw(self.mox, delete_decimal, event=event,
                                json_str=json_str)
-        delete = self.mox.CreateMockAnything()
-        delete.instance = INSTANCE_ID_1
-        delete.launched_at = launch_decimal
-        delete.deleted_at = delete_decimal
-        views.STACKDB.get_or_create_instance_delete(instance=INSTANCE_ID_1,
-                                                    deleted_at=delete_decimal)\
-                     .AndReturn((delete, True))
-        views.STACKDB.save(delete)
+        views.STACKDB.upsert_instance_delete(INSTANCE_ID_1, delete_decimal,
+                                             {'raw': raw,
+                                              'launched_at': launch_decimal})
         self.mox.ReplayAll()
 
         views._process_delete(raw, notif[1])
-        self.assertEqual(delete.instance, INSTANCE_ID_1)
-        self.assertEqual(delete.launched_at, launch_decimal)
-        self.assertEqual(delete.deleted_at, delete_decimal)
         self.mox.VerifyAll()
 
     def test_process_delete_no_launch(self):
@@ -583,18 +781,11 @@ class StacktachUsageParsingTestCase(unittest.TestCase):
         event = 'compute.instance.delete.end'
         raw = utils.create_raw(self.mox, delete_decimal, event=event,
                                json_str=json_str)
-        delete = self.mox.CreateMockAnything()
-        delete.instance = INSTANCE_ID_1
-        delete.deleted_at = delete_decimal
-        views.STACKDB.get_or_create_instance_delete(instance=INSTANCE_ID_1,
-                                                    deleted_at=delete_decimal)\
-                     .AndReturn((delete, True))
-        views.STACKDB.save(delete)
+        views.STACKDB.upsert_instance_delete(INSTANCE_ID_1, delete_decimal,
+                                             {'raw': raw})
         self.mox.ReplayAll()
 
         views._process_delete(raw, notif[1])
-        self.assertEqual(delete.instance, INSTANCE_ID_1)
-        self.assertEqual(delete.deleted_at, delete_decimal)
         self.mox.VerifyAll()
 
     def test_process_exists(self):
@@ -718,3 +909,60 @@ class StacktachUsageParsingTestCase(unittest.TestCase):
         views._process_exists(raw, notif[1])
         self.mox.VerifyAll()
 
+    def test_aggregate_exists_batch(self):
+        current_time = datetime.datetime.utcnow()
+        launch_time = current_time - datetime.timedelta(hours=23)
+        launch_decimal = utils.decimal_utc(launch_time)
+        deleted_time = current_time - datetime.timedelta(hours=12)
+        current_decimal = utils.decimal_utc(current_time)
+        audit_beginning = current_time - datetime.timedelta(hours=20)
+        kwargs = dict(launched=str(launch_time),
+                      audit_period_beginning=str(audit_beginning),
+                      audit_period_ending=str(current_time),
+                      tenant_id=TENANT_ID_1)
+        notif1 = utils.create_nova_notif(**kwargs)
+        notif2 = utils.create_nova_notif(instance=INSTANCE_ID_2,
+                                         deleted=str(deleted_time), **kwargs)
+        notif3 = utils.create_nova_notif(
+            audit_period_beginning=str(audit_beginning),
+            audit_period_ending=str(current_time), tenant_id=TENANT_ID_1)
+        event = 'compute.instance.exists'
+        raw1 = utils.create_raw(self.mox, current_decimal, event=event)
+        raw2 = utils.create_raw(self.mox, current_decimal, event=event,
+                                instance=INSTANCE_ID_2)
+        raw3 = utils.create_raw(self.mox, current_decimal, event=event)
+        raw3.id = 3
+        self.setup_mock_log()
+        self.log.warn('Ignoring exists without launched_at. RawData(3)')
+        usage1 = self.mox.CreateMockAnything()
+        delete2 = self.mox.CreateMockAnything()
+        launch1 = (INSTANCE_ID_1, launch_decimal)
+        launch2 = (INSTANCE_ID_2, launch_decimal)
+        views.STACKDB.find_instance_usages_by_launch([launch1, launch2])\
+             .AndReturn({launch1: usage1, launch2: None})
+        views.STACKDB.find_instance_deletes_by_launch([launch2])\
+             .AndReturn({launch2: delete2})
+        exists1 = self.mox.CreateMockAnything()
+        views.STACKDB.create_instance_exists(
+            message_id=MESSAGE_ID_1, instance=INSTANCE_ID_1,
+            launched_at=launch_decimal,
+            audit_period_beginning=utils.decimal_utc(audit_beginning),
+            audit_period_ending=current_decimal, instance_type_id='1',
+            usage=usage1, raw=raw1, tenant=TENANT_ID_1, rax_options=None,
+            os_architecture=None, os_version=None, os_distro=None)\
+            .AndReturn(exists1)
+        exists2 = self.mox.CreateMockAnything()
+        views.STACKDB.create_instance_exists(
+            message_id=MESSAGE_ID_1, instance=INSTANCE_ID_2,
+            launched_at=launch_decimal,
+            audit_period_beginning=utils.decimal_utc(audit_beginning),
+            audit_period_ending=current_decimal, instance_type_id='1',
+            deleted_at=utils.decimal_utc(deleted_time), delete=delete2,
+            raw=raw2, tenant=TENANT_ID_1, rax_options=None,
+            os_architecture=None, os_version=None, os_distro=None)\
+            .AndReturn(exists2)
+        views.STACKDB.create_instance_exists_batch([exists1, exists2])
+        self.mox.ReplayAll()
+        views.aggregate_exists_batch([(raw1, notif1[1]), (raw2, notif2[1]),
+                                      (raw3, notif3[1])])
+        self.mox.VerifyAll()
@@ -71,9 +71,9 @@ class StacktachDBTestCase(unittest.TestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
+        results.order_by('id').AndReturn(results)
         object = self.mox.CreateMockAnything()
-        results[0].AndReturn(object)
+        results[:2].AndReturn([object])
         self.mox.ReplayAll()
         returned = db._safe_get(Model, **filters)
         self.assertEqual(returned, object)
@@ -86,8 +86,8 @@ class StacktachDBTestCase(unittest.TestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(0)
-        log = self.mox.CreateMockAnything()
+        results.order_by('id').AndReturn(results)
+        results[:2].AndReturn([])
         self.setup_mock_log()
         self.log.warn('No records found for Model get.')
         self.mox.ReplayAll()
@@ -102,11 +102,11 @@ class StacktachDBTestCase(unittest.TestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         Model.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(2)
+        results.order_by('id').AndReturn(results)
+        object = self.mox.CreateMockAnything()
+        results[:2].AndReturn([object, self.mox.CreateMockAnything()])
         self.setup_mock_log()
         self.log.warn('Multiple records found for Model get.')
-        object = self.mox.CreateMockAnything()
-        results[0].AndReturn(object)
         self.mox.ReplayAll()
         returned = db._safe_get(Model, **filters)
         self.assertEqual(returned, object)
@@ -165,7 +165,15 @@ class StacktachDBTestCase(unittest.TestCase):
         self.mox.VerifyAll()
 
     def test_find_lifecycles(self):
-        self._test_db_find_func(models.Lifecycle, db.find_lifecycles)
+        params = {'field1': 'value1', 'field2': 'value2'}
+        results = self.mox.CreateMockAnything()
+        models.Lifecycle.objects.select_related('last_raw')\
+                                .AndReturn(results)
+        results.defer('last_raw__json').AndReturn(results)
+        results.filter(**params).AndReturn(results)
+        self.mox.ReplayAll()
+        self.assertEqual(db.find_lifecycles(**params), results)
+        self.mox.VerifyAll()
 
     def test_find_timings(self):
         self._test_db_find_func(models.Timing, db.find_timings)
@@ -192,13 +200,35 @@ class StacktachDBTestCase(unittest.TestCase):
         self._test_db_get_or_create_func(models.InstanceDeletes,
                                          db.get_or_create_instance_delete)
 
+    def test_upsert_clause_mysql(self):
+        clause = db._upsert_clause('mysql', 't', ['k'], ['a', 'b'], ['b'])
+        self.assertEqual(clause, 'ON DUPLICATE KEY UPDATE a = VALUES(a), '
+                                 'b = COALESCE(t.b, VALUES(b))')
+
+    def test_upsert_clause_sqlite(self):
+        self.mox.StubOutWithMock(db, 'sqlite3')
+        db.sqlite3.sqlite_version_info = (3, 24, 0)
+        clause = db._upsert_clause('sqlite', 't', ['k1', 'k2'], ['a', 'b'],
+                                   ['b'])
+        self.assertEqual(clause, 'ON CONFLICT (k1, k2) DO UPDATE SET '
+                                 'a = excluded.a, '
+                                 'b = COALESCE(t.b, excluded.b)')
+
+        db.sqlite3.sqlite_version_info = (3, 7, 17)
+        self.assertEqual(db._upsert_clause('sqlite', 't', ['k'], ['a'], []),
+                         None)
+
+    def test_upsert_clause_unknown_database(self):
+        self.assertEqual(db._upsert_clause('oracle', 't', ['k'], ['a'], []),
+                         None)
+
     def test_get_instance_usage(self):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         models.InstanceUsage.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
+        results.order_by('id').AndReturn(results)
         usage = self.mox.CreateMockAnything()
-        results[0].AndReturn(usage)
+        results[:2].AndReturn([usage])
         self.mox.ReplayAll()
         returned = db.get_instance_usage(**filters)
         self.assertEqual(returned, usage)
@@ -208,9 +238,9 @@ class StacktachDBTestCase(unittest.TestCase):
         filters = {'field1': 'value1', 'field2': 'value2'}
         results = self.mox.CreateMockAnything()
         models.InstanceDeletes.objects.filter(**filters).AndReturn(results)
-        results.count().AndReturn(1)
+        results.order_by('id').AndReturn(results)
         usage = self.mox.CreateMockAnything()
-        results[0].AndReturn(usage)
+        results[:2].AndReturn([usage])
         self.mox.ReplayAll()
         returned = db.get_instance_delete(**filters)
         self.assertEqual(returned, usage)
@@ -18,10 +18,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import decimal
 import unittest
 
 import mox
 
+from stacktach import compression
 from stacktach import utils as stacktach_utils
 from utils import INSTANCE_ID_1
 from utils import MESSAGE_ID_1
@@ -61,4 +63,65 @@ class StacktachUtilsTestCase(unittest.TestCase):
 
     def test_is_message_id_like_invalid(self):
         uuid = "$-^&#$"
-        self.assertFalse(stacktach_utils.is_request_id_like(uuid))
\ No newline at end of file
+        self.assertFalse(stacktach_utils.is_request_id_like(uuid))
+    def test_load_raw_json_routing_key_and_body(self):
+        raw = self.mox.CreateMockAnything()
+        raw.json = '["monitor.info", {"event_type": "compute.instance.exists"}]'
+        self.mox.ReplayAll()
+        self.assertEqual(stacktach_utils.load_raw_json(raw),
+                         ['monitor.info',
+                          {'event_type': 'compute.instance.exists'}])
+        self.mox.VerifyAll()
+
+    def test_load_raw_json_original_body(self):
+        raw = self.mox.CreateMockAnything()
+        raw.routing_key = 'monitor.error'
+        raw.json = '{"event_type": "compute.instance.exists"}'
+        self.mox.ReplayAll()
+        self.assertEqual(stacktach_utils.load_raw_json(raw),
+                         ['monitor.error',
+                          {'event_type': 'compute.instance.exists'}])
+        self.mox.VerifyAll()
+
+    def test_load_raw_json_compressed(self):
+        raw = self.mox.CreateMockAnything()
+        raw.routing_key = 'monitor.info'
+        raw.json = compression.compress(
+            u'{"event_type": "compute.instance.exists"}')
+        self.mox.ReplayAll()
+        self.assertEqual(stacktach_utils.load_raw_json(raw),
+                         ['monitor.info',
+                          {'event_type': 'compute.instance.exists'}])
+        self.mox.VerifyAll()
+
+    def test_shard_for(self):
+        shards = [stacktach_utils.shard_for(INSTANCE_ID_1, 4)
+                  for i in range(5)]
+        self.assertEqual(len(set(shards)), 1)
+        self.assertTrue(0 <= shards[0] < 4)
+        self.assertEqual(stacktach_utils.shard_for(None, 4), 0)
+
+    def test_str_time_to_unix(self):
+        expected = decimal.Decimal('1370081472.5')
+        for when in ['2013-06-01 10:11:12.5', '2013-06-01 10:11:12.500000',
+                     '2013-06-01T10:11:12.500000', '2013-6-1 10:11:12.5']:
+            actual = stacktach_utils._str_time_to_unix(when)
+            self.assertEqual(actual.as_tuple(), expected.as_tuple())
+
+    def test_str_time_to_unix_no_fraction(self):
+        expected = decimal.Decimal('1370081472')
+        for when in ['2013-06-01 10:11:12', '2013-06-01T10:11:12']:
+            actual = stacktach_utils._str_time_to_unix(when)
+            self.assertEqual(actual.as_tuple(), expected.as_tuple())
+
+    def test_str_time_to_unix_caches(self):
+        self.mox.StubOutWithMock(stacktach_utils, '_str_time_to_unix')
+        stacktach_utils._str_time_to_unix('2013-06-01 10:11:12')\
+                       .AndReturn(decimal.Decimal('1370081472'))
+        self.mox.ReplayAll()
+        stacktach_utils._timestamp_cache.clear()
+        for i in range(2):
+            self.assertEqual(
+                stacktach_utils.str_time_to_unix('2013-06-01 10:11:12'),
+                decimal.Decimal('1370081472'))
+        self.mox.VerifyAll()
@@ -228,6 +228,29 @@ class StackyServerTestCase(unittest.TestCase):
         self.assertEqual(json_resp[2], ['some.event.2'])
         self.mox.VerifyAll()
 
+    def test_do_ingest_counts(self):
+        fake_request = self.mox.CreateMockAnything()
+        fake_request.GET = {'period_from': '1360000000',
+                            'period_to': '1360086400'}
+        counts = [{'deployment__name': 'dep1',
+                   'event': 'compute.instance.update',
+                   'received': 10, 'stored': 4}]
+        self.mox.StubOutWithMock(stacky_server, 'get_ingest_counts')
+        stacky_server.get_ingest_counts('1360000000', '1360086400')\
+                     .AndReturn(counts)
+        self.mox.ReplayAll()
+
+        resp = stacky_server.do_ingest_counts(fake_request)
+
+        self.assertEqual(resp.status_code, 200)
+        json_resp = json.loads(resp.content)
+        self.assertEqual(len(json_resp), 2)
+        self.assertEqual(json_resp[0], ['Deployment', 'Event', 'Received',
+                                        'Stored', 'Dropped'])
+        self.assertEqual(json_resp[1], ['dep1', 'compute.instance.update',
+                                        10, 4, 6])
+        self.mox.VerifyAll()
+
     def test_do_hosts(self):
         fake_request = self.mox.CreateMockAnything()
         host1 = {'host': 'www.demo.com'}
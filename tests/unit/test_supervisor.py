@@ -0,0 +1,261 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import signal
+import unittest
+
+import mox
+
+import worker.supervisor as supervisor
+
+
+class StopProcessesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(supervisor.time, 'time')
+        self.mox.StubOutWithMock(supervisor.os, 'kill')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _process(self, name, pid):
+        process = self.mox.CreateMockAnything()
+        process.name = name
+        process.pid = pid
+        return process
+
+    def test_stop_processes(self):
+        process1 = self._process('worker-1', 101)
+        process2 = self._process('worker-2', 102)
+        process3 = self._process('worker-3', 103)
+        process1.is_alive().AndReturn(True)
+        process1.terminate()
+        process2.is_alive().AndReturn(True)
+        process2.terminate()
+        process3.is_alive().AndReturn(False)
+
+        supervisor.time.time().AndReturn(1000)
+        supervisor.time.time().AndReturn(1000)
+        process1.join(30)
+        supervisor.time.time().AndReturn(1010)
+        process2.join(20)
+        supervisor.time.time().AndReturn(1030)
+        process3.join(0)
+
+        process1.is_alive().AndReturn(False)
+        process2.is_alive().AndReturn(True)
+        supervisor.os.kill(102, signal.SIGKILL)
+        process2.join()
+        process3.is_alive().AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertEqual(supervisor.stop_processes(
+                         [process1, process2, process3], 30), [process2])
+        self.mox.VerifyAll()
+
+
+class ConsumerGroupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(supervisor, 'stop_processes')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_shares(self):
+        self.assertEqual(supervisor.shares(1, 4), [[0, 1, 2, 3]])
+        self.assertEqual(supervisor.shares(3, 8),
+                         [[0, 3, 6], [1, 4, 7], [2, 5]])
+        self.assertEqual(supervisor.shares(4, 4), [[0], [1], [2], [3]])
+
+    def test_resize(self):
+        started = []
+        def start(shards):
+            started.append(shards)
+            return 'consumer-%d' % len(started)
+        group = supervisor.ConsumerGroup('test', 4, start, 30)
+        supervisor.stop_processes([], 30)
+        supervisor.stop_processes(['consumer-1', 'consumer-2'], 30)
+        self.mox.ReplayAll()
+
+        group.resize(2)
+        self.assertEqual(group.processes, ['consumer-1', 'consumer-2'])
+        group.resize(3)
+        self.assertEqual(group.processes,
+                         ['consumer-3', 'consumer-4', 'consumer-5'])
+        self.assertEqual(started, [[0, 2], [1, 3], [0, 3], [1], [2]])
+        self.mox.VerifyAll()
+
+
+class QueueDepthsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(supervisor.requests, 'get')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_get(self):
+        response = self.mox.CreateMockAnything()
+        supervisor.requests.get('http://rabbit:15672/api/queues/%2F',
+                                auth=('user', 'pass'),
+                                params={'columns': 'name,messages'},
+                                timeout=10).AndReturn(response)
+        response.raise_for_status()
+        response.json().AndReturn([{'name': 'monitor.info', 'messages': 12},
+                                   {'name': 'monitor.error'}])
+        self.mox.ReplayAll()
+        depths = supervisor.QueueDepths('http://rabbit:15672/', 'user',
+                                        'pass')
+        self.assertEqual(depths.get(), {'monitor.info': 12,
+                                        'monitor.error': 0})
+        self.mox.VerifyAll()
+
+    def test_local_queue_depths(self):
+        depths = supervisor.LocalQueueDepths({'monitor.info': 5})
+        depths.set('monitor.error', 2)
+        self.assertEqual(depths.get(), {'monitor.info': 5,
+                                        'monitor.error': 2})
+
+
+class AutoscalerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.group = self.mox.CreateMockAnything()
+        self.depths = supervisor.LocalQueueDepths()
+        self.autoscaler = supervisor.Autoscaler(
+            'test', self.depths, ['a', 'b'], self.group, 1, 4, 1000, 100,
+            polls=2, interval=30, cooldown=300)
+        self.autoscaler.last_change = 0
+        self.mox.StubOutWithMock(supervisor.time, 'time')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_thresholds_must_not_overlap(self):
+        self.assertRaises(ValueError, supervisor.Autoscaler, 'test',
+                          self.depths, [], self.group, 1, 4, 100, 100)
+
+    def test_grows_to_what_the_backlog_needs(self):
+        self.depths.set('b', 500)
+        self.depths.set('other', 100000)
+        self.group.resize(3)
+        supervisor.time.time().MultipleTimes().AndReturn(1000)
+        self.mox.ReplayAll()
+        self.depths.set('a', 2000)
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 1)
+        self.depths.set('a', 2400)
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 3)
+        self.mox.VerifyAll()
+
+    def test_grows_no_further_than_maximum(self):
+        self.autoscaler.polls = 1
+        self.group.resize(4)
+        supervisor.time.time().MultipleTimes().AndReturn(1000)
+        self.mox.ReplayAll()
+        self.depths.set('a', 50000)
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 4)
+        self.depths.set('a', 50000)
+        self.autoscaler.check()
+        self.mox.VerifyAll()
+
+    def test_shrinks_one_at_a_time(self):
+        self.autoscaler.consumers = 3
+        self.group.resize(2)
+        supervisor.time.time().MultipleTimes().AndReturn(1000)
+        self.mox.ReplayAll()
+        self.depths.set('a', 50)
+        self.autoscaler.check()
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 2)
+        self.mox.VerifyAll()
+
+    def test_hysteresis(self):
+        self.autoscaler.consumers = 2
+        self.mox.ReplayAll()
+        # Between the two thresholds nothing changes.
+        for depth in [1500, 250, 1999, 200]:
+            self.depths.set('a', depth)
+            self.autoscaler.check()
+        # Nor does a spike that doesn't last.
+        for depth in [5000, 1500, 5000, 1500]:
+            self.depths.set('a', depth)
+            self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 2)
+        self.mox.VerifyAll()
+
+    def test_cooldown(self):
+        self.autoscaler.polls = 1
+        self.autoscaler.last_change = 900
+        supervisor.time.time().AndReturn(1000)
+        supervisor.time.time().AndReturn(1200)
+        self.group.resize(2)
+        supervisor.time.time().AndReturn(1200)
+        self.mox.ReplayAll()
+        self.depths.set('a', 1500)
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 1)
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 2)
+        self.assertEqual(self.autoscaler.last_change, 1200)
+        self.mox.VerifyAll()
+
+    def test_poll_checks_every_interval(self):
+        self.autoscaler.polls = 1
+        supervisor.time.time().AndReturn(1000)
+        self.group.resize(2)
+        supervisor.time.time().AndReturn(1000)
+        supervisor.time.time().AndReturn(1000)
+        supervisor.time.time().AndReturn(1029)
+        self.mox.ReplayAll()
+        self.depths.set('a', 1500)
+        self.autoscaler.poll()
+        self.autoscaler.poll()
+        self.assertEqual(self.autoscaler.consumers, 2)
+        self.mox.VerifyAll()
+
+    def test_check_carries_on_without_depths(self):
+        depths = self.mox.CreateMockAnything()
+        depths.get().AndRaise(Exception('Connection refused'))
+        self.mox.ReplayAll()
+        self.autoscaler.depths = depths
+        self.autoscaler.check()
+        self.assertEqual(self.autoscaler.consumers, 1)
+        self.mox.VerifyAll()
+
+    def test_autoscaler(self):
+        config = {'name': 'test', 'rabbit_host': 'rabbit', 'min_consumers': 2,
+                  'max_consumers': 3, 'priority_events': ['compute.exists'],
+                  'scale_up_depth': 500, 'scale_down_depth': 50}
+        autoscaler = supervisor.autoscaler(config, None, 60)
+        self.assertEqual(autoscaler.depths.url, 'http://rabbit:15672')
+        self.assertEqual(autoscaler.group.shards, 3)
+        self.assertEqual(autoscaler.group.timeout, 60)
+        self.assertEqual((autoscaler.consumers, autoscaler.maximum), (2, 3))
+        self.assertEqual((autoscaler.scale_up_depth,
+                          autoscaler.scale_down_depth), (500, 50))
+        self.assertEqual(len(autoscaler.queues), 12)
+        self.assertEqual(autoscaler.queues[:4],
+                         ['monitor.info.shard.0',
+                          'monitor.info.shard.0.priority',
+                          'monitor.error.shard.0',
+                          'monitor.error.shard.0.priority'])
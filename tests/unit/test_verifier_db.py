@@ -740,6 +740,34 @@ class VerifierTestCase(unittest.TestCase):
                                               routing_keys=routing_keys)
         self.mox.VerifyAll()
 
+    def test_send_verified_notification_original_json(self):
+        connection = self.mox.CreateMockAnything()
+        exchange = self.mox.CreateMockAnything()
+        exist = self.mox.CreateMockAnything()
+        exist.raw = self.mox.CreateMockAnything()
+        exist.raw.routing_key = 'monitor.info'
+        exist.raw.json = json.dumps({'event_type': 'test',
+                                     'message_id': 'some_uuid'})
+        self.mox.StubOutWithMock(kombu.pools, 'producers')
+        self.mox.StubOutWithMock(kombu.common, 'maybe_declare')
+        producer = self.mox.CreateMockAnything()
+        producer.channel = self.mox.CreateMockAnything()
+        kombu.pools.producers[connection].AndReturn(producer)
+        producer.acquire(block=True).AndReturn(producer)
+        producer.__enter__().AndReturn(producer)
+        kombu.common.maybe_declare(exchange, producer.channel)
+        self.mox.StubOutWithMock(uuid, 'uuid4')
+        uuid.uuid4().AndReturn('some_other_uuid')
+        message = {'event_type': 'compute.instance.exists.verified.old',
+                   'message_id': 'some_other_uuid',
+                   'original_message_id': 'some_uuid'}
+        producer.publish(message, 'monitor.info')
+        producer.__exit__(None, None, None)
+        self.mox.ReplayAll()
+
+        dbverifier.send_verified_notification(exist, exchange, connection)
+        self.mox.VerifyAll()
+
     def test_run_notifications(self):
         self.mox.StubOutWithMock(dbverifier, '_create_exchange')
         exchange = self.mox.CreateMockAnything()
@@ -18,6 +18,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import collections
 import json
 import unittest
 
@@ -26,13 +27,19 @@ import kombu.entity
 import kombu.connection
 import mox
 
-from stacktach import db, views
+from stacktach import compression
+from stacktach import dead_letter
+from stacktach import message_dedup
+from stacktach import db, utils, views
+from tests.unit.utils import INSTANCE_ID_1
+from tests.unit.utils import REQUEST_ID_1
 import worker.worker as worker
 
 
 class NovaConsumerTestCase(unittest.TestCase):
     def setUp(self):
         self.mox = mox.Mox()
+        self.mox.stubs.Set(worker, '_install_signal_handlers', lambda: None)
 
     def tearDown(self):
         self.mox.UnsetStubs()
@@ -69,6 +76,86 @@ class NovaConsumerTestCase(unittest.TestCase):
         self.assertTrue(consumer.on_nova in created_callbacks)
         self.mox.VerifyAll()
 
+    def test_get_consumers_for_shard(self):
+        created_queues = []
+        def Consumer(queues=None, callbacks=None):
+            created_queues.extend(queues)
+            return self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(worker.NovaConsumer, '_create_exchange')
+        self.mox.StubOutWithMock(worker.NovaConsumer, '_create_queue')
+        consumer = worker.NovaConsumer('test', None, None, True, {}, shard=3)
+        exchange = self.mox.CreateMockAnything()
+        consumer._create_exchange('stacktach.shards', 'direct')\
+                .AndReturn(exchange)
+        info_queue = self.mox.CreateMockAnything()
+        error_queue = self.mox.CreateMockAnything()
+        consumer._create_queue('monitor.info.shard.3', exchange,
+                               'monitor.info.shard.3').AndReturn(info_queue)
+        consumer._create_queue('monitor.error.shard.3', exchange,
+                               'monitor.error.shard.3').AndReturn(error_queue)
+        self.mox.ReplayAll()
+        consumer.get_consumers(Consumer, None)
+        self.assertEqual(created_queues, [info_queue, error_queue])
+        self.mox.VerifyAll()
+
+    def test_get_consumers_for_shards(self):
+        created_queues = []
+        def Consumer(queues=None, callbacks=None):
+            created_queues.extend(queues)
+            return self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(worker.NovaConsumer, '_create_exchange')
+        self.mox.StubOutWithMock(worker.NovaConsumer, '_create_queue')
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       shard=[1, 3])
+        exchange = self.mox.CreateMockAnything()
+        consumer._create_exchange('stacktach.shards', 'direct')\
+                .AndReturn(exchange)
+        queues = []
+        for key in ['monitor.info.shard.1', 'monitor.error.shard.1',
+                    'monitor.info.shard.3', 'monitor.error.shard.3']:
+            queue = self.mox.CreateMockAnything()
+            consumer._create_queue(key, exchange, key).AndReturn(queue)
+            queues.append(queue)
+        self.mox.ReplayAll()
+        consumer.get_consumers(Consumer, None)
+        self.assertEqual(created_queues, queues)
+        self.mox.VerifyAll()
+
+    def test_prefetch_count(self):
+        self.assertEqual(worker._prefetch_count({'batch_size': 50}), 0)
+        self.assertEqual(worker._prefetch_count(
+            {'batch_size': 50, 'commit_latency_target_ms': 100}), 500)
+        self.assertEqual(worker._prefetch_count(
+            {'batch_size': 50, 'commit_latency_target_ms': 100,
+             'prefetch_count': 200}), 200)
+        self.assertEqual(worker._prefetch_count(
+            {'batch_size': 50,
+             'priority_events': ['compute.instance.exists']}), 500)
+        self.assertEqual(worker._spool_prefetch_count(
+            {'batch_size': 50, 'commit_latency_target_ms': 100}), 0)
+        self.assertEqual(worker._spool_prefetch_count(
+            {'prefetch_count': 2000}), 2000)
+
+    def test_shard_count(self):
+        self.assertEqual(worker.shard_count({}), 1)
+        self.assertEqual(worker.shard_count({'consumers': 4}), 4)
+        self.assertEqual(worker.shard_count({'consumers': 4,
+                                             'max_consumers': 8}), 8)
+        # Not autoscaled, so only the fixed consumers' shards.
+        self.assertEqual(worker.shard_count({'consumers': 2,
+                                             'max_consumers': 8,
+                                             'spool_dir': '/tmp'}), 2)
+        self.assertEqual(worker.shard_count({'consumers': 2,
+                                             'min_consumers': 4,
+                                             'max_consumers': 4}), 2)
+
+    def test_autoscaling(self):
+        config = {'min_consumers': 2, 'max_consumers': 3}
+        self.assertTrue(worker.autoscaling(config))
+        self.assertFalse(worker.autoscaling({'consumers': 3}))
+        self.assertFalse(worker.autoscaling(dict(config, max_consumers=2)))
+        self.assertFalse(worker.autoscaling(dict(config, spool_dir='/tmp')))
+
     def test_create_exchange(self):
         args = {'key': 'value'}
         consumer = worker.NovaConsumer('test', None, None, True, args)
@@ -137,6 +224,46 @@ class NovaConsumerTestCase(unittest.TestCase):
         self.assertEqual(consumer.processed, 1)
         self.mox.VerifyAll()
 
+    def test_process_drops_recent_duplicate(self):
+        dedup = message_dedup.MessageDedup(10)
+        dedup.add('message-1')
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       dedup=dedup)
+        message = self._create_message('monitor.info',
+                                       {u'message_id': u'message-1'})
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        message.ack()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 0)
+        self.assertEqual(dedup.duplicates, 1)
+        self.mox.VerifyAll()
+
+    def test_process_duplicate_from_db(self):
+        deployment = self.mox.CreateMockAnything()
+        dedup = message_dedup.MessageDedup(10)
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       dedup=dedup)
+        body_dict = {u'message_id': u'message-1'}
+        message = self._create_message('monitor.info', body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = ('monitor.info', body_dict)
+        views.process_raw_data(deployment, args, json.dumps(args))\
+             .AndRaise(message_dedup.DuplicateMessage('message-1'))
+        message.ack()
+        self.mox.StubOutWithMock(views, 'post_process')
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 0)
+        self.assertEqual(dedup.duplicates, 1)
+        self.assertTrue(dedup.is_duplicate('message-1'))
+        self.mox.VerifyAll()
+
     def test_process_no_raw_dont_ack(self):
         deployment = self.mox.CreateMockAnything()
         raw = self.mox.CreateMockAnything()
@@ -160,6 +287,765 @@ class NovaConsumerTestCase(unittest.TestCase):
         self.assertEqual(consumer.processed, 0)
         self.mox.VerifyAll()
 
+    def test_process_store_original_json(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        message = self.mox.CreateMockAnything()
+
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       store_original_json=True)
+        routing_key = 'monitor.info'
+        message.delivery_info = {'routing_key': routing_key}
+        body_dict = {u'key': u'value'}
+        message.body = json.dumps(body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = (routing_key, body_dict)
+        views.process_raw_data(deployment, args, message.body)\
+             .AndReturn(raw)
+        message.ack()
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raw, body_dict)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_message_args_compress_json(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       compress_json=True)
+        body_dict = {u'key': u'value'}
+        message = self._create_message('monitor.info', body_dict)
+        self.mox.ReplayAll()
+        args, json_args = consumer._message_args(message)
+        self.assertEqual(args, ('monitor.info', body_dict))
+        self.assertTrue(compression.is_compressed(json_args))
+        self.assertEqual(json.loads(compression.decompress(json_args)),
+                         ['monitor.info', body_dict])
+        self.mox.VerifyAll()
+
+    def test_process_shard_routing_key(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        message = self.mox.CreateMockAnything()
+
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       shard=2)
+        message.delivery_info = {'routing_key': 'monitor.error.shard.2'}
+        body_dict = {u'key': u'value'}
+        message.body = json.dumps(body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        args = ('monitor.error', body_dict)
+        views.process_raw_data(deployment, args, json.dumps(args))\
+             .AndReturn(raw)
+        message.ack()
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raw, body_dict)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.mox.VerifyAll()
+
+    def _create_message(self, routing_key, body_dict, delivery_tag=1):
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': routing_key}
+        message.body = json.dumps(body_dict)
+        message.delivery_tag = delivery_tag
+        message.channel = self.mox.CreateMockAnything()
+        return message
+
+    def test_on_nova_batches_messages(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=2, batch_timeout=1)
+        message1 = self._create_message('monitor.info', {u'key': u'value'})
+        message2 = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        consumer._process_batch()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message1)
+        self.assertEqual(consumer.batch, [message1])
+        consumer.on_nova(None, message2)
+        self.assertEqual(consumer.batch, [message1, message2])
+        self.mox.VerifyAll()
+
+    def test_on_iteration_processes_expired_batch(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=10, batch_timeout=1)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        consumer.batch = [message]
+        consumer.batch_started = 100
+        self.mox.StubOutWithMock(worker.time, 'time')
+        worker.time.time().AndReturn(100.5)
+        worker.time.time().AndReturn(101)
+        self.mox.StubOutWithMock(consumer, '_process_batch')
+        consumer._process_batch()
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        consumer.on_iteration()
+        self.mox.VerifyAll()
+
+    def test_process_batch(self):
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=3, batch_timeout=1)
+        body_dict = {u'key': u'value'}
+        message1 = self._create_message('monitor.info', body_dict, 1)
+        message2 = self._create_message('monitor.error', body_dict, 2)
+        message3 = self._create_message('monitor.info', body_dict, 3)
+        consumer.batch = [message1, message2, message3]
+        args1 = ('monitor.info', body_dict)
+        args2 = ('monitor.error', body_dict)
+        batch = [(args1, json.dumps(args1)), (args2, json.dumps(args2)),
+                 (args1, json.dumps(args1))]
+        raw1 = self.mox.CreateMockAnything()
+        raw3 = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, batch)\
+             .AndReturn([raw1, None, raw3])
+        commit.__exit__(None, None, None).AndReturn(None)
+        message3.channel.basic_ack(3, multiple=True)
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raw1, body_dict)
+        views.post_process(raw3, body_dict)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.processed, 2)
+        self.assertEqual(consumer.batch, [])
+        self.mox.VerifyAll()
+
+    def test_process_batch_drops_recent_duplicates(self):
+        deployment = self.mox.CreateMockAnything()
+        dedup = message_dedup.MessageDedup(10)
+        dedup.add('message-1')
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=3, batch_timeout=1,
+                                       dedup=dedup)
+        body1 = {u'message_id': u'message-1'}
+        body2 = {u'message_id': u'message-2'}
+        message1 = self._create_message('monitor.info', body1, 1)
+        message2 = self._create_message('monitor.info', body2, 2)
+        consumer.batch = [message1, message2]
+        args2 = ('monitor.info', body2)
+        raw2 = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment,
+                                     [(args2, json.dumps(args2))])\
+             .AndReturn([raw2])
+        commit.__exit__(None, None, None).AndReturn(None)
+        message2.channel.basic_ack(2, multiple=True)
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raw2, body2)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.processed, 1)
+        self.assertTrue(dedup.is_duplicate('message-2'))
+        self.mox.VerifyAll()
+
+    def test_process_batch_aggregates_exists_together(self):
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=3, batch_timeout=1)
+        body_dict = {u'key': u'value'}
+        message1 = self._create_message('monitor.info', body_dict, 1)
+        message2 = self._create_message('monitor.info', body_dict, 2)
+        message3 = self._create_message('monitor.info', body_dict, 3)
+        consumer.batch = [message1, message2, message3]
+        raw1 = self.mox.CreateMockAnything()
+        raw1.instance = INSTANCE_ID_1
+        raw1.event = 'compute.instance.exists'
+        raw2 = self.mox.CreateMockAnything()
+        raw2.instance = INSTANCE_ID_1
+        raw2.event = 'compute.instance.delete.end'
+        raw3 = self.mox.CreateMockAnything()
+        raw3.instance = INSTANCE_ID_1
+        raw3.event = 'compute.instance.exists'
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, mox.IgnoreArg())\
+             .AndReturn([raw1, raw2, raw3])
+        commit.__exit__(None, None, None).AndReturn(None)
+        message3.channel.basic_ack(3, multiple=True)
+        self.mox.StubOutWithMock(views, 'aggregate_lifecycle')
+        self.mox.StubOutWithMock(views, 'post_process')
+        self.mox.StubOutWithMock(views, 'aggregate_exists_batch')
+        views.aggregate_lifecycle(raw1)
+        views.post_process(raw2, body_dict)
+        views.aggregate_lifecycle(raw3)
+        views.aggregate_exists_batch([(raw1, body_dict), (raw3, body_dict)])
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.processed, 3)
+        self.mox.VerifyAll()
+
+    def test_process_batch_stores_one_at_a_time_when_batch_fails(self):
+        deployment = self.mox.CreateMockAnything()
+        dead_letters = self.mox.CreateMock(dead_letter.DeadLetters)
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=2, batch_timeout=1,
+                                       dead_letters=dead_letters)
+        body_dict = {u'key': u'value'}
+        message1 = self._create_message('monitor.info', body_dict, 1)
+        message2 = self._create_message('monitor.info', body_dict, 2)
+        consumer.batch = [message1, message2]
+        args = ('monitor.info', body_dict)
+        batch = [(args, json.dumps(args)), (args, json.dumps(args))]
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, batch)\
+             .AndRaise(ValueError('bad message'))
+        commit.__exit__(ValueError, mox.IgnoreArg(), mox.IgnoreArg())\
+              .AndReturn(False)
+        self.mox.StubOutWithMock(consumer, '_process_or_park')
+        consumer._process_or_park(message1)
+        consumer._process_or_park(message2)
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.batch, [])
+        self.mox.VerifyAll()
+
+    def test_process_batch_raises_without_dead_letters(self):
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=2, batch_timeout=1)
+        consumer.batch = [self._create_message('monitor.info', {}, 1)]
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, mox.IgnoreArg())\
+             .AndRaise(ValueError('bad message'))
+        commit.__exit__(ValueError, mox.IgnoreArg(), mox.IgnoreArg())\
+              .AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertRaises(ValueError, consumer._process_batch)
+        self.mox.VerifyAll()
+
+    def test_on_nova_parks_failing_message(self):
+        dead_letters = self.mox.CreateMock(dead_letter.DeadLetters)
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       shard=1, dead_letters=dead_letters)
+        message = self._create_message(
+            worker.shard_routing_key('monitor.info', 1), {u'key': u'value'})
+        dead_letters.attempt(consumer._process, message, 'monitor.info')\
+                    .AndReturn(True)
+        message.ack()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message)
+        self.mox.VerifyAll()
+
+    def test_process_parks_message_that_fails_post_processing(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        dead_letters = self.mox.CreateMock(dead_letter.DeadLetters)
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       dead_letters=dead_letters)
+        body_dict = {u'key': u'value'}
+        message = self._create_message('monitor.info', body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, mox.IgnoreArg(), mox.IgnoreArg())\
+             .AndReturn(raw)
+        message.ack()
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raw, body_dict).AndRaise(ValueError('bad'))
+        self.mox.StubOutWithMock(worker.transaction,
+                                 'rollback_unless_managed')
+        worker.transaction.rollback_unless_managed()
+        dead_letters.park('monitor.info', message.body,
+                          mox.StrContains('ValueError: bad'), 1, raw=raw)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.assertEqual(consumer.processed, 1)
+        self.mox.VerifyAll()
+
+    def test_process_raises_pipeline_errors_rather_than_parking(self):
+        deployment = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        dead_letters = self.mox.CreateMock(dead_letter.DeadLetters)
+        post_process = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       pipeline=post_process,
+                                       dead_letters=dead_letters)
+        body_dict = {u'key': u'value'}
+        message = self._create_message('monitor.info', body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, mox.IgnoreArg(), mox.IgnoreArg())\
+             .AndReturn(raw)
+        message.ack()
+        post_process.put(raw, body_dict).AndRaise(
+            worker.pipeline.PipelineException('Post processing worker 0 '
+                                              'died'))
+        self.mox.ReplayAll()
+        self.assertRaises(worker.pipeline.PipelineException,
+                          consumer._process, message)
+        self.mox.VerifyAll()
+
+    def test_dead_letters_are_opt_in(self):
+        self.assertEqual(worker._dead_letters({}, None), None)
+        dead_letters = worker._dead_letters({'dead_letter_attempts': 3},
+                                            None)
+        self.assertEqual(dead_letters.attempts, 3)
+
+    def test_ack_batch_one_at_a_time(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=2, batch_timeout=1)
+        message1 = self._create_message('monitor.info', {}, 1)
+        message2 = self._create_message('monitor.info', {}, 2)
+        message2.channel.basic_ack(2, multiple=True).AndRaise(TypeError())
+        message1.ack()
+        message2.ack()
+        self.mox.ReplayAll()
+        consumer._ack_batch([message1, message2])
+        self.mox.VerifyAll()
+
+    def test_process_batch_flushes_lifecycle_writer(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=3, batch_timeout=1)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        consumer.batch = [message]
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(None, mox.IgnoreArg())\
+             .AndReturn([None])
+        commit.__exit__(None, None, None).AndReturn(None)
+        message.channel.basic_ack(mox.IgnoreArg(), multiple=True)
+        self.mox.StubOutWithMock(views, 'LIFECYCLE_WRITER')
+        views.LIFECYCLE_WRITER.flush()
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.mox.VerifyAll()
+
+    def test_process_batch_carries_on_after_post_processing_fails(self):
+        deployment = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       batch_size=3, batch_timeout=1)
+        messages = [self._create_message('monitor.info',
+                                         {u'message_id': u'm%d' % i}, i)
+                    for i in range(1, 4)]
+        consumer.batch = list(messages)
+        raws = []
+        for i in range(1, 4):
+            raw = self.mox.CreateMockAnything()
+            raw.id = i
+            raw.instance = None
+            raws.append(raw)
+        self.mox.StubOutWithMock(worker.transaction, 'commit_on_success')
+        commit = self.mox.CreateMockAnything()
+        worker.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        self.mox.StubOutWithMock(views, 'process_raw_data_batch',
+                                 use_mock_anything=True)
+        views.process_raw_data_batch(deployment, mox.IgnoreArg())\
+             .AndReturn(raws)
+        commit.__exit__(None, None, None).AndReturn(None)
+        messages[2].channel.basic_ack(3, multiple=True)
+        self.mox.StubOutWithMock(views, 'post_process')
+        views.post_process(raws[0], {u'message_id': u'm1'})
+        views.post_process(raws[1], {u'message_id': u'm2'})\
+             .AndRaise(ValueError('bad'))
+        self.mox.StubOutWithMock(worker.transaction,
+                                 'rollback_unless_managed')
+        worker.transaction.rollback_unless_managed()
+        views.post_process(raws[2], {u'message_id': u'm3'})
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        logged = []
+        self.mox.stubs.Set(worker.LOG, 'error', logged.append)
+        self.mox.ReplayAll()
+        consumer._process_batch()
+        self.assertEqual(consumer.processed, 3)
+        self.assertEqual(len(logged), 1)
+        self.assertTrue('post processing raw 2 failed' in logged[0])
+        self.assertTrue('ValueError: bad' in logged[0])
+        self.mox.VerifyAll()
+
+    def test_on_iteration_and_consume_end_flush_lifecycle_writer(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {})
+        self.mox.StubOutWithMock(views, 'LIFECYCLE_WRITER')
+        views.LIFECYCLE_WRITER.maybe_flush()
+        views.LIFECYCLE_WRITER.flush()
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        consumer.on_consume_end(None, None)
+        self.mox.VerifyAll()
+
+    def test_on_iteration_and_consume_end_flush_ingest_counts(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {})
+        self.mox.StubOutWithMock(views, 'INGEST_POLICY')
+        views.INGEST_POLICY.maybe_flush()
+        views.INGEST_POLICY.flush()
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        consumer.on_consume_end(None, None)
+        self.mox.VerifyAll()
+
+    def test_setup_ingest_policy(self):
+        self.mox.stubs.Set(views, 'INGEST_POLICY', None)
+        deployment = self.mox.CreateMockAnything()
+        worker._setup_ingest_policy({'name': 'test'}, deployment)
+        self.assertEqual(views.INGEST_POLICY, None)
+
+        config = {'name': 'test',
+                  'ingest_policies': {'compute.instance.update': 'count'},
+                  'ingest_count_interval_secs': 30}
+        worker._setup_ingest_policy(config, deployment)
+        self.assertEqual(views.INGEST_POLICY.deployment, deployment)
+        self.assertEqual(views.INGEST_POLICY.interval, 30)
+        self.assertEqual(views.INGEST_POLICY.policies,
+                         {'compute.instance.update': ('count', None)})
+
+    def test_on_nova_spools_messages(self):
+        message_spool = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=10, spool=message_spool,
+                                       spool_sync=1)
+        message1 = self._create_message('monitor.info', {u'key': u'value'},
+                                        1)
+        message2 = self._create_message('monitor.info', {u'key': u'value'},
+                                        2)
+        message_spool.append('monitor.info', message1.body)
+        message_spool.append('monitor.info', message2.body)
+        self.mox.StubOutWithMock(worker.time, 'time')
+        worker.time.time().AndReturn(100)
+        worker.time.time().AndReturn(100.5)
+        worker.time.time().AndReturn(101)
+        message_spool.sync()
+        message2.channel.basic_ack(2, multiple=True)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message1)
+        consumer.on_nova(None, message2)
+        consumer.on_iteration()
+        self.assertEqual(consumer.spooled, [message1, message2])
+        consumer.on_iteration()
+        self.assertEqual(consumer.spooled, [])
+        consumer.on_consume_end(None, None)
+        self.mox.VerifyAll()
+
+    def test_open_spool(self):
+        self.mox.StubOutClassWithMocks(worker.spool, 'Spool')
+        worker.spool.Spool('/var/spool/stacktach/test/shard2',
+                           32 * 1024 * 1024)
+        self.mox.ReplayAll()
+        self.assertEqual(worker._open_spool({'name': 'test'}), None)
+        config = {'name': 'test', 'spool_dir': '/var/spool/stacktach',
+                  'spool_segment_mb': 32}
+        worker._open_spool(config, shard=2)
+        self.mox.VerifyAll()
+
+    def test_open_spool_for_shards(self):
+        self.mox.StubOutClassWithMocks(worker.spool, 'Spool')
+        worker.spool.Spool('/var/spool/stacktach/test/shard1-3',
+                           64 * 1024 * 1024)
+        self.mox.ReplayAll()
+        config = {'name': 'test', 'spool_dir': '/var/spool/stacktach'}
+        worker._open_spool(config, shard=[1, 3])
+        self.mox.VerifyAll()
+
+    def test_request_stop(self):
+        consumer1 = self.mox.CreateMockAnything()
+        consumer1.should_stop = False
+        consumer2 = self.mox.CreateMockAnything()
+        consumer2.should_stop = False
+        self.mox.stubs.Set(worker, '_current_consumers',
+                           {'test1': consumer1, 'test2': consumer2})
+        self.mox.stubs.Set(worker, '_stop_requested', False)
+        self.assertTrue(worker.continue_running())
+        worker._request_stop(15, None)
+        self.assertTrue(consumer1.should_stop)
+        self.assertTrue(consumer2.should_stop)
+        self.assertFalse(worker.continue_running())
+
+    def test_priority_consumers(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       batch_size=10, shard=2,
+                                       priority_events=[
+                                           'compute.instance.exists'],
+                                       priority_weight=3, prefetch=20)
+        Consumer = self.mox.CreateMockAnything()
+        priority = self.mox.CreateMockAnything()
+        other = self.mox.CreateMockAnything()
+
+        def queue_names(*names):
+            return mox.Func(lambda queues: [q.name for q in queues] ==
+                            list(names))
+
+        Consumer(queues=queue_names('monitor.info.shard.2.priority',
+                                    'monitor.error.shard.2.priority'),
+                 callbacks=[consumer.on_nova]).AndReturn(priority)
+        Consumer(queues=queue_names('monitor.info.shard.2',
+                                    'monitor.error.shard.2'),
+                 callbacks=[consumer.on_nova]).AndReturn(other)
+        priority.qos(prefetch_count=60)
+        priority.consume()
+        other.qos(prefetch_count=20)
+        other.consume()
+        self.mox.ReplayAll()
+        self.assertEqual(consumer.get_consumers(Consumer, None),
+                         [priority, other])
+        self.mox.VerifyAll()
+
+    def test_on_consume_ready_sets_prefetch(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       prefetch=50)
+        channel = self.mox.CreateMockAnything()
+        channel.basic_qos(0, 50, True)
+        self.mox.ReplayAll()
+        consumer.on_consume_ready(None, channel, [])
+        self.assertEqual(consumer.channel, channel)
+        self.mox.VerifyAll()
+
+    def test_on_consume_ready_leaves_room_for_priority_consumers(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       shard=1, prefetch=20,
+                                       priority_events=[
+                                           'compute.instance.exists'],
+                                       priority_weight=3)
+        channel = self.mox.CreateMockAnything()
+        channel.basic_qos(0, 80, True)
+        self.mox.ReplayAll()
+        consumer.on_consume_ready(None, channel, [])
+        self.mox.VerifyAll()
+
+    def test_on_consume_ready_uses_flow_prefetch(self):
+        flow = self.mox.CreateMockAnything()
+        flow.prefetch = 20
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       prefetch=50, flow=flow)
+        channel = self.mox.CreateMockAnything()
+        channel.basic_qos(0, 20, True)
+        self.mox.ReplayAll()
+        consumer.on_consume_ready(None, channel, [])
+        self.mox.VerifyAll()
+
+    def test_on_iteration_applies_backpressure(self):
+        flow = self.mox.CreateMockAnything()
+        flow.paused = False
+        flow.interval = 1
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       flow=flow)
+        consumer.channel = self.mox.CreateMockAnything()
+
+        def pause():
+            flow.paused = True
+
+        def resume():
+            flow.paused = False
+
+        flow.adjust().WithSideEffects(pause).AndReturn(20)
+        consumer.channel.basic_qos(0, 20, True)
+        self.mox.StubOutWithMock(worker.time, 'sleep')
+        worker.time.sleep(1)
+        flow.probe()
+        flow.adjust().AndReturn(None)
+        worker.time.sleep(1)
+        flow.probe()
+        flow.adjust().WithSideEffects(resume).AndReturn(30)
+        consumer.channel.basic_qos(0, 30, True)
+        self.mox.ReplayAll()
+        consumer.on_iteration()
+        self.mox.VerifyAll()
+
+    def test_process_records_commit_latency(self):
+        deployment = self.mox.CreateMockAnything()
+        flow = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       flow=flow)
+        body_dict = {u'key': u'value'}
+        message = self._create_message('monitor.info', body_dict)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, mox.IgnoreArg(),
+                               mox.IgnoreArg()).AndReturn(None)
+        flow.record(mox.IsA(float))
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.mox.VerifyAll()
+
+    def test_record_stats_records_ingest_lag(self):
+        consumer = worker.NovaConsumer('test', None, None, True, {},
+                                       priority_events=[
+                                           'compute.instance.exists'])
+        consumer.lag = self.mox.CreateMockAnything()
+        raw = self.mox.CreateMockAnything()
+        raw.instance = INSTANCE_ID_1
+        raw.when = 1234
+        consumer.lag.record('compute.instance.exists', 1234)
+        self.mox.ReplayAll()
+        consumer._record_stats(raw, {'event_type': 'compute.instance.exists'},
+                               [])
+        consumer._record_stats(None, {'event_type': 'compute.instance.exists'},
+                               [])
+        self.mox.VerifyAll()
+
+    def test_views_state(self):
+        self.mox.stubs.Set(views, 'LIFECYCLE_CACHE', None)
+        self.mox.stubs.Set(views, 'LIFECYCLE_WRITER', None)
+        self.mox.stubs.Set(views, 'INGEST_POLICY', None)
+        cache = self.mox.CreateMockAnything()
+        policy = self.mox.CreateMockAnything()
+        state = worker.ViewsState()
+        state.lifecycle_cache = cache
+        with state:
+            self.assertEqual(views.LIFECYCLE_CACHE, cache)
+            self.assertEqual(views.INGEST_POLICY, None)
+            views.INGEST_POLICY = policy
+        self.assertEqual(state.lifecycle_cache, cache)
+        self.assertEqual(state.ingest_policy, policy)
+
+        other = worker.ViewsState()
+        with other:
+            self.assertEqual(views.LIFECYCLE_CACHE, None)
+            self.assertEqual(views.INGEST_POLICY, None)
+        with state:
+            self.assertEqual(views.INGEST_POLICY, policy)
+
+    def test_on_nova_uses_views_state(self):
+        deployment = self.mox.CreateMockAnything()
+        views_state = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       views_state=views_state)
+        message = self._create_message('monitor.info', {u'key': u'value'})
+        self.mox.StubOutWithMock(consumer, '_process')
+        views_state.__enter__().AndReturn(views_state)
+        consumer._process(message)
+        views_state.__exit__(None, None, None).AndReturn(False)
+        self.mox.ReplayAll()
+        consumer.on_nova(None, message)
+        self.mox.VerifyAll()
+
+    def test_run_many(self):
+        configs = [{'name': 'cell1'}, {'name': 'cell2'}]
+        self.mox.StubOutWithMock(worker, 'run')
+        worker.run(configs[0], views_state=mox.IsA(worker.ViewsState))\
+              .InAnyOrder()
+        worker.run(configs[1], views_state=mox.IsA(worker.ViewsState))\
+              .InAnyOrder()
+        self.mox.ReplayAll()
+        worker.run_many(configs)
+        self.mox.VerifyAll()
+
+    def test_run_many_exits_if_a_deployment_does(self):
+        self.mox.stubs.Set(worker, '_current_consumers', {})
+        self.mox.stubs.Set(worker, '_stop_requested', False)
+        self.mox.StubOutWithMock(worker, 'run')
+        worker.run({'name': 'cell1'}, views_state=mox.IsA(worker.ViewsState))\
+              .AndRaise(SystemExit(1))
+        self.mox.ReplayAll()
+        self.assertRaises(SystemExit, worker.run_many, [{'name': 'cell1'}])
+        self.assertFalse(worker.continue_running())
+        self.mox.VerifyAll()
+
+    def test_process_with_pipeline(self):
+        deployment = self.mox.CreateMockAnything()
+        post_process = self.mox.CreateMockAnything()
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       pipeline=post_process)
+        body_dict = {u'key': u'value'}
+        message = self._create_message('monitor.info', body_dict)
+        args = ('monitor.info', body_dict)
+        raw = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, args, json.dumps(args))\
+             .AndReturn(raw)
+        message.ack()
+        self.mox.StubOutWithMock(views, 'post_process')
+        post_process.put(raw, body_dict)
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.mox.VerifyAll()
+
+    def test_process_with_stats(self):
+        deployment = self.mox.CreateMockAnything()
+        stats = self.mox.CreateMockAnything()
+        stats.enabled = True
+        consumer = worker.NovaConsumer('test', None, deployment, True, {},
+                                       stats=stats)
+        body_dict = {u'event_type': u'compute.instance.update'}
+        message = self._create_message('monitor.info', body_dict)
+        args = ('monitor.info', body_dict)
+        raw = self.mox.CreateMockAnything()
+        raw.instance = INSTANCE_ID_1
+        stage = self.mox.CreateMockAnything()
+        stage.__enter__().MultipleTimes()
+        stage.__exit__(None, None, None).MultipleTimes()
+        stats.stage('parse', []).AndReturn(stage)
+        stats.stage('process_raw_data', []).AndReturn(stage)
+        self.mox.StubOutWithMock(views, 'process_raw_data',
+                                 use_mock_anything=True)
+        views.process_raw_data(deployment, args, json.dumps(args))\
+             .AndReturn(raw)
+        message.ack()
+        stats.stage('aggregate_lifecycle', []).AndReturn(stage)
+        self.mox.StubOutWithMock(views, 'aggregate_lifecycle')
+        views.aggregate_lifecycle(raw)
+        stats.stage('aggregate_usage', []).AndReturn(stage)
+        self.mox.StubOutWithMock(views, 'aggregate_usage')
+        views.aggregate_usage(raw, body_dict)
+        stats.record(u'compute.instance.update', INSTANCE_ID_1, [])
+        self.mox.StubOutWithMock(consumer, '_check_memory',
+                                 use_mock_anything=True)
+        consumer._check_memory()
+        self.mox.ReplayAll()
+        consumer._process(message)
+        self.mox.VerifyAll()
+
     def test_run(self):
         config = {
             'name': 'east_coast.prod.global',
@@ -189,7 +1075,19 @@ class NovaConsumerTestCase(unittest.TestCase):
         conn.__exit__(None, None, None).AndReturn(None)
         self.mox.StubOutClassWithMocks(worker, 'NovaConsumer')
         consumer = worker.NovaConsumer(config['name'], conn, deployment,
-                                       config['durable_queue'], {})
+                                       config['durable_queue'], {},
+                                       batch_size=1, batch_timeout=0.5,
+                                       store_original_json=False,
+                                       compress_json=False,
+                                       priority_events=None,
+                                       priority_weight=4,
+                                       prefetch=0,
+                                       shard=None, pipeline=None,
+                                       stats=None,
+                                       dedup=mox.IsA(
+                                           message_dedup.MessageDedup),
+                                       dead_letters=None,
+                                       views_state=None, flow=None)
         consumer.run()
         worker.continue_running().AndReturn(False)
         self.mox.ReplayAll()
@@ -227,9 +1125,184 @@ class NovaConsumerTestCase(unittest.TestCase):
         self.mox.StubOutClassWithMocks(worker, 'NovaConsumer')
         consumer = worker.NovaConsumer(config['name'], conn, deployment,
                                        config['durable_queue'],
-                                       config['queue_arguments'])
+                                       config['queue_arguments'],
+                                       batch_size=1, batch_timeout=0.5,
+                                       store_original_json=False,
+                                       compress_json=False,
+                                       priority_events=None,
+                                       priority_weight=4,
+                                       prefetch=0,
+                                       shard=None, pipeline=None,
+                                       stats=None,
+                                       dedup=mox.IsA(
+                                           message_dedup.MessageDedup),
+                                       dead_letters=None,
+                                       views_state=None, flow=None)
         consumer.run()
         worker.continue_running().AndReturn(False)
         self.mox.ReplayAll()
         worker.run(config)
-        self.mox.VerifyAll()
\ No newline at end of file
+        self.mox.VerifyAll()
+    def test_run_router(self):
+        config = {
+            'name': 'east_coast.prod.global',
+            'durable_queue': False,
+            'rabbit_host': '10.0.0.1',
+            'rabbit_port': 5672,
+            'rabbit_userid': 'rabbit',
+            'rabbit_password': 'rabbit',
+            'rabbit_virtual_host': '/',
+            'consumers': 4
+        }
+        self.mox.StubOutWithMock(kombu.connection, 'BrokerConnection')
+        params = dict(hostname=config['rabbit_host'],
+                      port=config['rabbit_port'],
+                      userid=config['rabbit_userid'],
+                      password=config['rabbit_password'],
+                      transport="pyamqp",
+                      virtual_host=config['rabbit_virtual_host'])
+        self.mox.StubOutWithMock(worker, "continue_running")
+        worker.continue_running().AndReturn(True)
+        conn = self.mox.CreateMockAnything()
+        kombu.connection.BrokerConnection(**params).AndReturn(conn)
+        conn.__enter__().AndReturn(conn)
+        conn.__exit__(None, None, None).AndReturn(None)
+        self.mox.StubOutClassWithMocks(worker, 'ShardRouter')
+        router = worker.ShardRouter(config['name'], conn,
+                                    config['durable_queue'], {}, 4,
+                                    priority_events=None,
+                                    batch_size=100,
+                                    batch_timeout=0.5)
+        router.run()
+        worker.continue_running().AndReturn(False)
+        self.mox.ReplayAll()
+        worker.run_router(config)
+        self.mox.VerifyAll()
+
+
+class ShardRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        self.mox.stubs.Set(worker, '_install_signal_handlers', lambda: None)
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def test_shard_routing_key(self):
+        key = worker.shard_routing_key('monitor.info', 12)
+        self.assertEqual(key, 'monitor.info.shard.12')
+        self.assertEqual(worker.unshard_routing_key(key), 'monitor.info')
+        key = worker.shard_routing_key('monitor.info', 12, priority=True)
+        self.assertEqual(key, 'monitor.info.shard.12.priority')
+        self.assertEqual(worker.unshard_routing_key(key), 'monitor.info')
+
+    def test_route_priority_event(self):
+        router = worker.ShardRouter('test', None, True, {}, 4,
+                                    priority_events=[
+                                        'compute.instance.exists'])
+        router.producer = self.mox.CreateMockAnything()
+        router.confirms = self.mox.CreateMockAnything()
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': 'monitor.info'}
+        message.content_type = 'application/json'
+        message.content_encoding = 'utf-8'
+        message.body = json.dumps({
+            'event_type': 'compute.instance.exists',
+            'publisher_id': 'compute.example.com',
+            '_context_request_id': REQUEST_ID_1,
+            'payload': {'instance_id': INSTANCE_ID_1}})
+        shard = utils.shard_for(INSTANCE_ID_1, 4)
+        router.producer.publish(
+            message.body,
+            routing_key='monitor.info.shard.%d.priority' % shard,
+            content_type='application/json',
+            content_encoding='utf-8',
+            delivery_mode=2)
+        router.confirms.sent()
+        self.mox.ReplayAll()
+        router.on_nova(None, message)
+        self.assertEqual(router.routed[shard], 1)
+        self.assertEqual(router.prioritized, 1)
+        self.assertEqual(router.unconfirmed, [message])
+        self.mox.VerifyAll()
+
+    def test_route(self):
+        router = worker.ShardRouter('test', None, True, {}, 4)
+        router.producer = self.mox.CreateMockAnything()
+        router.confirms = self.mox.CreateMockAnything()
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': 'monitor.info'}
+        message.content_type = 'application/json'
+        message.content_encoding = 'utf-8'
+        message.body = json.dumps({
+            'event_type': 'compute.instance.update',
+            'publisher_id': 'compute.example.com',
+            '_context_request_id': REQUEST_ID_1,
+            'payload': {'instance_id': INSTANCE_ID_1}})
+        shard = utils.shard_for(INSTANCE_ID_1, 4)
+        router.producer.publish(message.body,
+                                routing_key='monitor.info.shard.%d' % shard,
+                                content_type='application/json',
+                                content_encoding='utf-8',
+                                delivery_mode=2)
+        router.confirms.sent()
+        self.mox.ReplayAll()
+        router.on_nova(None, message)
+        self.assertEqual(router.routed[shard], 1)
+        self.assertEqual(router.unconfirmed, [message])
+        self.mox.VerifyAll()
+
+    def _message(self, tag):
+        message = self.mox.CreateMockAnything()
+        message.delivery_info = {'routing_key': 'monitor.info'}
+        message.delivery_tag = tag
+        message.content_type = 'application/json'
+        message.content_encoding = 'utf-8'
+        message.channel = self.mox.CreateMockAnything()
+        message.body = json.dumps({
+            'event_type': 'compute.instance.update',
+            'message_id': 'message-%d' % tag,
+            'payload': {'instance_id': INSTANCE_ID_1}})
+        return message
+
+    def test_route_acks_batch_once_confirmed(self):
+        router = worker.ShardRouter('test', None, True, {}, 4, batch_size=2)
+        router.producer = self.mox.CreateMockAnything()
+        router.producer.publish(mox.IgnoreArg(), routing_key=mox.IgnoreArg(),
+                                content_type=mox.IgnoreArg(),
+                                content_encoding=mox.IgnoreArg(),
+                                delivery_mode=2).MultipleTimes()
+        channel = self.mox.CreateMockAnything()
+        channel.events = collections.defaultdict(set)
+        channel.confirm_select()
+        messages = [self._message(1), self._message(2)]
+
+        def confirm(allowed):
+            self.assertEqual(router.unconfirmed, [])
+            for callback in channel.events['basic_ack']:
+                callback(2, True)
+        channel.wait([(60, 80), (60, 120)]).WithSideEffects(confirm)
+        messages[1].channel.basic_ack(2, multiple=True)
+        self.mox.ReplayAll()
+        router.confirms = worker.PublishConfirms(channel)
+        router.on_nova(None, messages[0])
+        router.on_nova(None, messages[1])
+        self.assertEqual(router.unconfirmed, [])
+        self.mox.VerifyAll()
+
+    def test_publish_confirms_single_acks(self):
+        channel = self.mox.CreateMockAnything()
+        channel.events = collections.defaultdict(set)
+        channel.confirm_select()
+        self.mox.ReplayAll()
+        confirms = worker.PublishConfirms(channel)
+        for i in range(3):
+            confirms.sent()
+        confirms._on_ack(2, False)
+        self.assertEqual(confirms.confirmed, 0)
+        confirms._on_ack(1, False)
+        self.assertEqual(confirms.confirmed, 2)
+        confirms._on_ack(3, False)
+        self.assertEqual(confirms.confirmed, 3)
+        confirms.wait()
+        self.mox.VerifyAll()
@@ -0,0 +1,131 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+
+import mox
+
+import utils
+from utils import INSTANCE_ID_1
+from utils import INSTANCE_ID_2
+from stacktach import views
+from stacktach import write_behind
+
+
+class LifecycleWriteBehindTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        write_behind.STACKDB = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(write_behind.transaction,
+                                 'commit_on_success')
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+
+    def _create_lifecycle(self, instance, id=1):
+        lifecycle = utils.create_lifecycle(self.mox, instance, 'active', '',
+                                           None)
+        lifecycle.id = id
+        return lifecycle
+
+    def _expect_commit(self):
+        commit = self.mox.CreateMockAnything()
+        write_behind.transaction.commit_on_success().AndReturn(commit)
+        commit.__enter__().AndReturn(commit)
+        return commit
+
+    def test_save_new_lifecycle_writes_through(self):
+        writer = write_behind.LifecycleWriteBehind(1)
+        lifecycle = self._create_lifecycle(INSTANCE_ID_1, id=None)
+        write_behind.STACKDB.save(lifecycle)
+        self.mox.ReplayAll()
+        writer.save(lifecycle)
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(writer.writes, 1)
+        self.mox.VerifyAll()
+
+    def test_flush_coalesces_updates(self):
+        writer = write_behind.LifecycleWriteBehind(1)
+        lifecycle1 = self._create_lifecycle(INSTANCE_ID_1, id=1)
+        lifecycle1_again = self._create_lifecycle(INSTANCE_ID_1, id=1)
+        lifecycle2 = self._create_lifecycle(INSTANCE_ID_2, id=2)
+        commit = self._expect_commit()
+        write_behind.STACKDB.update_lifecycles([lifecycle1_again,
+                                                lifecycle2])
+        commit.__exit__(None, None, None).AndReturn(None)
+        self.mox.ReplayAll()
+        writer.save(lifecycle1)
+        writer.save(lifecycle2)
+        writer.save(lifecycle1_again)
+        self.assertEqual(len(writer), 2)
+        writer.flush()
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(writer.saves, 3)
+        self.assertEqual(writer.writes, 2)
+        self.mox.VerifyAll()
+
+    def test_flush_with_nothing_pending(self):
+        writer = write_behind.LifecycleWriteBehind(1)
+        self.mox.ReplayAll()
+        writer.flush()
+        self.mox.VerifyAll()
+
+    def test_maybe_flush(self):
+        writer = write_behind.LifecycleWriteBehind(1)
+        writer.last_flush = 100
+        lifecycle = self._create_lifecycle(INSTANCE_ID_1)
+        writer.save(lifecycle)
+        self.mox.StubOutWithMock(write_behind.time, 'time')
+        write_behind.time.time().AndReturn(100.5)
+        write_behind.time.time().AndReturn(101)
+        write_behind.time.time().AndReturn(101)
+        commit = self._expect_commit()
+        write_behind.STACKDB.update_lifecycles([lifecycle])
+        commit.__exit__(None, None, None).AndReturn(None)
+        self.mox.ReplayAll()
+        writer.maybe_flush()
+        self.assertEqual(len(writer), 1)
+        writer.maybe_flush()
+        self.assertEqual(len(writer), 0)
+        self.mox.VerifyAll()
+
+
+class WriteBehindAggregateLifecycleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mox = mox.Mox()
+        views.STACKDB = self.mox.CreateMockAnything()
+        views.LIFECYCLE_WRITER = self.mox.CreateMockAnything()
+
+    def tearDown(self):
+        views.LIFECYCLE_WRITER = None
+        self.mox.UnsetStubs()
+
+    def test_aggregate_lifecycle_saves_through_writer(self):
+        when = utils.decimal_utc()
+        raw = utils.create_raw(self.mox, when, 'compute.instance.update')
+        lifecycle = utils.create_lifecycle(self.mox, INSTANCE_ID_1, 'active',
+                                           '', None)
+        views.STACKDB.find_lifecycles(instance=INSTANCE_ID_1)\
+                     .AndReturn([lifecycle])
+        views.LIFECYCLE_WRITER.save(lifecycle)
+        self.mox.ReplayAll()
+        views.aggregate_lifecycle(raw)
+        self.assertEqual(lifecycle.last_raw_id, raw.id)
+        self.mox.VerifyAll()
@@ -89,8 +89,9 @@ def create_nova_notif(request_id=None, instance=INSTANCE_ID_1, type_id='1',
 
 def create_raw(mox, when, event, instance=INSTANCE_ID_1,
                request_id=REQUEST_ID_1, state='active', old_task='',
-               host='c.example.com', service='compute', json_str=''):
+               host='c.example.com', service='compute', json_str='', id=1):
     raw = mox.CreateMockAnything()
+    raw.id = id
     raw.host = host
     raw.service = service
     raw.instance = instance
@@ -20,7 +20,6 @@
 
 import argparse
 import datetime
-import json
 import os
 import sys
 from time import sleep
@@ -44,6 +43,7 @@ LOG = stacklog.get_logger()
 
 from stacktach import models
 from stacktach import datetime_to_decimal as dt
+from stacktach import utils
 from verifier import AmbiguousResults
 from verifier import FieldMismatch
 from verifier import NotFound
@@ -311,8 +311,7 @@ def _send_notification(message, routing_key, connection, exchange):
 
 
 def send_verified_notification(exist, connection, exchange, routing_keys=None):
-    body = exist.raw.json
-    json_body = json.loads(body)
+    json_body = utils.load_raw_json(exist.raw)
     json_body[1]['event_type'] = 'compute.instance.exists.verified.old'
     json_body[1]['original_message_id'] = json_body[1]['message_id']
     json_body[1]['message_id'] = str(uuid.uuid4())
@@ -0,0 +1,130 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Feeds the notifications the worker parked as dead letters back
+through the same code the worker uses, once whatever was making them
+fail has been fixed.
+
+    redrive.py --deployment east_coast.prod.cell1 --list
+    redrive.py --deployment east_coast.prod.cell1 \\
+               --event compute.instance.exists
+
+Each dead letter is redriven in its own transaction and deleted once it
+has gone through. One that fails again stays parked, with its attempts
+counted and the new error recorded. Dead letters that were stored but
+couldn't be aggregated only have their stored RawData aggregated."""
+
+import argparse
+import json
+import os
+import sys
+import traceback
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir, os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'stacktach')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+from django.db import transaction
+
+from stacktach import datetime_to_decimal as dt
+from stacktach import db
+from stacktach import views
+
+
+def redrive_dead_letter(dead_letter):
+    body = json.loads(dead_letter.json)
+    with transaction.commit_on_success():
+        if dead_letter.raw_id is not None:
+            raw = dead_letter.raw
+        else:
+            # Stored the same as the worker's store_original_json.
+            args = (dead_letter.routing_key, body)
+            raw = views.process_raw_data(dead_letter.deployment, args,
+                                         dead_letter.json)
+        if raw:
+            views.post_process(raw, body)
+        dead_letter.delete()
+
+
+def redrive(deployment, event=None, ids=None):
+    """Redrives the deployment's dead letters, returning how many went
+    through and how many failed again."""
+    redriven = failed = 0
+    for dead_letter in list(db.find_dead_letters(deployment, event=event,
+                                                 ids=ids)):
+        try:
+            redrive_dead_letter(dead_letter)
+            redriven += 1
+        except Exception:
+            failed += 1
+            dead_letter.attempts += 1
+            dead_letter.error = traceback.format_exc()
+            with transaction.commit_on_success():
+                db.save(dead_letter)
+    return redriven, failed
+
+
+def discard(deployment, event=None, ids=None):
+    with transaction.commit_on_success():
+        dead_letters = db.find_dead_letters(deployment, event=event, ids=ids)
+        count = dead_letters.count()
+        dead_letters.delete()
+    return count
+
+
+def list_dead_letters(deployment, event=None, ids=None):
+    print "%8s %-26s %-40s %8s  %s" % ('id', 'parked', 'event', 'attempts',
+                                       'error')
+    for dead_letter in db.find_dead_letters(deployment, event=event,
+                                            ids=ids).defer('json'):
+        error = dead_letter.error.strip().splitlines() or ['']
+        print "%8d %-26s %-40s %8d  %s" % \
+            (dead_letter.id, dt.dt_from_decimal(dead_letter.parked),
+             dead_letter.event, dead_letter.attempts, error[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('StackTach Dead Letter Redrive')
+    parser.add_argument('--deployment', required=True,
+                        help="Name of the deployment the dead letters "
+                             "were parked by.")
+    parser.add_argument('--event', default=None,
+                        help="Only the dead letters for this event type.")
+    parser.add_argument('--id', dest='ids', type=int, action='append',
+                        help="Only this dead letter. Can be repeated.")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--list', action='store_true',
+                        help="List the dead letters instead.")
+    action.add_argument('--discard', action='store_true',
+                        help="Delete the dead letters instead.")
+    args = parser.parse_args()
+
+    deployment, new = db.get_or_create_deployment(args.deployment)
+    if args.list:
+        list_dead_letters(deployment, event=args.event, ids=args.ids)
+    elif args.discard:
+        print "Discarded %d dead letters" % \
+            discard(deployment, event=args.event, ids=args.ids)
+    else:
+        redriven, failed = redrive(deployment, event=args.event,
+                                   ids=args.ids)
+        print "Redrove %d dead letters, %d failed again" % (redriven, failed)
+        sys.exit(failed and 1 or 0)
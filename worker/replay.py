@@ -0,0 +1,333 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Feeds dumps of captured notifications through the same code the
+worker uses, without RabbitMQ. Each line of a dump is a json encoded
+[routing_key, body] pair (the default RawData.json layout), and dumps
+ending in .gz are read with gzip.
+
+    replay.py --deployment east_coast.prod.cell1 --shards 4 \\
+              --checkpoint-dir /var/tmp/replay dump1.json.gz dump2.json
+
+Each batch of notifications is stored and aggregated in a single
+transaction and the checkpoint is written once it has committed, so a
+replay that is stopped or fails can be rerun with the same arguments
+to pick up from the last completed batch.
+
+With --shards, this process reads the dumps and hands each shard's
+lines to its own process, so a line is only decoded here and by the
+process that replays it."""
+
+import argparse
+import gzip
+import json
+import os
+import Queue as queue_module
+import sys
+
+from multiprocessing import Process
+from multiprocessing import Queue
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir, os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'stacktach')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+from django.db import transaction
+
+from stacktach import db
+from stacktach import lifecycle_cache
+from stacktach import notification
+from stacktach import utils
+from stacktach import views
+
+
+def open_dump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def checkpoint_path(checkpoint_dir, dump, shard):
+    return os.path.join(checkpoint_dir,
+                        '%s.shard%d' % (os.path.basename(dump), shard))
+
+
+def read_checkpoint(path):
+    """The number of lines of the dump already replayed."""
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(path, lines):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        f.write('%d\n' % lines)
+    os.rename(tmp, path)
+
+
+def shard_of(routing_key, body, shards):
+    # Same key as the worker's ShardRouter.
+    return utils.shard_for(notification.shard_key(body), shards)
+
+
+def replay_batch(deployment, batch):
+    try:
+        _replay_batch(deployment, batch)
+    except Exception:
+        if views.LIFECYCLE_CACHE is not None:
+            # Whatever the batch cached has been rolled back.
+            views.LIFECYCLE_CACHE.discard_all(
+                [notification.find_instance(body.get('payload', {}))
+                 for (routing_key, body), json_args in batch])
+        raise
+
+
+def _replay_batch(deployment, batch):
+    with transaction.commit_on_success():
+        raws = views.process_raw_data_batch(deployment, batch)
+        exists = []
+        for raw, (args, json_args) in zip(raws, batch):
+            if not raw:
+                continue
+            if raw.instance and raw.event == views.INSTANCE_EVENT['exists']:
+                # Their usage is aggregated together once the rest of
+                # the batch is in.
+                views.aggregate_lifecycle(raw)
+                exists.append((raw, args[1]))
+            else:
+                views.post_process(raw, args[1])
+        if exists:
+            views.aggregate_exists_batch(exists)
+
+
+def replay_lines(deployment, lines):
+    batch = []
+    for line in lines:
+        routing_key, body = json.loads(line)
+        batch.append(((routing_key, body), line))
+    replay_batch(deployment, batch)
+
+
+def replay_dump(deployment, dump, batch_size=500, checkpoint_dir=None):
+    """Replays the notifications in dump, returning how many were
+    replayed."""
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = checkpoint_path(checkpoint_dir, dump, 0)
+    start = read_checkpoint(checkpoint)
+
+    replayed = 0
+    lines = []
+    line_number = 0
+    with open_dump(dump) as f:
+        for line_number, line in enumerate(f, 1):
+            if line_number <= start:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+
+            lines.append(line)
+            if len(lines) >= batch_size:
+                replay_lines(deployment, lines)
+                replayed += len(lines)
+                lines = []
+                if checkpoint:
+                    write_checkpoint(checkpoint, line_number)
+
+    if lines:
+        replay_lines(deployment, lines)
+        replayed += len(lines)
+    if checkpoint and line_number > start:
+        write_checkpoint(checkpoint, line_number)
+    return replayed
+
+
+class ShardDied(Exception):
+    pass
+
+
+def put(queue, item, process=None):
+    """Puts item on a shard's queue, raising ShardDied if the shard's
+    process has exited rather than waiting for it forever."""
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except queue_module.Full:
+            if process is not None and not process.is_alive():
+                raise ShardDied("Shard process %s exited with %s" %
+                                (process.name, process.exitcode))
+
+
+def split_dump(dump, queues, batch_size=500, checkpoint_dir=None,
+               processes=None):
+    """Reads dump once, putting each shard's lines on queues[shard] in
+    batches of batch_size. Each batch goes with the number of lines of
+    the dump read so far, which is where that shard's checkpoint is
+    once the batch is replayed. The last batch for every shard, empty
+    or not, goes when the dump is finished. processes are the shards'
+    processes, for put()."""
+    shards = len(queues)
+    processes = processes or [None] * shards
+    starts = [0] * shards
+    if checkpoint_dir:
+        starts = [read_checkpoint(checkpoint_path(checkpoint_dir, dump,
+                                                  shard))
+                  for shard in range(shards)]
+    start = min(starts)
+
+    pending = [[] for shard in range(shards)]
+    line_number = 0
+    with open_dump(dump) as f:
+        for line_number, line in enumerate(f, 1):
+            if line_number <= start:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            routing_key, body = json.loads(line)
+            shard = shard_of(routing_key, body, shards)
+            if line_number <= starts[shard]:
+                continue
+
+            pending[shard].append(line)
+            if len(pending[shard]) >= batch_size:
+                put(queues[shard], (dump, pending[shard], line_number),
+                    processes[shard])
+                pending[shard] = []
+
+    for shard, queue in enumerate(queues):
+        put(queue, (dump, pending[shard], max(line_number, starts[shard])),
+            processes[shard])
+
+
+def replay_shard(deployment, queue, shard, checkpoint_dir=None):
+    """Replays the batches split_dump() puts on queue until it gets
+    None, returning how many were replayed from each dump."""
+    replayed = {}
+    while True:
+        item = queue.get()
+        if item is None:
+            return replayed
+        dump, lines, line_number = item
+        if lines:
+            replay_lines(deployment, lines)
+        replayed[dump] = replayed.get(dump, 0) + len(lines)
+        if checkpoint_dir:
+            write_checkpoint(checkpoint_path(checkpoint_dir, dump, shard),
+                             line_number)
+
+
+def _setup(deployment_name, lifecycle_cache_size):
+    deployment, new = db.get_or_create_deployment(deployment_name)
+    if lifecycle_cache_size:
+        # Nothing else should be writing to the instances in our shard.
+        views.LIFECYCLE_CACHE = \
+            lifecycle_cache.LifecycleCache(lifecycle_cache_size)
+    return deployment
+
+
+def replay(deployment_name, dumps, batch_size=500, checkpoint_dir=None,
+           lifecycle_cache_size=0):
+    deployment = _setup(deployment_name, lifecycle_cache_size)
+    for dump in dumps:
+        replayed = replay_dump(deployment, dump, batch_size=batch_size,
+                               checkpoint_dir=checkpoint_dir)
+        print "Replayed %d notifications from %s" % (replayed, dump)
+
+
+def replay_sharded(deployment_name, queue, shard, shards,
+                   checkpoint_dir=None, lifecycle_cache_size=0):
+    deployment = _setup(deployment_name, lifecycle_cache_size)
+    replayed = replay_shard(deployment, queue, shard,
+                            checkpoint_dir=checkpoint_dir)
+    for dump, count in sorted(replayed.items()):
+        print "Replayed %d notifications from %s (shard %d of %d)" % \
+            (count, dump, shard, shards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('StackTach Notification Replay')
+    parser.add_argument('dumps', nargs='+',
+                        help="Files of json encoded [routing_key, body] "
+                             "lines, optionally gzipped.")
+    parser.add_argument('--deployment', required=True,
+                        help="Name of the deployment to store them under.")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of processes to replay with, each "
+                             "taking the notifications for a share of "
+                             "the instances.")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help="Where to keep track of progress so the "
+                             "replay can be resumed.")
+    parser.add_argument('--lifecycle-cache-size', type=int, default=10000,
+                        help="Instances to cache lifecycles for in each "
+                             "process, 0 to turn it off.")
+    args = parser.parse_args()
+
+    if args.checkpoint_dir and not os.path.exists(args.checkpoint_dir):
+        os.makedirs(args.checkpoint_dir)
+
+    if args.shards <= 1:
+        replay(args.deployment, args.dumps, batch_size=args.batch_size,
+               checkpoint_dir=args.checkpoint_dir,
+               lifecycle_cache_size=args.lifecycle_cache_size)
+        sys.exit(0)
+
+    kwargs = dict(checkpoint_dir=args.checkpoint_dir,
+                  lifecycle_cache_size=args.lifecycle_cache_size)
+    queues = []
+    processes = []
+    for shard in range(args.shards):
+        # Bounded, so reading doesn't get too far ahead of replaying.
+        queue = Queue(4)
+        process = Process(target=replay_sharded,
+                          args=(args.deployment, queue, shard, args.shards),
+                          kwargs=kwargs)
+        process.start()
+        queues.append(queue)
+        processes.append(process)
+
+    try:
+        for dump in args.dumps:
+            split_dump(dump, queues, batch_size=args.batch_size,
+                       checkpoint_dir=args.checkpoint_dir,
+                       processes=processes)
+        for queue, process in zip(queues, processes):
+            put(queue, None, process)
+    except ShardDied as e:
+        # The rest can pick up from their checkpoints next time.
+        print "%s, stopping" % e
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        sys.exit(1)
+
+    failed = False
+    for process in processes:
+        process.join()
+        failed = failed or process.exitcode != 0
+    sys.exit(failed and 1 or 0)
@@ -2,6 +2,7 @@ import json
 import os
 import signal
 import sys
+import time
 
 from multiprocessing import Process
 
@@ -10,7 +11,9 @@ POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
 if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'stacktach')):
     sys.path.insert(0, POSSIBLE_TOPDIR)
 
+import worker.supervisor as supervisor
 import worker.worker as worker
+from stacktach import prefork
 
 config_filename = os.environ.get('STACKTACH_DEPLOYMENTS_FILE',
                                  'stacktach_worker_config.json')
@@ -21,32 +24,97 @@ except ImportError:
     pass
 
 processes = []
+autoscalers = []
+# How long the workers get to finish up when we're stopped.
+shutdown_timeout = 60
+stopping = False
 
 
-def kill_time(signal, frame):
+def all_processes():
+    return processes + [process for autoscaler in autoscalers
+                        for process in autoscaler.group.processes]
+
+
+def kill_time(signum, frame):
+    global stopping
+    if stopping:
+        # Asked twice, so don't wait for them.
+        print "killing ..."
+        supervisor.stop_processes(all_processes(), 0)
+        sys.exit(1)
+    stopping = True
     print "dying ..."
-    for process in processes:
-        process.terminate()
-    print "rose"
-    for process in processes:
-        process.join()
+    supervisor.stop_processes(all_processes(), shutdown_timeout)
     print "bud"
     sys.exit(0)
 
 
+def start_process(target, deployment, *args):
+    process = Process(target=target, args=(deployment,) + args)
+    # Daemonic processes can't start the post processing pool.
+    process.daemon = not deployment.get('post_process_workers')
+    process.start()
+    return process
+
+
 if __name__ == '__main__':
     config = None
     with open(config_filename, "r") as f:
         config = json.load(f)
 
     deployments = config['deployments']
+    shutdown_timeout = config.get('shutdown_timeout_secs', shutdown_timeout)
+    if config.get('prefork'):
+        # Finish loading what the workers would otherwise each load for
+        # themselves, so they share it with us.
+        load_time = prefork.preload()
+        print "Loaded the workers' modules in %.2fs" % load_time
+
+    def start_consumer(deployment):
+        return lambda shards: start_process(worker.run, deployment, shards)
 
+    shared = []
     for deployment in deployments:
         if deployment.get('enabled', True):
-            process = Process(target=worker.run, args=(deployment,))
-            process.daemon = True
-            process.start()
-            processes.append(process)
+            consumers = worker.shard_count(deployment)
+            if worker.autoscaling(deployment):
+                # The router spreads the notifications over a shard
+                # per consumer we could have, and the autoscaler
+                # shares them out between the ones we need.
+                processes.append(start_process(worker.run_router,
+                                               deployment))
+                autoscaler = supervisor.autoscaler(
+                    deployment, start_consumer(deployment), shutdown_timeout)
+                autoscaler.start()
+                autoscalers.append(autoscaler)
+            elif consumers > 1 or deployment.get('priority_events'):
+                # One router spreading the notifications across
+                # a consumer per shard, and splitting off the
+                # priority events.
+                processes.append(start_process(worker.run_router,
+                                               deployment))
+                for shard in range(consumers):
+                    processes.append(start_process(worker.run, deployment,
+                                                   shard))
+            elif deployment.get('shared_process') and \
+                    not deployment.get('post_process_workers'):
+                shared.append(deployment)
+            else:
+                processes.append(start_process(worker.run, deployment))
+    if shared:
+        # All the quiet deployments in one process, a thread each.
+        process = Process(target=worker.run_many, args=(shared,))
+        process.daemon = True
+        process.start()
+        processes.append(process)
     signal.signal(signal.SIGINT, kill_time)
     signal.signal(signal.SIGTERM, kill_time)
-    signal.pause()
+    if config.get('prefork'):
+        prefork.report_later(all_processes, load_time)
+    while True:
+        if not autoscalers:
+            signal.pause()
+            continue
+        for autoscaler in autoscalers:
+            autoscaler.poll()
+        time.sleep(1)
@@ -0,0 +1,241 @@
+# Copyright (c) 2013 - Rackspace Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""Looks after the worker processes start_workers.py starts."""
+
+from __future__ import absolute_import
+
+import os
+import signal
+import time
+import urllib
+
+import requests
+
+import worker.worker as worker
+
+
+def stop_processes(processes, timeout):
+    """Asks the processes to stop with a SIGTERM and waits up to timeout
+    seconds, in all, for them to do so. The workers stop consuming,
+    finish the batch they have, flush anything they're holding on to
+    and ack before exiting. Any still going after that are killed.
+    Returns the ones that had to be killed."""
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+    deadline = time.time() + timeout
+    for process in processes:
+        process.join(max(deadline - time.time(), 0))
+
+    killed = []
+    for process in processes:
+        if process.is_alive():
+            print "%s (pid %d) didn't stop within %ds, killing it" % \
+                (process.name, process.pid, timeout)
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            killed.append(process)
+    return killed
+
+
+def shares(count, shards):
+    """Splits the shard numbers up to shards between count consumers,
+    as evenly as they'll go."""
+    return [range(i, shards, count) for i in range(count)]
+
+
+class ConsumerGroup(object):
+    """The consumer processes of an autoscaled deployment.
+
+    The deployment's shard queues are shared out between however many
+    consumers there are, so to change that they're all stopped before
+    the new ones are started. No shard queue is ever read by two
+    consumers at once, which keeps each instance's events in order.
+    start(shards) starts a consumer for a share of them."""
+    def __init__(self, name, shards, start, timeout):
+        self.name = name
+        self.shards = shards
+        self.start = start
+        self.timeout = timeout
+        self.processes = []
+
+    def resize(self, count):
+        stop_processes(self.processes, self.timeout)
+        self.processes = [self.start(share)
+                          for share in shares(count, self.shards)]
+
+
+class QueueDepths(object):
+    """The number of messages in each of a virtual host's queues, from
+    the RabbitMQ management plugin's HTTP API."""
+    def __init__(self, url, userid, password, virtual_host='/', timeout=10):
+        self.url = url.rstrip('/')
+        self.auth = (userid, password)
+        self.virtual_host = virtual_host
+        self.timeout = timeout
+
+    def get(self):
+        url = '%s/api/queues/%s' % (self.url,
+                                    urllib.quote(self.virtual_host, safe=''))
+        response = requests.get(url, auth=self.auth,
+                                params={'columns': 'name,messages'},
+                                timeout=self.timeout)
+        response.raise_for_status()
+        # A new queue has no stats until the broker's next collection.
+        return dict((queue['name'], queue.get('messages') or 0)
+                    for queue in response.json())
+
+
+class LocalQueueDepths(object):
+    """Stands in for QueueDepths where there's no management plugin,
+    such as in tests. The depths are whatever they were last set to."""
+    def __init__(self, depths=None):
+        self.depths = dict(depths or {})
+
+    def set(self, queue, depth):
+        self.depths[queue] = depth
+
+    def get(self):
+        return dict(self.depths)
+
+
+class Autoscaler(object):
+    """Grows and shrinks a ConsumerGroup with the depth of its queues.
+
+    Once there have been more than scale_up_depth messages queued per
+    consumer for polls checks in a row, the group grows to as many
+    consumers as that many messages calls for, up to maximum. Once
+    there have been fewer than scale_down_depth per consumer for as
+    long, it loses one, down to minimum. Every change restarts the
+    group's consumers, so none is made within cooldown seconds of the
+    last one."""
+    def __init__(self, name, depths, queues, group, minimum, maximum,
+                 scale_up_depth, scale_down_depth, polls=3, interval=30,
+                 cooldown=300):
+        if scale_down_depth >= scale_up_depth:
+            raise ValueError("%s: scale_down_depth must be less than "
+                             "scale_up_depth" % name)
+        self.name = name
+        self.depths = depths
+        self.queues = queues
+        self.group = group
+        self.minimum = minimum
+        self.maximum = maximum
+        self.scale_up_depth = scale_up_depth
+        self.scale_down_depth = scale_down_depth
+        self.polls = polls
+        self.interval = interval
+        self.cooldown = cooldown
+        self.consumers = minimum
+        self.high = 0
+        self.low = 0
+        self.last_check = 0
+        self.last_change = None
+
+    def start(self):
+        self.group.resize(self.consumers)
+        self.last_change = time.time()
+
+    def poll(self):
+        """Checks the queues if it's been interval seconds since the
+        last time."""
+        now = time.time()
+        if now - self.last_check >= self.interval:
+            self.last_check = now
+            self.check()
+
+    def check(self):
+        try:
+            depths = self.depths.get()
+        except Exception as e:
+            print "%s: couldn't get the queue depths: %s" % (self.name, e)
+            return
+
+        depth = sum(depths.get(queue, 0) for queue in self.queues)
+        wanted = self._wanted(depth)
+        if wanted == self.consumers:
+            return
+        if time.time() - self.last_change < self.cooldown:
+            return
+
+        print "%s: %d messages queued, going from %d to %d consumers" % \
+            (self.name, depth, self.consumers, wanted)
+        self.group.resize(wanted)
+        self.consumers = wanted
+        self.last_change = time.time()
+        self.high = 0
+        self.low = 0
+
+    def _wanted(self, depth):
+        if depth > self.scale_up_depth * self.consumers and \
+                self.consumers < self.maximum:
+            self.high += 1
+            self.low = 0
+            if self.high >= self.polls:
+                needed = -(-depth // self.scale_up_depth)
+                return min(max(needed, self.consumers + 1), self.maximum)
+        elif depth < self.scale_down_depth * self.consumers and \
+                self.consumers > self.minimum:
+            self.low += 1
+            self.high = 0
+            if self.low >= self.polls:
+                return self.consumers - 1
+        else:
+            self.high = 0
+            self.low = 0
+        return self.consumers
+
+
+def autoscaler(deployment_config, start, timeout):
+    """The Autoscaler for a deployment, with start(shards) to start one
+    of its consumers and timeout for them to stop in."""
+    name = deployment_config['name']
+    shards = worker.shard_count(deployment_config)
+    host = deployment_config.get('rabbit_host', 'localhost')
+    url = deployment_config.get('rabbit_management_url',
+                                'http://%s:15672' % host)
+    depths = QueueDepths(url,
+                         deployment_config.get('rabbit_userid', 'rabbit'),
+                         deployment_config.get('rabbit_password', 'rabbit'),
+                         deployment_config.get('rabbit_virtual_host', '/'))
+
+    # Only the shard queues: another consumer won't help with a backlog
+    # the router hasn't got through.
+    queues = []
+    for shard in range(shards):
+        for key in worker.NOVA_ROUTING_KEYS:
+            queues.append(worker.shard_routing_key(key, shard))
+            if deployment_config.get('priority_events'):
+                queues.append(worker.shard_routing_key(key, shard,
+                                                       priority=True))
+
+    group = ConsumerGroup(name, shards, start, timeout)
+    return Autoscaler(name, depths, queues, group,
+                      deployment_config.get('min_consumers', 1),
+                      deployment_config['max_consumers'],
+                      deployment_config.get('scale_up_depth', 10000),
+                      deployment_config.get('scale_down_depth', 1000),
+                      polls=deployment_config.get('scale_polls', 3),
+                      interval=deployment_config.get('scale_interval_secs',
+                                                     30),
+                      cooldown=deployment_config.get('scale_cooldown_secs',
+                                                     300))
@@ -20,8 +20,12 @@ import datetime
 import kombu
 import kombu.entity
 import kombu.mixins
+import os
+import signal
 import sys
+import threading
 import time
+import traceback
 
 try:
     import ujson as json
@@ -31,27 +35,56 @@ except ImportError:
     except ImportError:
         import json
 
+from django.db import connection
+from django.db import transaction
 from pympler.process import ProcessMemoryInfo
 
+from stacktach import backpressure
+from stacktach import compression
+from stacktach import datetime_to_decimal as dt
 from stacktach import db
+from stacktach import dead_letter
+from stacktach import ingest_policy
+from stacktach import lifecycle_cache
+from stacktach import message_dedup
+from stacktach import message_stats
+from stacktach import notification
+from stacktach import pipeline
+from stacktach import spool
 from stacktach import stacklog
+from stacktach import utils
 from stacktach import views
+from stacktach import write_behind
 
 stacklog.set_default_logger_name('worker')
 LOG = stacklog.get_logger()
 
 
-class NovaConsumer(kombu.mixins.ConsumerMixin):
-    def __init__(self, name, connection, deployment, durable, queue_arguments):
+NOVA_ROUTING_KEYS = ['monitor.info', 'monitor.error']
+
+# When a deployment runs more than one consumer a ShardRouter moves
+# the notifications from the nova queues onto one queue per consumer.
+SHARD_EXCHANGE = 'stacktach.shards'
+
+
+def shard_routing_key(routing_key, shard, priority=False):
+    key = '%s.shard.%d' % (routing_key, shard)
+    if priority:
+        # The deployment's priority_events get queues of their own.
+        key += '.priority'
+    return key
+
+
+def unshard_routing_key(routing_key):
+    return routing_key.rsplit('.shard.', 1)[0]
+
+
+class BaseConsumer(kombu.mixins.ConsumerMixin):
+    def __init__(self, name, connection, durable, queue_arguments):
         self.connection = connection
-        self.deployment = deployment
         self.durable = durable
         self.queue_arguments = queue_arguments
         self.name = name
-        self.last_time = None
-        self.pmi = None
-        self.processed = 0
-        self.total_processed = 0
 
     def _create_exchange(self, name, type, exclusive=False, auto_delete=False):
         return kombu.entity.Exchange(name, type=type, exclusive=exclusive,
@@ -65,33 +98,649 @@ class NovaConsumer(kombu.mixins.ConsumerMixin):
                            queue_arguments=self.queue_arguments,
                            routing_key=routing_key)
 
-    def get_consumers(self, Consumer, channel):
+    def _nova_queues(self):
         nova_exchange = self._create_exchange("nova", "topic")
+        return [self._create_queue(key, nova_exchange, key)
+                for key in NOVA_ROUTING_KEYS]
 
-        nova_queues = [
-            self._create_queue('monitor.info', nova_exchange, 'monitor.info'),
-            self._create_queue('monitor.error', nova_exchange, 'monitor.error')
-        ]
+    def _shard_queues(self, shards, priority=False):
+        shard_exchange = self._create_exchange(SHARD_EXCHANGE, "direct")
+        queues = []
+        for shard in shards:
+            for key in NOVA_ROUTING_KEYS:
+                shard_key = shard_routing_key(key, shard, priority)
+                queues.append(self._create_queue(shard_key, shard_exchange,
+                                                 shard_key))
+        return queues
 
-        return [Consumer(queues=nova_queues, callbacks=[self.on_nova])]
 
-    def _process(self, message):
+class PublishConfirms(object):
+    """Waits for the broker to confirm everything published on a py-amqp
+    channel since the last wait(), all at once rather than one message
+    at a time. A basic.nack raises amqp's NotConfirmed."""
+    def __init__(self, channel):
+        self.channel = channel
+        self.published = 0
+        self.confirmed = 0
+        self.acked = set()
+        channel.events['basic_ack'].add(self._on_ack)
+        channel.confirm_select()
+
+    def _on_ack(self, delivery_tag, multiple):
+        if multiple:
+            self.confirmed = max(self.confirmed, delivery_tag)
+        else:
+            self.acked.add(delivery_tag)
+        while self.confirmed + 1 in self.acked:
+            self.confirmed += 1
+            self.acked.remove(self.confirmed)
+
+    def sent(self):
+        # The broker numbers confirms in the order they were published.
+        self.published += 1
+
+    def wait(self):
+        while self.confirmed < self.published:
+            self.channel.wait([(60, 80), (60, 120)])
+
+
+class ShardRouter(BaseConsumer):
+    """Spreads a deployment's notifications over several NovaConsumers.
+
+    Every notification is re-published, untouched, to the shard queue
+    picked by hashing its instance uuid, so all the events for an
+    instance are handled in order by the same consumer. The events in
+    priority_events go to a priority queue for the shard instead, which
+    its consumer favours, so they aren't held up behind a backlog of
+    everything else.
+
+    The copies are published batch_size at a time (or whatever arrived
+    within batch_timeout seconds) and the originals are only acked, all
+    together, once the broker has confirmed every copy in the batch.
+    Only the instance and event_type are read from each notification."""
+    def __init__(self, name, connection, durable, queue_arguments, shards,
+                 priority_events=None, batch_size=100, batch_timeout=0.1):
+        super(ShardRouter, self).__init__(name, connection, durable,
+                                          queue_arguments)
+        self.shards = shards
+        self.priority_events = set(priority_events or [])
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.producer = None
+        self.confirms = None
+        self.unconfirmed = []
+        self.batch_started = None
+        self.routed = [0] * shards
+        self.prioritized = 0
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self._nova_queues(),
+                         callbacks=[self.on_nova])]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # Declare all the shard queues up front so nothing is lost
+        # while the shard consumers are still starting.
+        shard_queues = self._shard_queues(range(self.shards))
+        if self.priority_events:
+            shard_queues += self._shard_queues(range(self.shards),
+                                               priority=True)
+        for queue in shard_queues:
+            queue(channel).declare()
+        self.producer = kombu.Producer(channel,
+                                       exchange=shard_queues[0].exchange)
+        self.confirms = PublishConfirms(channel)
+
+    def consume(self, limit=None, timeout=None, safety_interval=1, **kwargs):
+        # Wake up often enough to confirm a partial batch in time.
+        safety_interval = min(safety_interval, self.batch_timeout)
+        return super(ShardRouter, self).consume(
+            limit=limit, timeout=timeout, safety_interval=safety_interval,
+            **kwargs)
+
+    def _route(self, message):
+        routing_key = message.delivery_info['routing_key']
+        body = json.loads(str(message.body))
+        shard = utils.shard_for(notification.shard_key(body), self.shards)
+        priority = body.get('event_type') in self.priority_events
+
+        delivery_mode = self.durable and 2 or 1
+        self.producer.publish(message.body,
+                              routing_key=shard_routing_key(routing_key,
+                                                            shard, priority),
+                              content_type=message.content_type,
+                              content_encoding=message.content_encoding,
+                              delivery_mode=delivery_mode)
+        self.confirms.sent()
+        if not self.unconfirmed:
+            self.batch_started = time.time()
+        self.unconfirmed.append(message)
+        self.routed[shard] += 1
+        if priority:
+            self.prioritized += 1
+        if len(self.unconfirmed) >= self.batch_size:
+            self._confirm()
+
+    def _confirm(self):
+        """Waits for the broker to confirm the batch's copies, then acks
+        the originals."""
+        messages = self.unconfirmed
+        self.unconfirmed = []
+        self.batch_started = None
+        self.confirms.wait()
+        last = messages[-1]
+        last.channel.basic_ack(last.delivery_tag, multiple=True)
+
+    def on_iteration(self):
+        if self.unconfirmed and \
+                time.time() - self.batch_started >= self.batch_timeout:
+            self._confirm()
+
+    def on_consume_end(self, connection, channel):
+        if self.unconfirmed:
+            self._confirm()
+
+    def on_nova(self, body, message):
+        try:
+            self._route(message)
+        except Exception, e:
+            LOG.debug("Problem routing: %s\nFailed message body:\n%s" %
+                      (e, str(message.body)))
+            raise
+
+
+class ViewsState(object):
+    """A deployment's lifecycle cache, lifecycle writer and ingest policy,
+    which views keeps in module globals.
+
+    run_many() has several deployments in one process, so each consumer
+    swaps its own into views while it handles messages, holding a lock
+    they all share. Whatever views has when it's done is swapped back
+    out again, so the _setup_*() functions can be used inside it."""
+
+    lock = threading.RLock()
+
+    def __init__(self):
+        self.lifecycle_cache = None
+        self.lifecycle_writer = None
+        self.ingest_policy = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        views.LIFECYCLE_CACHE = self.lifecycle_cache
+        views.LIFECYCLE_WRITER = self.lifecycle_writer
+        views.INGEST_POLICY = self.ingest_policy
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.lifecycle_cache = views.LIFECYCLE_CACHE
+        self.lifecycle_writer = views.LIFECYCLE_WRITER
+        self.ingest_policy = views.INGEST_POLICY
+        self.lock.release()
+        return False
+
+
+class NullViewsState(object):
+    """Stands in for ViewsState when the deployment has the process, and
+    so views, to itself."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class NovaConsumer(BaseConsumer):
+    def __init__(self, name, connection, deployment, durable, queue_arguments,
+                 batch_size=1, batch_timeout=0, store_original_json=False,
+                 shard=None, pipeline=None, stats=None, compress_json=False,
+                 dedup=None, spool=None, spool_sync=0.1, dead_letters=None,
+                 views_state=None, priority_events=None, priority_weight=4,
+                 prefetch=0, flow=None):
+        super(NovaConsumer, self).__init__(name, connection, durable,
+                                           queue_arguments)
+        self.deployment = deployment
+        # Set when this is one of several consumers for the deployment,
+        # in which case we read from our shard queues instead of nova's.
+        # The consumers of an autoscaled deployment get a list of shards
+        # each.
+        self.shard = shard
+        self.last_time = None
+        self.pmi = None
+        self.processed = 0
+        self.total_processed = 0
+        # With a batch_size > 1 messages are collected until we have
+        # batch_size of them or the oldest is batch_timeout seconds old,
+        # then written in a single transaction and acked together.
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch = []
+        self.batch_started = None
+        # Store the message body as it came off the queue instead of
+        # re-encoding (routing_key, body) for RawData.json.
+        self.store_original_json = store_original_json
+        # Compress RawData.json with the latest shared dictionary.
+        self.compress_json = compress_json
+        # A pipeline.PostProcessPipeline to hand the raws to rather than
+        # post processing them ourselves.
+        self.pipeline = pipeline
+        # A message_stats.MessageStats to time each stage of handling a
+        # message with.
+        self.stats = stats or message_stats.NullMessageStats()
+        # A message_dedup.MessageDedup of the recently stored message_ids,
+        # to drop redelivered messages with. It outlives the consumer so
+        # it's still there after a reconnect.
+        if dedup is None:
+            dedup = message_dedup.MessageDedup(0)
+        self.dedup = dedup
+        # A spool.Spool to write the messages to instead of the database.
+        # They're acked once they've been synced, which happens every
+        # spool_sync seconds, and a spool.SpoolDrainer stores them.
+        self.spool = spool
+        self.spool_sync = spool_sync
+        self.spooled = []
+        self.spool_started = None
+        # A dead_letter.DeadLetters to park the messages that keep
+        # failing with, rather than raising and having them redelivered.
+        self.dead_letters = dead_letters
+        # A ViewsState to swap into views while handling messages, when
+        # other deployments are being consumed in the same process.
+        self.views_state = views_state or NullViewsState()
+        # When sharded, the priority_events have queues of their own and
+        # we let priority_weight times as many of them be in flight as
+        # of the rest. Either way we keep track of how far behind each
+        # lot is.
+        self.priority_events = priority_events
+        self.priority_weight = priority_weight
+        self.lag = None
+        if priority_events:
+            self.lag = message_stats.IngestLag(priority_events)
+        # How many unacked messages the broker may send us, 0 for no
+        # limit, unless a backpressure.PrefetchController is adjusting
+        # it (and pausing us) to how long our commits are taking.
+        self.prefetch = prefetch
+        self.flow = flow
+        self.channel = None
+
+    def get_consumers(self, Consumer, channel):
+        if self.shard is None:
+            queues = self._nova_queues()
+        elif self.priority_events:
+            return self._priority_consumers(Consumer)
+        else:
+            queues = self._shard_queues(self._shards())
+
+        return [Consumer(queues=queues, callbacks=[self.on_nova])]
+
+    def _shards(self):
+        if isinstance(self.shard, list):
+            return self.shard
+        return [self.shard]
+
+    def _priority_consumers(self, Consumer):
+        """Consumes the priority queues with priority_weight times the
+        prefetch of the others. The broker only sends another message
+        from a queue once one of its in flight messages is acked, so
+        during a backlog of both that's the ratio they're handled in.
+        Without a prefetch neither is limited, so they aren't weighted
+        either."""
+        priority = Consumer(queues=self._shard_queues(self._shards(),
+                                                      priority=True),
+                            callbacks=[self.on_nova])
+        other = Consumer(queues=self._shard_queues(self._shards()),
+                         callbacks=[self.on_nova])
+
+        # A prefetch only applies to the consumers started after it, so
+        # start them here rather than leaving it to ConsumerMixin.
+        if self.prefetch:
+            priority.qos(prefetch_count=self.prefetch * self.priority_weight)
+        priority.consume()
+        if self.prefetch:
+            other.qos(prefetch_count=self.prefetch)
+        other.consume()
+        return [priority, other]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        self.channel = channel
+        prefetch = self.prefetch
+        if self.flow is not None:
+            prefetch = self.flow.prefetch
+        if prefetch:
+            # For the channel, so shared by the priority consumers on
+            # top of their own.
+            channel.basic_qos(0, self._channel_prefetch(prefetch), True)
+
+    def _channel_prefetch(self, prefetch):
+        if self.shard is not None and self.priority_events:
+            # Room for both priority consumers' prefetches, so it's only
+            # the limit on the channel when backpressure shrinks it.
+            return prefetch * (self.priority_weight + 1)
+        return prefetch
+
+    def consume(self, limit=None, timeout=None, safety_interval=1, **kwargs):
+        # drain_events() only wakes up every safety_interval seconds
+        # when the queues are quiet, so wake up often enough to honour
+        # the batch timeout.
+        if self.batch_size > 1 and self.batch_timeout:
+            safety_interval = min(safety_interval, self.batch_timeout)
+        if self.spool is not None:
+            safety_interval = min(safety_interval, self.spool_sync)
+        return super(NovaConsumer, self).consume(
+            limit=limit, timeout=timeout, safety_interval=safety_interval,
+            **kwargs)
+
+    def on_iteration(self):
+        if self.spool is not None:
+            # Everything else is up to the drainer.
+            if self.spooled and \
+                    time.time() - self.spool_started >= self.spool_sync:
+                self._sync_spool()
+            return
+
+        with self.views_state:
+            if self.batch and \
+                    time.time() - self.batch_started >= self.batch_timeout:
+                self._process_batch()
+            if views.LIFECYCLE_WRITER is not None:
+                views.LIFECYCLE_WRITER.maybe_flush()
+            if views.INGEST_POLICY is not None:
+                views.INGEST_POLICY.maybe_flush()
+        self.stats.maybe_dump()
+        if self.flow is not None:
+            self._apply_backpressure()
+
+    def _apply_backpressure(self):
+        """Adjusts our prefetch to the commit latency, and waits here,
+        not taking any more messages, while it's over the ceiling."""
+        self._set_prefetch(self.flow.adjust())
+        while self.flow.paused and not self.should_stop:
+            time.sleep(self.flow.interval)
+            self.flow.probe()
+            self._set_prefetch(self.flow.adjust())
+
+    def _set_prefetch(self, prefetch):
+        if prefetch is not None and self.channel is not None:
+            self.channel.basic_qos(0, self._channel_prefetch(prefetch), True)
+
+    def _record_commit(self, seconds):
+        if self.flow is not None:
+            self.flow.record(seconds)
+
+    def on_consume_end(self, connection, channel):
+        if self.spool is not None:
+            if self.spooled:
+                self._sync_spool()
+            return
+
+        with self.views_state:
+            if self.batch:
+                self._process_batch()
+            if views.LIFECYCLE_WRITER is not None:
+                views.LIFECYCLE_WRITER.flush()
+            if views.INGEST_POLICY is not None:
+                views.INGEST_POLICY.flush()
+
+    def _routing_key(self, message):
         routing_key = message.delivery_info['routing_key']
+        if self.shard is not None:
+            routing_key = unshard_routing_key(routing_key)
+        return routing_key
+
+    def _message_args(self, message):
+        routing_key = self._routing_key(message)
+
+        if self.store_original_json:
+            body = message.body
+            args, json_args = (routing_key, json.loads(body)), body
+        else:
+            body = str(message.body)
+            args = (routing_key, json.loads(body))
+            json_args = json.dumps(args)
+
+        if self.compress_json:
+            json_args = compression.compress(json_args)
+        return args, json_args
+
+    def _process(self, message):
+        stages = []
+        with self.stats.stage('parse', stages):
+            args, asJson = self._message_args(message)
 
-        body = str(message.body)
-        args = (routing_key, json.loads(body))
-        asJson = json.dumps(args)
+        message_id = args[1].get('message_id')
+        if self.dedup.is_duplicate(message_id):
+            message.ack()
+            return
 
         # save raw and ack the message
-        raw = views.process_raw_data(self.deployment, args, asJson)
+        with self.stats.stage('process_raw_data', stages):
+            start = time.time()
+            try:
+                raw = views.process_raw_data(self.deployment, args, asJson)
+            except message_dedup.DuplicateMessage:
+                # Caught by the unique index instead.
+                self.dedup.duplicates += 1
+                raw = None
+                message.ack()
+            self._record_commit(time.time() - start)
+        self.dedup.add(message_id)
 
         if raw:
             self.processed += 1
             message.ack()
-            views.post_process(raw, args[1])
+            self._post_process_or_park(message, raw, args[1], stages)
+
+        self._record_stats(raw, args[1], stages)
+        self._check_memory()
+
+    def _process_or_park(self, message):
+        if self.dead_letters.attempt(self._process, message,
+                                     self._routing_key(message)):
+            message.ack()
+
+    def _add_to_batch(self, message):
+        if not self.batch:
+            self.batch_started = time.time()
+        self.batch.append(message)
+        if len(self.batch) >= self.batch_size:
+            self._process_batch()
+
+    def _process_batch(self):
+        messages = self.batch
+        self.batch = []
+        self.batch_started = None
+        self._store_batch(messages, ack=self._ack_batch)
+
+    def _store_batch(self, messages, ack=None):
+        """Stores and post processes messages, calling ack(messages)
+        once they're committed."""
+        batch = []
+        batch_messages = []
+        batch_stages = []
+        for message in messages:
+            stages = []
+            with self.stats.stage('parse', stages):
+                try:
+                    args, json_args = self._message_args(message)
+                except Exception:
+                    if self.dead_letters is None:
+                        raise
+                    return self._store_one_at_a_time(messages)
+            if self.dedup.is_duplicate(args[1].get('message_id')):
+                continue
+            batch.append((args, json_args))
+            batch_messages.append(message)
+            batch_stages.append(stages)
+
+        # save all the raws in one go
+        raws = []
+        if batch:
+            snapshot = self.stats.snapshot()
+            start = time.time()
+            try:
+                with transaction.commit_on_success():
+                    raws = views.process_raw_data_batch(self.deployment,
+                                                        batch)
+            except Exception:
+                if self.dead_letters is None:
+                    raise
+                return self._store_one_at_a_time(messages)
+            self._record_commit(time.time() - start)
+            seconds, queries = self.stats.since(snapshot)
+            for stages in batch_stages:
+                stages.append(('process_raw_data', seconds / len(batch),
+                               queries / float(len(batch))))
+
+        # ... then ack everything up to and including the last message
+        if ack is not None:
+            ack(messages)
+
+        exists = []
+        for raw, (args, json_args), message, stages in \
+                zip(raws, batch, batch_messages, batch_stages):
+            self.dedup.add(args[1].get('message_id'))
+            if raw and self._batches_exists(raw):
+                # Its usage is aggregated along with the rest below.
+                self.processed += 1
+                if self._post_process_or_park(message, raw, args[1], stages,
+                                              usage=False, batched=True):
+                    self._record_stats(raw, args[1], stages)
+                else:
+                    exists.append((message, raw, args[1], stages))
+                continue
+            if raw:
+                self.processed += 1
+                self._post_process_or_park(message, raw, args[1], stages,
+                                           batched=True)
+            self._record_stats(raw, args[1], stages)
+
+        if exists:
+            self._aggregate_exists(exists)
+
+        if views.LIFECYCLE_WRITER is not None:
+            views.LIFECYCLE_WRITER.flush()
+
+        self._check_memory()
 
+    def _batches_exists(self, raw):
+        return self.pipeline is None and raw.instance and \
+            raw.event == views.INSTANCE_EVENT['exists']
+
+    def _aggregate_exists(self, exists):
+        """Aggregates the usage for all of a batch's exists events in one
+        go, since they arrive in a flood at the end of each audit period.
+        Done after the rest of the batch so any usages and deletes they
+        refer to are already there."""
+        snapshot = self.stats.snapshot()
+        try:
+            views.aggregate_exists_batch([(raw, body) for message, raw, body,
+                                          stages in exists])
+        except Exception as e:
+            if dead_letter.is_infrastructure_error(e):
+                raise
+            transaction.rollback_unless_managed()
+            LOG.warn("%s: aggregating %d exists failed, aggregating them "
+                     "one at a time" % (self.name, len(exists)))
+            for message, raw, body, stages in exists:
+                self._post_process_or_park(message, raw, body, stages,
+                                           lifecycle=False, batched=True)
+                self._record_stats(raw, body, stages)
+            return
+
+        seconds, queries = self.stats.since(snapshot)
+        for message, raw, body, stages in exists:
+            stages.append(('aggregate_usage', seconds / len(exists),
+                           queries / float(len(exists))))
+            self._record_stats(raw, body, stages)
+
+    def store_spooled(self, messages):
+        """_store_batch() for the spool drainer's thread."""
+        with self.views_state:
+            self._store_batch(messages)
+
+    def _store_one_at_a_time(self, messages):
+        """Falls back to storing a batch that failed message by message,
+        so only the bad ones get parked."""
+        LOG.warn("%s: a batch of %d messages failed, storing them one at "
+                 "a time" % (self.name, len(messages)))
+        for message in messages:
+            self._process_or_park(message)
+        if views.LIFECYCLE_WRITER is not None:
+            views.LIFECYCLE_WRITER.flush()
+
+    def _ack_batch(self, messages):
+        last = messages[-1]
+        try:
+            last.channel.basic_ack(last.delivery_tag, multiple=True)
+        except TypeError:
+            # kombu's virtual transports (memory, redis, ...) can only
+            # ack one message at a time.
+            for message in messages:
+                message.ack()
+
+    def _spool_message(self, message):
+        if not self.spooled:
+            self.spool_started = time.time()
+        self.spool.append(message.delivery_info['routing_key'], message.body)
+        self.spooled.append(message)
+
+    def _sync_spool(self):
+        messages = self.spooled
+        self.spooled = []
+        self.spool_started = None
+        self.spool.sync()
+        self._ack_batch(messages)
         self._check_memory()
 
+    def _post_process_or_park(self, message, raw, body, stages,
+                              lifecycle=True, usage=True, batched=False):
+        """Returns True if it failed and was parked. A batched message
+        was acked along with the rest of its batch, so without dead
+        letters its failure is logged rather than raised, or the rest
+        of the batch would never be post processed."""
+        if self.dead_letters is None and not batched:
+            self._post_process(raw, body, stages, lifecycle, usage)
+            return False
+
+        try:
+            self._post_process(raw, body, stages, lifecycle, usage)
+        except Exception as e:
+            if dead_letter.is_infrastructure_error(e):
+                # Not the message's fault, so every message after it
+                # would be parked too.
+                raise
+            # It's already stored and acked, so there's no point trying
+            # again. Redriving it will aggregate the stored raw.
+            error = traceback.format_exc()
+            transaction.rollback_unless_managed()
+            if self.dead_letters is None:
+                LOG.error("%s: post processing raw %s failed:\n%s" %
+                          (self.name, raw.id, error))
+                return True
+            self.dead_letters.park(self._routing_key(message), message.body,
+                                   error, 1, raw=raw)
+            return True
+        return False
+
+    def _post_process(self, raw, body, stages, lifecycle=True, usage=True):
+        if self.pipeline is not None:
+            self.pipeline.put(raw, body)
+        elif self.stats.enabled or not (lifecycle and usage):
+            # Same as views.post_process(), a stage at a time.
+            if lifecycle:
+                with self.stats.stage('aggregate_lifecycle', stages):
+                    views.aggregate_lifecycle(raw)
+            if usage:
+                with self.stats.stage('aggregate_usage', stages):
+                    views.aggregate_usage(raw, body)
+        else:
+            views.post_process(raw, body)
+
+    def _record_stats(self, raw, body, stages):
+        instance = raw and raw.instance or None
+        self.stats.record(body.get('event_type'), instance, stages)
+        if self.lag is not None and raw is not None:
+            self.lag.record(body.get('event_type'), raw.when)
+
     def _check_memory(self):
         if not self.pmi:
             self.pmi = ProcessMemoryInfo()
@@ -117,12 +766,40 @@ class NovaConsumer(kombu.mixins.ConsumerMixin):
                       "%3d/%4d msgs @ %6dk/msg" %
                       (self.name, diff, idiff, self.processed,
                       self.total_processed, per_message))
+            if self.dedup.duplicates:
+                LOG.debug("%20s %d redelivered messages dropped" %
+                          (self.name, self.dedup.duplicates))
+            if self.dead_letters is not None and self.dead_letters.parked:
+                LOG.debug("%20s %d messages parked as dead letters" %
+                          (self.name, self.dead_letters.parked))
+            if self.spool is not None:
+                LOG.debug("%20s spool depth %dk, %d spooled, %d drained "
+                          "(%.1f msgs/sec)" %
+                          (self.name, self.spool.depth() / 1000,
+                           self.spool.appended, self.spool.drained,
+                           self.spool.drain_rate()))
+            if self.lag is not None and self.lag.lags:
+                LOG.debug("%20s ingest lag %s" %
+                          (self.name, self.lag.summary()))
+            if self.pipeline is not None:
+                LOG.debug("%20s post process queue depths %s, lag %s" %
+                          (self.name, self.pipeline.depths(),
+                           ["%.2fs" % lag for lag in self.pipeline.lag()]))
             self.last_vsz = self.pmi.vsz
             self.processed = 0
 
     def on_nova(self, body, message):
         try:
-            self._process(message)
+            if self.spool is not None:
+                self._spool_message(message)
+                return
+            with self.views_state:
+                if self.batch_size > 1:
+                    self._add_to_batch(message)
+                elif self.dead_letters is not None:
+                    self._process_or_park(message)
+                else:
+                    self._process(message)
         except Exception, e:
             LOG.debug("Problem: %s\nFailed message body:\n%s" %
                       (e, json.loads(str(message.body)))
@@ -130,8 +807,31 @@ class NovaConsumer(kombu.mixins.ConsumerMixin):
             raise
 
 
+# Set by a SIGTERM/SIGINT so the current consumers can finish up (and
+# flush anything they are holding on to) before the process exits.
+_stop_requested = False
+# name -> consumer. There's more than one when run_many() is consuming
+# from several deployments.
+_current_consumers = {}
+
+
+def _request_stop(signum, frame):
+    global _stop_requested
+    _stop_requested = True
+    for consumer in _current_consumers.values():
+        consumer.should_stop = True
+
+
+def _install_signal_handlers():
+    # Only the main thread can, and gets, signals.
+    if threading.current_thread().name != 'MainThread':
+        return
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+
 def continue_running():
-    return True
+    return not _stop_requested
 
 
 def exit_or_sleep(exit=False):
@@ -140,37 +840,194 @@ def exit_or_sleep(exit=False):
     time.sleep(5)
 
 
-def run(deployment_config):
-    name = deployment_config['name']
-    host = deployment_config.get('rabbit_host', 'localhost')
-    port = deployment_config.get('rabbit_port', 5672)
-    user_id = deployment_config.get('rabbit_userid', 'rabbit')
-    password = deployment_config.get('rabbit_password', 'rabbit')
-    virtual_host = deployment_config.get('rabbit_virtual_host', '/')
-    durable = deployment_config.get('durable_queue', True)
-    queue_arguments = deployment_config.get('queue_arguments', {})
-    exit_on_exception = deployment_config.get('exit_on_exception', False)
+def _consumer_kwargs(deployment_config):
+    """The optional NovaConsumer settings for a deployment."""
+    batch_timeout = deployment_config.get('batch_timeout_ms', 500) / 1000.0
+    return dict(
+        batch_size=deployment_config.get('batch_size', 1),
+        batch_timeout=batch_timeout,
+        store_original_json=deployment_config.get('store_original_json',
+                                                  False),
+        compress_json=deployment_config.get('compress_json', False),
+        priority_events=deployment_config.get('priority_events'),
+        priority_weight=deployment_config.get('priority_weight', 4),
+        prefetch=_prefetch_count(deployment_config))
 
-    deployment, new = db.get_or_create_deployment(name)
 
-    print "Starting worker for '%s'" % name
-    LOG.info("%s: %s %s %s %s" % (name, host, port, user_id, virtual_host))
+def _prefetch_count(deployment_config):
+    """The most unacked messages the broker may send the consumer, 0
+    for no limit. Unless set, there's only a limit when the commit
+    latency is adjusting it or there are priority events."""
+    batch_size = max(deployment_config.get('batch_size', 1), 1)
+    default = 0
+    if deployment_config.get('commit_latency_target_ms') or \
+            deployment_config.get('priority_events'):
+        # Weighting the priority events needs a limit too.
+        default = batch_size * 10
+    return deployment_config.get('prefetch_count', default)
+
+
+def _spool_prefetch_count(deployment_config):
+    # Spooled messages are only acked every spool_sync_ms, so a limit
+    # sized for the batch would hold back the consumer that's meant to
+    # keep up while the database can't. Only limit it when asked to.
+    return deployment_config.get('prefetch_count', 0)
+
+
+def _prefetch_controller(deployment_config):
+    target_ms = deployment_config.get('commit_latency_target_ms', 0)
+    if not target_ms:
+        return None
+
+    ceiling_ms = deployment_config.get('commit_latency_ceiling_ms',
+                                       target_ms * 10)
+    batch_size = max(deployment_config.get('batch_size', 1), 1)
+    maximum = max(_prefetch_count(deployment_config), batch_size)
+    return backpressure.PrefetchController(deployment_config['name'],
+                                           batch_size, maximum,
+                                           target_ms / 1000.0,
+                                           ceiling_ms / 1000.0)
+
+
+def autoscaling(deployment_config):
+    """Whether start_workers.py scales the deployment's consumers with
+    its backlog rather than starting a fixed number of them."""
+    # A consumer's spool holds the messages for the shards it had, so a
+    # deployment that spools keeps a fixed set of consumers.
+    return deployment_config.get('max_consumers', 0) > \
+        deployment_config.get('min_consumers', 1) and \
+        not deployment_config.get('spool_dir')
+
+
+def shard_count(deployment_config):
+    """How many shard queues the deployment's notifications are spread
+    over: one per consumer, or for an autoscaled deployment one for the
+    most consumers it can have, with each consumer taking a share."""
+    if autoscaling(deployment_config):
+        return deployment_config['max_consumers']
+    return deployment_config.get('consumers', 1)
+
+
+def _setup_lifecycle_cache(deployment_config, shard=None):
+    cache_size = deployment_config.get('lifecycle_cache_size', 0)
+    if not cache_size:
+        return
+
+    include = None
+    if shard is not None:
+        shards = shard_count(deployment_config)
+        mine = shard if isinstance(shard, list) else [shard]
+        include = lambda instance: \
+            utils.shard_for(instance, shards) in mine
+
+    warm_minutes = deployment_config.get('lifecycle_cache_warm_minutes', 60)
+    since = datetime.datetime.utcnow() - \
+        datetime.timedelta(minutes=warm_minutes)
+
+    views.LIFECYCLE_CACHE = lifecycle_cache.LifecycleCache(cache_size)
+    views.LIFECYCLE_CACHE.warm(dt.dt_to_decimal(since), include=include)
+
+
+def _setup_lifecycle_writer(deployment_config):
+    interval = deployment_config.get('lifecycle_write_behind_ms', 0)
+    if not interval:
+        return
+
+    views.LIFECYCLE_WRITER = \
+        write_behind.LifecycleWriteBehind(interval / 1000.0)
+
+
+def _setup_ingest_policy(deployment_config, deployment):
+    policies = deployment_config.get('ingest_policies')
+    if not policies:
+        return
+
+    interval = deployment_config.get('ingest_count_interval_secs', 60)
+    views.INGEST_POLICY = ingest_policy.IngestPolicy(deployment, policies,
+                                                     interval)
+
 
-    params = dict(hostname=host,
-                  port=port,
-                  userid=user_id,
-                  password=password,
-                  transport="librabbitmq",
-                  virtual_host=virtual_host)
+def _message_dedup(deployment_config):
+    size = deployment_config.get('dedup_cache_size', 10000)
+    return message_dedup.MessageDedup(size)
 
+
+def _dead_letters(deployment_config, deployment):
+    attempts = deployment_config.get('dead_letter_attempts', 0)
+    if not attempts:
+        return None
+
+    retry_delay = deployment_config.get('dead_letter_retry_ms', 1000)
+    return dead_letter.DeadLetters(deployment, attempts, retry_delay / 1000.0)
+
+
+def _open_spool(deployment_config, shard=None):
+    spool_dir = deployment_config.get('spool_dir')
+    if not spool_dir:
+        return None
+
+    directory = os.path.join(spool_dir, deployment_config['name'])
+    if isinstance(shard, list):
+        directory = os.path.join(directory,
+                                 'shard' + '-'.join(str(s) for s in shard))
+    elif shard is not None:
+        directory = os.path.join(directory, 'shard%d' % shard)
+    segment_mb = deployment_config.get('spool_segment_mb', 64)
+    return spool.Spool(directory, segment_mb * 1024 * 1024)
+
+
+def _start_spool_drainer(deployment_config, message_spool, processor):
+    batch_size = deployment_config.get('spool_batch_size', 500)
+    drainer = spool.SpoolDrainer(deployment_config['name'], message_spool,
+                                 processor.store_spooled,
+                                 processor.on_iteration, batch_size)
+    drainer.start()
+    return drainer
+
+
+def _message_stats(deployment_config):
+    interval = deployment_config.get('stats_interval_secs', 0)
+    slow_ms = deployment_config.get('slow_message_ms', 0)
+    if not interval and not slow_ms:
+        return None
+
+    return message_stats.MessageStats(deployment_config['name'],
+                                      interval or 300,
+                                      (slow_ms or 1000) / 1000.0)
+
+
+def _start_pipeline(deployment_config):
+    workers = deployment_config.get('post_process_workers', 0)
+    if not workers:
+        return None
+
+    queue_size = deployment_config.get('post_process_queue_size', 1000)
+    post_process = pipeline.PostProcessPipeline(deployment_config['name'],
+                                                workers, queue_size)
+    post_process.start()
+    return post_process
+
+
+def _connection_params(deployment_config):
+    return dict(hostname=deployment_config.get('rabbit_host', 'localhost'),
+                port=deployment_config.get('rabbit_port', 5672),
+                userid=deployment_config.get('rabbit_userid', 'rabbit'),
+                password=deployment_config.get('rabbit_password', 'rabbit'),
+                transport="librabbitmq",
+                virtual_host=deployment_config.get('rabbit_virtual_host',
+                                                   '/'))
+
+
+def _run_consumer(name, params, exit_on_exception, create_consumer):
+    _install_signal_handlers()
     # continue_running() is used for testing
     while continue_running():
         try:
             LOG.debug("Processing on '%s'" % name)
             with kombu.connection.BrokerConnection(**params) as conn:
                 try:
-                    consumer = NovaConsumer(name, conn, deployment, durable,
-                                            queue_arguments)
+                    consumer = create_consumer(conn)
+                    _current_consumers[name] = consumer
                     consumer.run()
                 except Exception as e:
                     LOG.error("!!!!Exception!!!!")
@@ -184,3 +1041,139 @@ def run(deployment_config):
             msg = "Uncaught exception: deployment=%s, exception=%s. Retrying in 5s"
             LOG.exception(msg % (name, e))
             exit_or_sleep(exit_on_exception)
+
+
+def run(deployment_config, shard=None, views_state=None):
+    name = deployment_config['name']
+    durable = deployment_config.get('durable_queue', True)
+    queue_arguments = deployment_config.get('queue_arguments', {})
+    exit_on_exception = deployment_config.get('exit_on_exception', False)
+    consumer_kwargs = _consumer_kwargs(deployment_config)
+    params = _connection_params(deployment_config)
+
+    deployment, new = db.get_or_create_deployment(name)
+    state = views_state or NullViewsState()
+    with state:
+        _setup_lifecycle_cache(deployment_config, shard=shard)
+        _setup_lifecycle_writer(deployment_config)
+        _setup_ingest_policy(deployment_config, deployment)
+    post_process = _start_pipeline(deployment_config)
+    stats = _message_stats(deployment_config)
+    dedup = _message_dedup(deployment_config)
+    dead_letters = _dead_letters(deployment_config, deployment)
+    flow = _prefetch_controller(deployment_config)
+    message_spool = _open_spool(deployment_config, shard=shard)
+    spool_sync = deployment_config.get('spool_sync_ms', 100) / 1000.0
+
+    drainer = None
+    if message_spool is not None:
+        processor = NovaConsumer(name, None, deployment, durable,
+                                 queue_arguments, shard=shard,
+                                 pipeline=post_process, stats=stats,
+                                 dedup=dedup, dead_letters=dead_letters,
+                                 views_state=views_state, **consumer_kwargs)
+        drainer = _start_spool_drainer(deployment_config, message_spool,
+                                       processor)
+
+    if shard is None:
+        print "Starting worker for '%s'" % name
+    elif isinstance(shard, list):
+        print "Starting worker for '%s' shards %s" % \
+            (name, ', '.join(str(s) for s in shard))
+    else:
+        print "Starting worker for '%s' shard %d" % (name, shard)
+    LOG.info("%s: %s %s %s %s" % (name, params['hostname'], params['port'],
+                                  params['userid'], params['virtual_host']))
+
+    def create_consumer(conn):
+        if message_spool is not None:
+            spool_kwargs = dict(consumer_kwargs,
+                                prefetch=_spool_prefetch_count(
+                                    deployment_config))
+            return NovaConsumer(name, conn, deployment, durable,
+                                queue_arguments, shard=shard,
+                                spool=message_spool, spool_sync=spool_sync,
+                                **spool_kwargs)
+        return NovaConsumer(name, conn, deployment, durable, queue_arguments,
+                            shard=shard, pipeline=post_process,
+                            stats=stats, dedup=dedup,
+                            dead_letters=dead_letters,
+                            views_state=views_state, flow=flow,
+                            **consumer_kwargs)
+
+    _run_consumer(name, params, exit_on_exception, create_consumer)
+
+    if drainer is not None:
+        drainer.stop()
+        message_spool.close()
+    if post_process is not None:
+        post_process.stop()
+    with state:
+        if views.LIFECYCLE_WRITER is not None:
+            views.LIFECYCLE_WRITER.flush()
+        if views.INGEST_POLICY is not None:
+            views.INGEST_POLICY.flush()
+
+
+def _run_shared(deployment_config, failed):
+    try:
+        run(deployment_config, views_state=ViewsState())
+    except SystemExit:
+        # exit_on_exception. Whatever restarts us won't notice a thread
+        # going, so take the whole process down.
+        failed.append(deployment_config['name'])
+        _request_stop(None, None)
+    finally:
+        # Django gives each thread a connection of its own.
+        connection.close()
+
+
+def run_many(deployment_configs):
+    """Consumes from several deployments in this one process, with a
+    thread each, instead of a process each with run(). This is for lots
+    of quiet deployments: they share the interpreter and Django, but
+    only one of them handles a message at a time."""
+    _install_signal_handlers()
+    failed = []
+    threads = []
+    for deployment_config in deployment_configs:
+        thread = threading.Thread(target=_run_shared,
+                                  args=(deployment_config, failed),
+                                  name=deployment_config['name'])
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        # join() without a timeout would hold up the signal handlers.
+        while thread.is_alive():
+            thread.join(1)
+    if failed:
+        sys.exit(1)
+
+
+def run_router(deployment_config):
+    name = deployment_config['name']
+    durable = deployment_config.get('durable_queue', True)
+    queue_arguments = deployment_config.get('queue_arguments', {})
+    exit_on_exception = deployment_config.get('exit_on_exception', False)
+    shards = shard_count(deployment_config)
+    priority_events = deployment_config.get('priority_events')
+    batch_size = deployment_config.get('router_batch_size', 100)
+    batch_timeout = deployment_config.get('batch_timeout_ms', 500) / 1000.0
+    params = _connection_params(deployment_config)
+    # librabbitmq can't do publisher confirms, and without them a copy
+    # the broker drops after we've acked the original is lost.
+    params['transport'] = 'pyamqp'
+
+    print "Starting router for '%s' (%d shards)" % (name, shards)
+    LOG.info("%s: %s %s %s %s" % (name, params['hostname'], params['port'],
+                                  params['userid'], params['virtual_host']))
+
+    def create_consumer(conn):
+        return ShardRouter(name, conn, durable, queue_arguments, shards,
+                           priority_events=priority_events,
+                           batch_size=batch_size,
+                           batch_timeout=batch_timeout)
+
+    _run_consumer(name, params, exit_on_exception, create_consumer)